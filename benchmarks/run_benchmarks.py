@@ -0,0 +1,403 @@
+"""
+run_benchmarks.py
+
+Benchmarks of the main entry points of the data API pipelines on synthetic, offline
+inputs (see synthetic_inputs.py), at several data sizes:
+
+- tc_windfields: windfields of track chunks (2_tc_genesis_basin.py),
+- tc_concat: concatenation of the basin files (4_tc_concat_basins.py),
+- tc_countries: country files of a global file (5_compute_tc_countries.py),
+- tc_countries_region: the same from the region-sorted layout (see region_layout.py),
+- subset_server: country subsets of the TC region-sorted layout as extracted by the
+  subset server (subset_server.LayoutFile.subset, written with write_stored),
+- storm_tracks_climada, storm_tracks, storm_tracks_cached: reading a STORM track file with
+  CLIMADA, with tropical_cyclone_STORM/storm_tracks.py and from its binary cache,
+- hail_aggregate: aggregation of radar hail to a 2km grid (hail/utility.aggregate_hazard),
+- centroids: land and ocean centroids with region ids (compute_centroids.make_base_centroids),
+- river_flood: ingestion of the flood netCDFs (compute_river_flood.py).
+
+The inputs of each case and size are generated from a fixed seed into a temporary data
+directory (used as config.DATA_DIR), and the case is then run in a fresh process, such
+that its wall time, CPU time (including worker processes) and peak memory are measured
+on their own. The results are written as JSON with the commit they were run on, to be
+compared across commits with --compare.
+
+Usage: python run_benchmarks.py [--cases tc_concat,hail_aggregate] [--sizes small,medium]
+                                [--out results.json] [--compare baseline.json]
+"""
+
+import os
+import sys
+import json
+import time
+import shutil
+import socket
+import argparse
+import platform
+import resource
+import tempfile
+import subprocess
+import importlib.util
+from datetime import datetime
+
+import cartopy
+import numpy as np
+import pandas as pd
+from pycountry import countries
+from climada.hazard import Hazard, TCTracks
+
+import synthetic_inputs as si
+
+REPO_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+sys.path.append(REPO_DIR)
+from instrumentation import peak_rss_mb
+from output_manifest import write_hdf5
+from region_layout import write_region_layout
+
+RESULTS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'results')
+SEED = 42
+#scale factor of the inputs of each size
+SIZES = {'small': 1, 'medium': 4, 'large': 16}
+RUN_ID = 'bench'  # TC_RUN_ID of the tropical cyclone scripts
+N_TRACKS = 10  # number of synthetic tracks per track in the file names
+HIST_YEARS = (1980, 2020)
+#genesis extent of the synthetic tracks and extent of the centroids of each basin
+TRACK_EXTENT = (-125, -95, 8, 18)
+BASIN_EXTENTS = {
+    'EP': (-180, -75, 0, 40),
+    'WP': (100, 180, 0, 45),
+    'SP': (135, 180, -40, 0),
+    'NI': (40, 100, 0, 30),
+    'SI': (30, 135, -40, 0),
+}
+FLOOD_YEARS = (1980, 1989)
+
+
+def load_script(rel_path):
+    """Import a script of the repository (whose name may start with a digit) as a module."""
+    path = os.path.join(REPO_DIR, rel_path)
+    sys.path.insert(0, os.path.dirname(path))
+    name = os.path.splitext(os.path.basename(path))[0].lstrip('0123456789_')
+    spec = importlib.util.spec_from_file_location(name, path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+#setup_<case>(data_dir, scale, rng) writes the inputs of a case and returns its number of
+#units of work, prepare_<case>(data_dir, scale) returns the call to measure.
+
+def _tc_base(data_dir):
+    return os.path.join(data_dir, 'tropical_cyclones', RUN_ID)
+
+
+def setup_tc_windfields(data_dir, scale, rng):
+    stage = load_script('tropical_cyclone/2_tc_genesis_basin.py')
+    os.makedirs(os.path.dirname(stage.CENT_FILE_PATH), exist_ok=True)
+    si.grid_centroids(BASIN_EXTENTS['EP'], 0.1).write_hdf5(stage.CENT_FILE_PATH)
+    tracks_dir = os.path.join(_tc_base(data_dir), 'tracks', '{}_{}'.format(*HIST_YEARS),
+                              f"{N_TRACKS}synth_tracks", 'EP')
+    os.makedirs(tracks_dir, exist_ok=True)
+    si.synthetic_tracks(10 * scale, 'EP', TRACK_EXTENT, rng).write_netcdf(tracks_dir)
+    return 10 * scale
+
+
+def prepare_tc_windfields(data_dir, scale):
+    stage = load_script('tropical_cyclone/2_tc_genesis_basin.py')
+    return lambda: stage.main('EP', N_TRACKS, *HIST_YEARS)
+
+
+def setup_tc_concat(data_dir, scale, rng):
+    stage = load_script('tropical_cyclone/4_tc_concat_basins.py')
+    years = '{}_{}'.format(*HIST_YEARS)
+    n_events = 100 * scale
+    for basin in stage.BASINS:
+        basin_dir = os.path.join(_tc_base(data_dir), 'genesis_basin', f"{N_TRACKS}synth_tracks", basin, 'historical')
+        os.makedirs(basin_dir, exist_ok=True)
+        haz = si.synthetic_tc_hazard(si.grid_centroids(BASIN_EXTENTS[basin], 0.25), n_events, 0.01, rng, basin=basin)
+        haz.write_hdf5(os.path.join(basin_dir, stage.FILE_NAME_HIST.format(n_tracks=N_TRACKS, basin=basin, year=years)))
+    return n_events * len(stage.BASINS)
+
+
+def prepare_tc_concat(data_dir, scale):
+    stage = load_script('tropical_cyclone/4_tc_concat_basins.py')
+    return lambda: stage.main(['historical'], N_TRACKS, years=['{}_{}'.format(*HIST_YEARS)])
+
+
+def setup_tc_countries(data_dir, scale, rng, region_layout=False):
+    stage = load_script('tropical_cyclone/4_tc_concat_basins.py')
+    years = '{}_{}'.format(*HIST_YEARS)
+    global_dir = os.path.join(_tc_base(data_dir), 'genesis_basin', f"{N_TRACKS}synth_tracks", 'global',
+                              'historical', years)
+    os.makedirs(global_dir, exist_ok=True)
+    centroids = si.grid_centroids((-180, 180, -60, 60), 0.5, n_countries=len(countries))
+    haz = si.synthetic_tc_hazard(centroids, 200 * scale, 0.002, rng)
+    global_file = os.path.join(global_dir, stage.FILE_NAME_GLOBAL_HIST.format(n_tracks=N_TRACKS, year=years))
+    write_hdf5(haz, global_file)
+    if region_layout:
+        write_region_layout(haz, global_file)
+    return len(countries)
+
+
+def setup_tc_countries_region(data_dir, scale, rng):
+    return setup_tc_countries(data_dir, scale, rng, region_layout=True)
+
+
+def prepare_subset_server(data_dir, scale):
+    import subset_server
+    from hazard_storage import write_stored
+    from region_layout import region_layout_path
+
+    years = '{}_{}'.format(*HIST_YEARS)
+    global_dir = os.path.join(_tc_base(data_dir), 'genesis_basin', f"{N_TRACKS}synth_tracks", 'global',
+                              'historical', years)
+    global_file = [name for name in os.listdir(global_dir) if name.endswith('.hdf5')][0]
+
+    def run():
+        layout = subset_server.LayoutFile(region_layout_path(os.path.join(global_dir, global_file)))
+        cache = subset_server.BlockCache(2**30)
+        try:
+            for country in countries:
+                columns = layout.columns(reg_ids=[int(country.numeric)])
+                if columns.size:
+                    write_stored(layout.subset(columns, cache), os.path.join(data_dir, 'subset.hdf5'))
+        finally:
+            layout.close()
+    return run
+
+
+def prepare_tc_countries(data_dir, scale):
+    stage = load_script('tropical_cyclone/5_compute_tc_countries.py')
+    return lambda: stage.main(scenarios=['historical'], n_tracks=N_TRACKS)
+
+
+def _storm_file(data_dir):
+    return os.path.join(data_dir, 'STORM_DATA_IBTRACS_EP_1000_YEARS_0.txt')
+
+
+def setup_storm_tracks(data_dir, scale, rng):
+    os.makedirs(data_dir, exist_ok=True)
+    return si.storm_file(_storm_file(data_dir), 100 * scale, 'EP', TRACK_EXTENT, rng)
+
+
+def setup_storm_tracks_cached(data_dir, scale, rng):
+    n_storms = setup_storm_tracks(data_dir, scale, rng)
+    load_script('tropical_cyclone_STORM/storm_tracks.py').load_storm_columns(_storm_file(data_dir))
+    return n_storms
+
+
+def prepare_storm_tracks(data_dir, scale):
+    storm_tracks = load_script('tropical_cyclone_STORM/storm_tracks.py')
+    return lambda: storm_tracks.read_storm_tracks(_storm_file(data_dir))
+
+
+def prepare_storm_tracks_climada(data_dir, scale):
+    return lambda: TCTracks.from_simulations_storm(_storm_file(data_dir))
+
+
+def setup_hail_aggregate(data_dir, scale, rng):
+    os.makedirs(data_dir, exist_ok=True)
+    si.radar_hazard(50 * scale, rng).write_hdf5(os.path.join(data_dir, 'MZC_synthetic.hdf5'))
+    return 50 * scale
+
+
+def prepare_hail_aggregate(data_dir, scale):
+    utility = load_script('hail/utility.py')
+    haz = Hazard.from_hdf5(os.path.join(data_dir, 'MZC_synthetic.hdf5'))
+    return lambda: utility.aggregate_hazard(haz, original_grid_epsg=2056, cell_size_new=2000, aggfunc='max')
+
+
+def _centroids_bounds(scale):
+    return (0, 0, 10 * scale, 10)
+
+
+def setup_centroids(data_dir, scale, rng):
+    bounds = _centroids_bounds(scale)
+    si.natural_earth_shapefiles(os.path.join(data_dir, 'cartopy'), bounds, 5 * scale, rng)
+    si.dist_coast_raster(os.path.join(data_dir, 'centroids', 'dist_coast.tif'))
+    #number of points of the land grid
+    return int((bounds[2] - bounds[0]) * (bounds[3] - bounds[1]) * (3600 / 150) ** 2)
+
+
+def prepare_centroids(data_dir, scale):
+    cartopy.config['data_dir'] = os.path.join(data_dir, 'cartopy')
+    compute_centroids = load_script('centroids/compute_centroids.py')
+    out_file = os.path.join(data_dir, 'centroids', 'earth_centroids_synthetic.hdf5')
+    # the region id and distance to coast rasters are built in the timed run (empty cache)
+    return lambda: compute_centroids.make_base_centroids(
+        out_file, bounds=_centroids_bounds(scale), cache_dir=os.path.join(data_dir, 'centroids', 'attributes_cache'),
+        dist_coast_file=os.path.join(data_dir, 'centroids', 'dist_coast.tif'))
+
+
+def setup_river_flood(data_dir, scale, rng):
+    stage = load_script('river_flood/compute_river_flood.py')
+    extent = (5, 15, 40, 50)
+    cent_dir = os.path.join(data_dir, 'centroids', stage.DATE_CENTROIDS)
+    os.makedirs(cent_dir, exist_ok=True)
+    si.grid_centroids(extent, 150 / 3600, n_countries=3).write_hdf5(
+        os.path.join(cent_dir, 'earth_centroids_150asland_1800asoceans_distcoast_region.hdf5'))
+    n_gcm = 2 * scale
+    si.flood_netcdfs(os.path.join(data_dir, 'river_flood', 'flood_flddph_hist'), FLOOD_YEARS, extent,
+                     150 / 3600, n_gcm, rng)
+    return n_gcm * (FLOOD_YEARS[1] - FLOOD_YEARS[0] + 1)
+
+
+def prepare_river_flood(data_dir, scale):
+    stage = load_script('river_flood/compute_river_flood.py')
+    return lambda: stage.main(years=[FLOOD_YEARS[0], FLOOD_YEARS[1] + 1], scenario='hist', aligned='climate_data')
+
+
+#inputs (setup), entry point (prepare) and unit of the throughput of each case
+CASES = {
+    'tc_windfields': (setup_tc_windfields, prepare_tc_windfields, 'tracks'),
+    'tc_concat': (setup_tc_concat, prepare_tc_concat, 'events'),
+    'tc_countries': (setup_tc_countries, prepare_tc_countries, 'countries'),
+    'tc_countries_region': (setup_tc_countries_region, prepare_tc_countries, 'countries'),
+    'subset_server': (setup_tc_countries_region, prepare_subset_server, 'countries'),
+    'storm_tracks_climada': (setup_storm_tracks, prepare_storm_tracks_climada, 'storms'),
+    'storm_tracks': (setup_storm_tracks, prepare_storm_tracks, 'storms'),
+    'storm_tracks_cached': (setup_storm_tracks_cached, prepare_storm_tracks, 'storms'),
+    'hail_aggregate': (setup_hail_aggregate, prepare_hail_aggregate, 'events'),
+    'centroids': (setup_centroids, prepare_centroids, 'grid points'),
+    'river_flood': (setup_river_flood, prepare_river_flood, 'gcm years'),
+}
+
+
+def measure(func):
+    """Wall time, CPU time (of the process and its terminated children) and peak RSS of a call."""
+    usage = [resource.getrusage(who) for who in (resource.RUSAGE_SELF, resource.RUSAGE_CHILDREN)]
+    start = time.perf_counter()
+    func()
+    wall_s = time.perf_counter() - start
+    usage_end = [resource.getrusage(who) for who in (resource.RUSAGE_SELF, resource.RUSAGE_CHILDREN)]
+    cpu_s = sum(end.ru_utime + end.ru_stime - begin.ru_utime - begin.ru_stime
+                for begin, end in zip(usage, usage_end))
+    return dict(wall_s=round(wall_s, 3), cpu_s=round(cpu_s, 3), peak_rss_mb=round(peak_rss_mb(), 1),
+                peak_rss_children_mb=round(usage_end[1].ru_maxrss / 1024, 1))
+
+
+def run_child(mode, case, size, work_dir):
+    """Generate the inputs of a case (mode 'setup') or run and measure it (mode 'run')."""
+    import config
+    config.DATA_DIR = os.path.join(work_dir, 'data')
+    setup, prepare, unit = CASES[case]
+    scale = SIZES[size]
+    meta_file = os.path.join(work_dir, 'meta.json')
+    if mode == 'setup':
+        n_units = setup(config.DATA_DIR, scale, np.random.default_rng(SEED))
+        with open(meta_file, 'w') as file:
+            json.dump({'n_units': n_units}, file)
+        return
+
+    with open(meta_file) as file:
+        n_units = json.load(file)['n_units']
+    record = measure(prepare(config.DATA_DIR, scale))
+    record.update(scale=scale, n_units=n_units, unit=unit, throughput=round(n_units / record['wall_s'], 3))
+    with open(os.path.join(work_dir, 'result.json'), 'w') as file:
+        json.dump(record, file)
+
+
+def git_commit():
+    """Short hash of the checked out commit, with '+dirty' if tracked files were modified."""
+    def git(*args):
+        return subprocess.run(['git', *args], cwd=REPO_DIR, capture_output=True, text=True).stdout.strip()
+    commit = git('rev-parse', '--short', 'HEAD') or 'unknown'
+    return commit + ('+dirty' if git('status', '--porcelain', '--untracked-files=no') else '')
+
+
+def run_benchmarks(cases, sizes, out_file=None, work_root=None, keep=False):
+    """
+    Run the benchmark cases at the given sizes and write the results.
+
+    Parameters:
+        cases (list of str): Cases to run (keys of CASES).
+        sizes (list of str): Sizes to run (keys of SIZES).
+        out_file (str, optional): JSON file of the results. Default: results/<commit>_<time>.json.
+        work_root (str, optional): Directory of the temporary data directories.
+        keep (bool): If True, keep the data directories (and logs) of the cases.
+
+    Returns:
+        dict: The results.
+    """
+    commit = git_commit()
+    if out_file is None:
+        os.makedirs(RESULTS_DIR, exist_ok=True)
+        out_file = os.path.join(RESULTS_DIR, f"{commit}_{datetime.now().strftime('%Y%m%d_%H%M%S')}.json")
+
+    results = []
+    for size in sizes:
+        for case in cases:
+            work_dir = tempfile.mkdtemp(prefix=f"bench_{case}_{size}_", dir=work_root)
+            env = dict(os.environ, TC_RUN_ID=RUN_ID, PIPELINE_LOG_DIR=os.path.join(work_dir, 'logs'))
+            record = dict(case=case, size=size, status='ok')
+            for mode in ['setup', 'run']:
+                log_file = os.path.join(work_dir, f"{mode}.log")
+                with open(log_file, 'w') as log:
+                    returncode = subprocess.call(
+                        [sys.executable, os.path.abspath(__file__), '--child', mode, case, size, work_dir],
+                        cwd=work_dir, env=env, stdout=log, stderr=subprocess.STDOUT)
+                if returncode:
+                    with open(log_file) as log:
+                        record.update(status=f"{mode} failed", error=(log.read().strip().splitlines() or [''])[-1])
+                    break
+            else:
+                with open(os.path.join(work_dir, 'result.json')) as file:
+                    record.update(json.load(file))
+            results.append(record)
+            print(f"{case} ({size}): " + (f"{record['wall_s']:.1f}s, {record['throughput']} {record['unit']}/s, "
+                                          f"{record['peak_rss_mb']:.0f} MB" if record['status'] == 'ok'
+                                          else f"{record['status']}: {record['error']}"))
+            if not keep:
+                shutil.rmtree(work_dir, ignore_errors=True)
+
+    report = dict(commit=commit, time=datetime.now().isoformat(timespec='seconds'), host=socket.gethostname(),
+                  python=platform.python_version(), cpus=os.cpu_count(), seed=SEED, results=results)
+    with open(out_file, 'w') as file:
+        json.dump(report, file, indent=1)
+    print(f"Results written to {out_file}")
+    return report
+
+
+def compare(report, baseline):
+    """
+    Compare results to a baseline, on the cases and sizes run successfully in both.
+
+    Parameters:
+        report (dict): Results of run_benchmarks.
+        baseline (dict): Results of run_benchmarks to compare to.
+
+    Returns:
+        pd.DataFrame: Wall time, throughput and peak RSS of both, with the speedup
+            (baseline / new wall time) and the ratio of peak RSS (new / baseline).
+    """
+    columns = ['wall_s', 'throughput', 'peak_rss_mb']
+    new, old = [pd.DataFrame(rep['results']).query("status == 'ok'").set_index(['case', 'size'])[columns]
+                for rep in (report, baseline)]
+    table = new.join(old, rsuffix='_base', how='inner')
+    table['speedup'] = (table['wall_s_base'] / table['wall_s']).round(2)
+    table['rss_ratio'] = (table['peak_rss_mb'] / table['peak_rss_mb_base']).round(2)
+    return table
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the pipelines on synthetic inputs.")
+    parser.add_argument('--cases', default=','.join(CASES))
+    parser.add_argument('--sizes', default='small', help=f"Comma-separated sizes of {list(SIZES)}.")
+    parser.add_argument('--out', default=None, help="JSON file of the results. Default: results/<commit>_<time>.json")
+    parser.add_argument('--compare', default=None, help="JSON file of results to compare to.")
+    parser.add_argument('--work-dir', default=None, help="Directory of the temporary inputs.")
+    parser.add_argument('--keep', action='store_true', help="Keep the inputs and logs of the cases.")
+    parser.add_argument('--child', nargs=4, metavar=('MODE', 'CASE', 'SIZE', 'WORK_DIR'), help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        run_child(*args.child)
+        sys.exit(0)
+
+    report = run_benchmarks(args.cases.split(','), args.sizes.split(','), out_file=args.out,
+                            work_root=args.work_dir, keep=args.keep)
+    if args.compare:
+        with open(args.compare) as file:
+            baseline = json.load(file)
+        with pd.option_context('display.width', 200, 'display.max_columns', None):
+            print(compare(report, baseline))
@@ -0,0 +1,359 @@
+"""
+synthetic_inputs.py
+
+Synthetic inputs for the benchmarks, generated locally from a random seed and written
+in the layout the pipeline scripts expect, such that the stages can be timed without
+the IBTrACS, ISIMIP, radar, CMIP6 and Natural Earth data:
+
+- tropical cyclone tracks (straight tracks with a rise and decay of intensity),
+- STORM track files,
+- gridded centroids with synthetic country region_ids (numeric ISO codes),
+- sparse hazards (e.g. basin or global tropical cyclone files),
+- hail radar hazards on the LV95 grid,
+- ISIMIP-like flood depth and fraction netCDFs,
+- Natural Earth land and country shapefiles for cartopy,
+- a distance to coast raster in the format of the NASA raster.
+"""
+
+import os
+
+import numpy as np
+import pandas as pd
+import xarray as xr
+from scipy import sparse
+from pycountry import countries
+
+from climada.hazard import Centroids, Hazard, TCTracks, TropCyclone
+from climada.hazard.tc_tracks import set_category
+
+#part of the LV95 grid covering Switzerland (xmin, ymin, xmax, ymax)
+LV95_EXTENT = (2485000, 1075000, 2834000, 1296000)
+
+
+def country_codes(n_countries):
+    """Alpha-3 and numeric ISO codes of the first n_countries countries of pycountry."""
+    sel = list(countries)[:n_countries]
+    return [country.alpha_3 for country in sel], np.array([int(country.numeric) for country in sel])
+
+
+def grid_centroids(extent, res, n_countries=0):
+    """
+    Regular centroids, optionally split into n_countries synthetic countries.
+
+    Parameters:
+        extent (tuple): (lon_min, lon_max, lat_min, lat_max).
+        res (float): Resolution in degrees.
+        n_countries (int): Number of countries, as bands of longitude with the numeric
+            ISO codes of country_codes as region_id. If 0, no region_id is set.
+
+    Returns:
+        Centroids: Centroids on the grid.
+    """
+    lon = np.arange(extent[0] + res/2, extent[1], res)
+    lat = np.arange(extent[2] + res/2, extent[3], res)
+    lon, lat = [coord.ravel() for coord in np.meshgrid(lon, lat)]
+    if not n_countries:
+        return Centroids(lat=lat, lon=lon)
+    _, codes = country_codes(n_countries)
+    band = np.minimum(((lon - extent[0]) / (extent[1] - extent[0]) * n_countries).astype(int),
+                      n_countries - 1)
+    return Centroids(lat=lat, lon=lon, region_id=codes[band], on_land=np.ones(lat.size, bool))
+
+
+def synthetic_tracks(n_tracks, basin, extent, rng, time_step_h=1):
+    """
+    Straight tropical cyclone tracks moving poleward and westward, with a rise and
+    decay of the intensity.
+
+    Parameters:
+        n_tracks (int): Number of tracks.
+        basin (str): Basin of the tracks, e.g. 'EP'.
+        extent (tuple): (lon_min, lon_max, lat_min, lat_max) of the genesis points.
+        rng (np.random.Generator): Random generator.
+        time_step_h (float): Time step in hours.
+
+    Returns:
+        TCTracks: The tracks.
+    """
+    poleward = 1 if extent[2] + extent[3] >= 0 else -1
+    data = []
+    for i_track in range(n_tracks):
+        n_steps = int(rng.integers(48, 168) / time_step_h)
+        time = pd.date_range(f"{rng.integers(1980, 2020)}-08-01", periods=n_steps, freq=f"{time_step_h}h")
+        step = np.arange(n_steps) * time_step_h
+        #translation speed of 4 to 8 m/s, heading west and poleward
+        speed_deg = rng.uniform(4, 8) * 3600 * time_step_h / 111e3
+        heading = np.radians(rng.uniform(20, 80))
+        lon = rng.uniform(extent[0], extent[1]) - np.arange(n_steps) * speed_deg * np.cos(heading)
+        lat = rng.uniform(extent[2], extent[3]) + poleward * np.arange(n_steps) * speed_deg * np.sin(heading)
+        peak = rng.uniform(35, 140)
+        wind = 25 + (peak - 25) * np.sin(np.pi * step / step[-1]) ** 2
+        #inverse of the wind-pressure relation of Atkinson and Holliday (1977)
+        pressure = 1010 - (wind / 6.7) ** (1 / 0.644)
+        data.append(xr.Dataset(
+            {
+                'time_step': ('time', np.full(n_steps, float(time_step_h))),
+                'radius_max_wind': ('time', np.linspace(20, 45, n_steps)),
+                'radius_oci': ('time', np.linspace(180, 350, n_steps)),
+                'max_sustained_wind': ('time', wind),
+                'central_pressure': ('time', pressure),
+                'environmental_pressure': ('time', np.full(n_steps, 1010.)),
+                'basin': ('time', np.full(n_steps, basin, dtype='<U2')),
+            },
+            coords={'time': time, 'lat': ('time', lat), 'lon': ('time', lon)},
+            attrs={
+                'max_sustained_wind_unit': 'kn',
+                'central_pressure_unit': 'mb',
+                'name': f"SYN{basin}{i_track}",
+                'sid': f"SYN{basin}{i_track}",
+                'orig_event_flag': True,
+                'data_provider': 'synthetic',
+                'id_no': float(i_track),
+                'category': set_category(wind, 'kn'),
+            }))
+    return TCTracks(data)
+
+
+def storm_file(path, n_years, basin, extent, rng, storms_per_year=10):
+    """
+    STORM track file (one line per 3-hourly time step: year, month, storm number, time
+    step, basin index, lat, lon in [0, 360), pressure, wind in m/s, radius of maximum
+    winds in km, category, landfall and distance to land).
+
+    Parameters:
+        path (str): File to write.
+        n_years (int): Number of simulated years.
+        basin (str): Basin of the tracks, e.g. 'EP'.
+        extent (tuple): (lon_min, lon_max, lat_min, lat_max) of the genesis points.
+        rng (np.random.Generator): Random generator.
+        storms_per_year (int): Mean number of storms per year.
+
+    Returns:
+        int: Number of storms.
+    """
+    basin_index = ['EP', 'NA', 'NI', 'SI', 'SP', 'WP'].index(basin)
+    blocks = []
+    for year in range(n_years):
+        for tc_num in range(rng.poisson(storms_per_year)):
+            n_steps = int(rng.integers(16, 56))
+            step = np.arange(n_steps)
+            lon = (rng.uniform(extent[0], extent[1]) - step * rng.uniform(0.2, 0.5)) % 360
+            lat = rng.uniform(extent[2], extent[3]) + step * rng.uniform(0.1, 0.3)
+            wind = 18 + rng.uniform(10, 50) * np.sin(np.pi * step / (n_steps - 1)) ** 2
+            pressure = 1010 - (wind / 3.45) ** (1 / 0.644)
+            blocks.append(np.column_stack([
+                np.full(n_steps, year), np.full(n_steps, rng.integers(6, 11)), np.full(n_steps, tc_num),
+                step, np.full(n_steps, basin_index), lat, lon, pressure, wind, np.linspace(20, 60, n_steps),
+                np.digitize(wind, [33, 43, 50, 58, 70]), np.zeros(n_steps), rng.uniform(0, 1000, n_steps)]))
+    np.savetxt(path, np.concatenate(blocks), delimiter=',', fmt='%g')
+    return len(blocks)
+
+
+def sparse_intensity(n_events, n_centroids, footprint, rng, vmin=17.5, vmax=70.):
+    """
+    Random sparse intensity where each event covers a contiguous range of centroids.
+
+    Parameters:
+        n_events (int): Number of events.
+        n_centroids (int): Number of centroids.
+        footprint (float): Fraction of the centroids covered by each event.
+        rng (np.random.Generator): Random generator.
+        vmin, vmax (float): Range of the intensity.
+
+    Returns:
+        sparse.csr_matrix: Intensity of shape (n_events, n_centroids).
+    """
+    width = max(1, int(footprint * n_centroids))
+    start = rng.integers(0, n_centroids - width + 1, n_events)
+    rows = np.repeat(np.arange(n_events), width)
+    cols = (start[:, None] + np.arange(width)).ravel()
+    values = rng.uniform(vmin, vmax, rows.size)
+    return sparse.csr_matrix((values, (rows, cols)), shape=(n_events, n_centroids))
+
+
+def synthetic_tc_hazard(centroids, n_events, footprint, rng, event_offset=0, basin='EP'):
+    """
+    TropCyclone with a random sparse intensity (see sparse_intensity).
+
+    Parameters:
+        centroids (Centroids): Centroids of the hazard.
+        n_events (int): Number of events.
+        footprint (float): Fraction of the centroids covered by each event.
+        rng (np.random.Generator): Random generator.
+        event_offset (int): Offset of the event ids.
+        basin (str): Basin of the events.
+
+    Returns:
+        TropCyclone: The hazard.
+    """
+    intensity = sparse_intensity(n_events, centroids.size, footprint, rng)
+    event_id = np.arange(1, n_events + 1) + event_offset
+    return TropCyclone(
+        centroids=centroids,
+        event_id=event_id,
+        event_name=[f"SYN{basin}{i_event}" for i_event in event_id],
+        date=rng.integers(723180, 737790, n_events),
+        frequency=np.full(n_events, 1 / n_events),
+        orig=np.ones(n_events, bool),
+        intensity=intensity,
+        fraction=sparse.csr_matrix(intensity.shape),
+        category=np.zeros(n_events, int),
+        basin=[basin] * n_events,
+    )
+
+
+def radar_hazard(n_events, rng, cell_size=1000, extent=LV95_EXTENT, n_cells=8, max_radius_km=8):
+    """
+    Hail hazard (MESHS in mm) on the LV95 grid, with each event made of a few hail
+    cells decreasing in intensity from their centre.
+
+    Parameters:
+        n_events (int): Number of events (days).
+        rng (np.random.Generator): Random generator.
+        cell_size (float): Grid spacing in m.
+        extent (tuple): (xmin, ymin, xmax, ymax) of the grid in LV95.
+        n_cells (int): Maximum number of hail cells per event.
+        max_radius_km (float): Maximum radius of the hail cells.
+
+    Returns:
+        Hazard: Hail hazard with centroids in LV95 (EPSG:2056).
+    """
+    x = np.arange(extent[0] + cell_size/2, extent[2], cell_size)
+    y = np.arange(extent[1] + cell_size/2, extent[3], cell_size)
+    n_x, n_y = x.size, y.size
+    xx, yy = np.meshgrid(x, y)
+
+    rows, cols, values = [], [], []
+    for i_event in range(n_events):
+        for _ in range(rng.integers(1, n_cells + 1)):
+            radius = rng.uniform(1, max_radius_km) * 1000 / cell_size
+            c_x, c_y = rng.integers(0, n_x), rng.integers(0, n_y)
+            i_y, i_x = np.mgrid[max(c_y - int(radius), 0):min(c_y + int(radius) + 1, n_y),
+                                max(c_x - int(radius), 0):min(c_x + int(radius) + 1, n_x)]
+            dist = np.hypot(i_y - c_y, i_x - c_x) / radius
+            inside = dist < 1
+            rows.append(np.full(inside.sum(), i_event))
+            cols.append((i_y * n_x + i_x)[inside])
+            values.append(20 + 50 * (1 - dist[inside]))
+    rows, cols, values = np.concatenate(rows), np.concatenate(cols), np.concatenate(values)
+    #keep the largest value where hail cells overlap
+    order = np.lexsort((-values, cols, rows))
+    rows, cols, values = rows[order], cols[order], values[order]
+    first = np.r_[True, (np.diff(rows) != 0) | (np.diff(cols) != 0)]
+    intensity = sparse.csr_matrix((np.round(values[first]), (rows[first], cols[first])),
+                                  shape=(n_events, n_x * n_y))
+
+    dates = np.sort(rng.choice(np.arange(pd.Timestamp('2002-04-01').toordinal(),
+                                         pd.Timestamp('2021-09-30').toordinal()), n_events, replace=False))
+    return Hazard(
+        'HL',
+        units='mm',
+        centroids=Centroids(lat=yy.ravel(), lon=xx.ravel(), crs='EPSG:2056'),
+        event_id=np.arange(1, n_events + 1),
+        event_name=[str(pd.Timestamp.fromordinal(int(date)).date()) for date in dates],
+        date=dates,
+        frequency=np.full(n_events, 1 / 20),
+        orig=np.ones(n_events, bool),
+        intensity=intensity,
+        fraction=sparse.csr_matrix((0, 0)),
+    )
+
+
+def flood_netcdfs(dph_dir, years, extent, res, n_gcm, rng, flooded=0.05):
+    """
+    Write ISIMIP-like annual flood depth (flddph) and fraction (fldfrc) files, one pair
+    per synthetic GCM. The fraction files are written to dph_dir with flddph replaced by
+    fldfrc, as read by compute_river_flood.py.
+
+    Parameters:
+        dph_dir (str): Directory of the flood depth files.
+        years (list of int): Start and end year (included).
+        extent (tuple): (lon_min, lon_max, lat_min, lat_max).
+        res (float): Resolution in degrees.
+        n_gcm (int): Number of GCMs.
+        rng (np.random.Generator): Random generator.
+        flooded (float): Fraction of flooded grid cells per year.
+
+    Returns:
+        list of str: Paths of the flood depth files.
+    """
+    lon = np.arange(extent[0] + res/2, extent[1], res)
+    lat = np.arange(extent[3] - res/2, extent[2], -res)
+    time = pd.date_range(f"{years[0]}-01-01", f"{years[1]}-01-01", freq='YS')
+    shape = (time.size, lat.size, lon.size)
+    coords = {'time': time, 'lat': lat, 'lon': lon}
+
+    frc_dir = dph_dir.replace('flddph', 'fldfrc')
+    os.makedirs(dph_dir, exist_ok=True)
+    os.makedirs(frc_dir, exist_ok=True)
+    paths = []
+    for i_gcm in range(n_gcm):
+        wet = rng.random(shape) < flooded
+        depth = np.where(wet, rng.gamma(1.5, 0.8, shape), 0).astype('float32')
+        fraction = np.where(wet, rng.uniform(0.01, 1, shape), 0).astype('float32')
+        name = f"flddph_150arcsec_synhm_syngcm{i_gcm}_historical_flopros_gev_0.1.nc"
+        paths.append(os.path.join(dph_dir, name))
+        xr.Dataset({'flddph': (('time', 'lat', 'lon'), depth)}, coords=coords).to_netcdf(paths[-1])
+        xr.Dataset({'fldfrc': (('time', 'lat', 'lon'), fraction)}, coords=coords).to_netcdf(
+            os.path.join(frc_dir, name.replace('flddph', 'fldfrc')))
+    return paths
+
+
+def natural_earth_shapefiles(data_dir, bounds, n_countries, rng):
+    """
+    Write Natural Earth 10m land and country shapefiles made of rectangular islands, in
+    the layout of the cartopy data directory (set cartopy.config['data_dir'] to data_dir
+    to use them instead of downloading Natural Earth).
+
+    Parameters:
+        data_dir (str): cartopy data directory.
+        bounds (tuple): (lon_min, lat_min, lon_max, lat_max) to place the islands in.
+        n_countries (int): Number of islands (countries).
+        rng (np.random.Generator): Random generator.
+    """
+    import geopandas as gpd
+    from shapely.geometry import box
+
+    alpha_3, numeric = country_codes(n_countries)
+    width = (bounds[2] - bounds[0]) / n_countries
+    height = bounds[3] - bounds[1]
+    geometry = []
+    for i_country in range(n_countries):
+        lon_min = bounds[0] + (i_country + rng.uniform(0.05, 0.3)) * width
+        lat_min = bounds[1] + rng.uniform(0.05, 0.3) * height
+        geometry.append(box(lon_min, lat_min, lon_min + rng.uniform(0.4, 0.65) * width,
+                            lat_min + rng.uniform(0.4, 0.65) * height))
+
+    ne_dir = os.path.join(data_dir, 'shapefiles', 'natural_earth')
+    os.makedirs(os.path.join(ne_dir, 'physical'), exist_ok=True)
+    os.makedirs(os.path.join(ne_dir, 'cultural'), exist_ok=True)
+    gpd.GeoDataFrame({'featurecla': ['Land'] * n_countries}, geometry=geometry, crs='EPSG:4326').to_file(
+        os.path.join(ne_dir, 'physical', 'ne_10m_land.shp'))
+    gpd.GeoDataFrame({
+        'ADM0_A3': alpha_3,
+        'ISO_A3': alpha_3,
+        'ISO_N3': [f"{code:03d}" for code in numeric],
+        'NAME': alpha_3,
+    }, geometry=geometry, crs='EPSG:4326').to_file(os.path.join(ne_dir, 'cultural', 'ne_10m_admin_0_countries.shp'))
+
+
+def dist_coast_raster(path, res=0.1, max_km=500):
+    """
+    Write a global distance to coast GeoTIFF with the layout of the NASA raster of CLIMADA
+    (km, negative on land), with distances growing with the latitude.
+
+    Parameters:
+        path (str): Path of the raster.
+        res (float): Resolution in degrees.
+        max_km (float): Largest distance.
+    """
+    import rasterio
+    from rasterio.transform import from_origin
+
+    n_rows, n_cols = int(round(180 / res)), int(round(360 / res))
+    lat = 90 - (np.arange(n_rows) + 0.5) * res
+    values = np.repeat((np.abs(lat) / 90 * max_km - max_km / 2).astype('float32')[:, None], n_cols, axis=1)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with rasterio.open(path, 'w', driver='GTiff', height=n_rows, width=n_cols, count=1, dtype='float32',
+                       crs='EPSG:4326', transform=from_origin(-180, 90, res, res)) as dst:
+        dst.write(values, 1)
@@ -0,0 +1,55 @@
+"""
+Centroid sets kept in memory by the worker daemon (see worker_daemon.py).
+
+The scripts load their centroids with load_centroids instead of Centroids.from_hdf5. In
+a job of the worker daemon, the centroid files preloaded by the daemon are returned
+without reading them again (each job is a forked copy of the daemon, such that changes
+of a job to the centroids are not seen by the other jobs). Outside of the daemon, and
+for files that changed since they were preloaded, the file is read.
+"""
+import os
+
+# preloaded centroids by real path: (modification time, Centroids)
+_preloaded = {}
+
+
+def _mtime(path):
+    return os.stat(path).st_mtime_ns
+
+
+def preload_centroids(paths):
+    """
+    Read centroid files into memory, for the jobs forked afterwards.
+
+    Parameters:
+        paths (list of str): Centroid files. Missing files are ignored.
+
+    Returns:
+        dict: Number of centroids of each preloaded file.
+    """
+    from climada.hazard import Centroids
+
+    for path in paths:
+        path = os.path.realpath(str(path))
+        if os.path.exists(path):
+            _preloaded[path] = (_mtime(path), Centroids.from_hdf5(path))
+    return {path: centroids.size for path, (_, centroids) in _preloaded.items()}
+
+
+def load_centroids(path):
+    """
+    Centroids of a file, preloaded if the file did not change since.
+
+    Parameters:
+        path (str): Centroid file (HDF5).
+
+    Returns:
+        Centroids
+    """
+    from climada.hazard import Centroids
+
+    real_path = os.path.realpath(str(path))
+    mtime, centroids = _preloaded.get(real_path, (None, None))
+    if centroids is not None and mtime == _mtime(real_path):
+        return centroids
+    return Centroids.from_hdf5(path)
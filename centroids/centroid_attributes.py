@@ -0,0 +1,261 @@
+"""
+Region ids and distances to coast of the global centroids, from cached rasters.
+
+Centroids.set_region_id tests each centroid against the country polygons, and the
+distance to coast of each centroid is computed from the coast geometries, for tens of
+millions of centroids in each of the 4 variants of compute_centroids.py. Instead, the
+country polygons (Natural Earth admin 0, ISO 3166 numeric codes as in CLIMADA) are
+rasterized once on the 150 arcsec grid, and the precomputed distance to coast raster of
+NASA (0.01 degree, km) is sampled once on the same grid. The attributes of the centroids
+are then looked up by index.
+
+There are two grids, whose cell centres are the points of the land centroids: 'edge'
+(points at multiples of the resolution, as Centroids.from_pnt_bounds and the ocean
+centroids) and 'centre' (shifted by half a cell, as the LitPop-aligned centroids), such
+that the region id of a centroid is that of the point itself, as with set_region_id. Each
+grid is built in bands of TILE_DEG degrees of latitude, in parallel, and only for the bands
+with centroids. The bands are cached in the cache directory (default
+<DATA_DIR>/centroids/attributes_cache), recorded in its manifest with the sources they
+were built from, and shared by all variants and later runs.
+
+The distance to coast is unsigned, in m, as Centroids.get_dist_coast.
+"""
+import os
+import sys
+import json
+import hashlib
+
+import numpy as np
+
+# Add parent directory of the current script to sys.path
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+from config import DATA_DIR
+from output_manifest import is_complete, read_manifest, write_atomic
+
+RES_ARCSEC = 150
+TILE_DEG = 10  # latitude band of a tile
+GRIDS = {'edge': 0., 'centre': 0.5}  # offset of the cell centres, in cells
+DIST_COAST_FILE = 'GMT_intermediate_coast_distance_01d.tif'  # NASA distance to coast, as in CLIMADA
+CACHE_VERSION = 1
+
+# country shapes (geometry, code), set before the pool of workers is started
+_shapes = None
+
+
+def default_cache_dir():
+    """Cache directory of the rasters."""
+    return os.path.join(DATA_DIR, 'centroids', 'attributes_cache')
+
+
+def default_dist_coast_file():
+    """NASA distance to coast raster of CLIMADA, downloaded if needed."""
+    from climada.util import coordinates as u_coord
+    from climada.util.constants import SYSTEM_DIR
+
+    path = SYSTEM_DIR.joinpath(DIST_COAST_FILE)
+    if not path.is_file():
+        u_coord.dist_to_coast_nasa(np.zeros(1), np.zeros(1))  # downloads the raster
+    return str(path)
+
+
+def grid_shape(grid, res=RES_ARCSEC / 3600):
+    """Number of rows (north to south) and columns (west to east) of a grid."""
+    offset = GRIDS[grid]
+    n_rows = int(round(180 / res)) + (1 if offset == 0 else 0)  # the edge grid has points at both poles
+    return n_rows, int(round(360 / res))
+
+
+def grid_origin(grid, res=RES_ARCSEC / 3600):
+    """Latitude of the first row and longitude of the first column of cell centres."""
+    offset = GRIDS[grid] * res
+    return 90 - offset, -180 + offset
+
+
+def tile_rows(res=RES_ARCSEC / 3600):
+    """Number of rows of a band."""
+    return int(round(TILE_DEG / res))
+
+
+def country_shapes():
+    """Natural Earth admin 0 country polygons with their ISO 3166 numeric code."""
+    import cartopy.io.shapereader as shpreader
+    from climada.util.coordinates import natearth_country_to_int
+
+    shp_file = shpreader.natural_earth(resolution='10m', category='cultural', name='admin_0_countries')
+    return shp_file, [(record.geometry, natearth_country_to_int(record))
+                      for record in shpreader.Reader(shp_file).records() if record.geometry is not None]
+
+
+def _file_key(path):
+    stat = os.stat(path)
+    return f"{os.path.abspath(path)}:{stat.st_size}:{stat.st_mtime_ns}"
+
+
+def source_key(shp_file, dist_coast_file):
+    """Checksum of the sources of the rasters, recorded with each cached band."""
+    sources = [str(CACHE_VERSION), str(RES_ARCSEC), str(TILE_DEG), _file_key(shp_file)]
+    # the shapefile comes with its attribute table
+    dbf_file = os.path.splitext(shp_file)[0] + '.dbf'
+    if os.path.exists(dbf_file):
+        sources.append(_file_key(dbf_file))
+    sources.append(_file_key(dist_coast_file))
+    return hashlib.sha256('\n'.join(sources).encode()).hexdigest()
+
+
+def band_path(cache_dir, grid, band):
+    """Cache file of a band of a grid."""
+    return os.path.join(cache_dir, f"centroid_attributes_{RES_ARCSEC}as_{grid}_{band:02d}.npz")
+
+
+def build_band(grid, band, dist_coast_file, res=RES_ARCSEC / 3600):
+    """
+    Region ids and distances to coast of the cell centres of a band of a grid.
+
+    Parameters:
+        grid (str): 'edge' or 'centre'.
+        band (int): Index of the band, from the north.
+        dist_coast_file (str): NASA distance to coast raster.
+        res (float): Resolution of the grid in degrees.
+
+    Returns:
+        region_id (np.ndarray of int16), dist_coast (np.ndarray of float32, m): Values of the
+            cells of the band, rows x columns.
+    """
+    import rasterio
+    from rasterio.features import rasterize
+    from rasterio.transform import from_origin, rowcol
+    from rasterio.windows import Window
+
+    n_rows, n_cols = grid_shape(grid, res)
+    lat0, lon0 = grid_origin(grid, res)
+    row_start = band * tile_rows(res)
+    rows = min(tile_rows(res), n_rows - row_start)
+    north = lat0 - (row_start - 0.5) * res
+    south = north - rows * res
+
+    # countries: cells whose centre is in the polygon
+    shapes = [(geom, code) for geom, code in _shapes if geom.bounds[1] <= north and geom.bounds[3] >= south]
+    region_id = np.zeros((rows, n_cols), dtype=np.int16)
+    if shapes:
+        region_id = rasterize(shapes, out_shape=(rows, n_cols), transform=from_origin(lon0 - res / 2, north, res, res),
+                              fill=0, dtype='int16')
+
+    # distance to coast: cell of the NASA raster containing the centre
+    lat = lat0 - (row_start + np.arange(rows)) * res
+    lon = lon0 + np.arange(n_cols) * res
+    with rasterio.open(dist_coast_file) as src:
+        src_rows, _ = rowcol(src.transform, np.zeros(rows), np.clip(lat, -89.999, 89.999))
+        _, src_cols = rowcol(src.transform, np.clip(lon, -179.999, 179.999), np.zeros(n_cols))
+        src_rows = np.clip(np.asarray(src_rows), 0, src.height - 1)
+        src_cols = np.clip(np.asarray(src_cols), 0, src.width - 1)
+        window = Window(0, src_rows.min(), src.width, src_rows.max() - src_rows.min() + 1)
+        values = src.read(1, window=window)
+    dist_coast = np.abs(values[np.ix_(src_rows - src_rows.min(), src_cols)]).astype(np.float32) * 1000
+    return region_id, dist_coast
+
+
+def _write_band(job):
+    """Build a band and write it to the cache (in a worker)."""
+    grid, band, path, dist_coast_file, source = job
+
+    def write(tmp_path):
+        region_id, dist_coast = build_band(grid, band, dist_coast_file)
+        with open(tmp_path, 'wb') as file:
+            np.savez(file, region_id=region_id, dist_coast=dist_coast)
+    write_atomic(path, write, info={'source': source, 'grid': grid, 'band': band})
+    return path
+
+
+def _cached(path, source):
+    return is_complete(path) and read_manifest(path).get(os.path.basename(path), {}).get('source') == source
+
+
+def _grid_index(lat, lon, res=RES_ARCSEC / 3600):
+    """Grid of each point (edge unless it is on the centre grid), with its row and column."""
+    on_centre = np.abs((lon + 180) / res % 1 - 0.5) < 0.25
+    grid_rows, grid_cols = {}, {}
+    for grid, select in (('edge', ~on_centre), ('centre', on_centre)):
+        n_rows, n_cols = grid_shape(grid, res)
+        lat0, lon0 = grid_origin(grid, res)
+        grid_rows[grid] = np.clip(np.rint((lat0 - lat[select]) / res), 0, n_rows - 1).astype(np.int64)
+        grid_cols[grid] = np.rint((lon[select] - lon0) / res).astype(np.int64) % n_cols
+    return on_centre, grid_rows, grid_cols
+
+
+def centroid_attributes(lat, lon, cache_dir=None, dist_coast_file=None, processes=None):
+    """
+    Region ids and distances to coast of points, from the cached bands of the grids.
+
+    Parameters:
+        lat, lon (np.ndarray): Coordinates of the points.
+        cache_dir (str, optional): Cache directory. Default: default_cache_dir().
+        dist_coast_file (str, optional): NASA distance to coast raster. Default: the raster
+            of CLIMADA (default_dist_coast_file()).
+        processes (int, optional): Workers building the missing bands. Default: number of CPUs.
+
+    Returns:
+        region_id (np.ndarray of int), dist_coast (np.ndarray of float, m)
+    """
+    global _shapes
+    cache_dir = cache_dir or default_cache_dir()
+    dist_coast_file = dist_coast_file or default_dist_coast_file()
+    lat, lon = np.asarray(lat, dtype=np.float64), np.asarray(lon, dtype=np.float64)
+    on_centre, grid_rows, grid_cols = _grid_index(lat, lon)
+
+    shp_file, shapes = country_shapes()
+    source = source_key(shp_file, dist_coast_file)
+    bands = {grid: np.unique(rows // tile_rows()) for grid, rows in grid_rows.items()}
+    jobs = [(grid, int(band), band_path(cache_dir, grid, band), dist_coast_file, source)
+            for grid, grid_bands in bands.items() for band in grid_bands
+            if not _cached(band_path(cache_dir, grid, band), source)]
+    if jobs:
+        from pathos.pools import ProcessPool as Pool
+
+        _shapes = shapes  # shared with the workers
+        pool = Pool(nodes=min(processes or os.cpu_count(), len(jobs)))
+        try:
+            list(pool.uimap(_write_band, jobs))
+        finally:
+            pool.close()
+            pool.join()
+            pool.clear()
+            _shapes = None
+
+    region_id = np.zeros(lat.size, dtype=np.int64)
+    dist_coast = np.zeros(lat.size, dtype=np.float64)
+    for grid, select in (('edge', ~on_centre), ('centre', on_centre)):
+        points = np.flatnonzero(select)
+        rows, cols = grid_rows[grid], grid_cols[grid]
+        for band in bands[grid]:
+            in_band = rows // tile_rows() == band
+            with np.load(band_path(cache_dir, grid, band)) as data:
+                band_rows = rows[in_band] - band * tile_rows()
+                region_id[points[in_band]] = data['region_id'][band_rows, cols[in_band]]
+                dist_coast[points[in_band]] = data['dist_coast'][band_rows, cols[in_band]]
+    return region_id, dist_coast
+
+
+def set_centroid_attributes(cent, cache_dir=None, dist_coast_file=None, processes=None):
+    """
+    Set the region_id and dist_coast of centroids (see centroid_attributes).
+
+    Parameters:
+        cent (Centroids): Centroids, modified in place.
+        cache_dir (str, optional): Cache directory of the rasters.
+        dist_coast_file (str, optional): NASA distance to coast raster.
+        processes (int, optional): Workers building the missing bands.
+    """
+    region_id, dist_coast = centroid_attributes(cent.lat, cent.lon, cache_dir, dist_coast_file, processes)
+    cent.gdf['region_id'] = region_id
+    cent.gdf['dist_coast'] = dist_coast
+
+
+if __name__ == "__main__":
+    # Usage: python centroid_attributes.py <centroids.hdf5>  (compares with set_region_id)
+    from climada.hazard import Centroids
+
+    cent = Centroids.from_hdf5(sys.argv[1])
+    region_id, _ = centroid_attributes(cent.lat, cent.lon)
+    cent.set_region_id(overwrite=True)
+    differ = region_id != cent.region_id
+    print(json.dumps({'n_centroids': int(cent.size), 'n_differ': int(differ.sum())}))
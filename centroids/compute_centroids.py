@@ -4,8 +4,9 @@ compute_centroids.py
 This script generates a global set of centroids for use in climate risk modelling, 
 distinguishing between land and ocean areas at different spatial resolutions.
 It uses Natural Earth shapefiles to define land boundaries, applies coastal buffers,
-assigns region IDs and land/ocean classifications, and saves the resulting centroids 
-in HDF5 format compatible with CLIMADA.
+assigns region IDs, distances to coast and land/ocean classifications, and saves the
+resulting centroids in HDF5 format compatible with CLIMADA. The region IDs and distances
+to coast are looked up in rasters cached for all variants (see centroid_attributes.py).
 
 It runs 4 variants by default:
 - LitPop-aligned grid (with and without poles)
@@ -19,16 +20,26 @@ from datetime import datetime
 # Add parent directory of the current script to sys.path
 sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
 from config import DATA_DIR
+from output_manifest import write_hdf5
+from instrumentation import timed
+import cli
 
 import cartopy.io.shapereader as shpreader
 from shapely.ops import unary_union
 import shapely.vectorized
 from climada.hazard import Centroids
+from centroid_attributes import set_centroid_attributes
 
 
+@timed('centroids')
 def make_base_centroids(out_file_path, bounds=(-180, -60, 180, 60), res_land_arcsec=150, res_ocean_arcsec=1800,
-                        land_buffer=0.1, on_land_buffer=0.02, litpop_aligned=False):
-    """Create and save a centroid grid with optional LitPop alignment and polar inclusion."""
+                        land_buffer=0.1, on_land_buffer=0.02, litpop_aligned=False, cache_dir=None,
+                        dist_coast_file=None, processes=None):
+    """
+    Create and save a centroid grid with optional LitPop alignment and polar inclusion.
+
+    cache_dir, dist_coast_file and processes are those of centroid_attributes.set_centroid_attributes.
+    """
     res_land = res_land_arcsec / 3600
     res_ocean = res_ocean_arcsec / 3600
 
@@ -65,16 +76,24 @@ def make_base_centroids(out_file_path, bounds=(-180, -60, 180, 60), res_land_arc
     cent = cent_land
     cent.append(cent_ocean)
 
-    # Add region ID and crop to bounds
-    cent.set_region_id()
+    # Add region ID and distance to coast, crop to bounds
+    set_centroid_attributes(cent, cache_dir=cache_dir, dist_coast_file=dist_coast_file, processes=processes)
     cent = cent.select(extent=(bounds[0], bounds[2], bounds[1], bounds[3]))
-    cent.write_hdf5(out_file_path)
+    write_hdf5(cent, out_file_path)
 
 
-# === Auto-run all 4 variants ===
-if __name__ == "__main__":
-    date_str = datetime.today().strftime('%m_%Y')
-    out_dir = os.path.join(DATA_DIR, 'centroids', date_str)
+def main(out_dir=None, cache_dir=None, processes=None):
+    """
+    Create the 4 variants of the centroids.
+
+    Parameters:
+        out_dir (str, optional): Output directory. Default: <DATA_DIR>/centroids/<month>_<year>.
+        cache_dir (str, optional): Cache of the region id and distance to coast rasters.
+            Default: <DATA_DIR>/centroids/attributes_cache.
+        processes (int, optional): Workers building the rasters. Default: number of CPUs.
+    """
+    if out_dir is None:
+        out_dir = os.path.join(DATA_DIR, 'centroids', datetime.today().strftime('%m_%Y'))
     os.makedirs(out_dir, exist_ok=True)
 
     variants = [
@@ -92,6 +111,16 @@ if __name__ == "__main__":
 
         bounds = (-180, -90, 180, 90) if variant["include_poles"] else (-180, -60, 180, 60)
         print(bounds)
-        make_base_centroids(out_file, bounds=bounds, litpop_aligned=variant["litpop_aligned"])
+        make_base_centroids(out_file, bounds=bounds, litpop_aligned=variant["litpop_aligned"],
+                            cache_dir=cache_dir, processes=processes)
 
         print(f"✓ Created: {file_name}")
+
+
+# === Auto-run all 4 variants ===
+if __name__ == "__main__":
+    cli.run(main, 'centroids', [
+        ('out_dir', str, None, "Output directory"),
+        ('cache_dir', str, None, "Cache of the region id and distance to coast rasters"),
+        ('processes', int, None, "Workers building the rasters (default: number of CPUs)"),
+    ], description="Create the global centroids.")
@@ -0,0 +1,245 @@
+"""
+Common command line of the pipeline scripts, with opt-in profiling.
+
+The arguments of a script can be given positionally, in the order of the former
+sys.argv interface (such that the job files keep working), or by name (--n-tracks 10).
+Each script can further be run under one or several profiling modes:
+
+--profile        cProfile of the main process: <prefix>.prof (for pstats or snakeviz) and
+                 the 40 most expensive functions by cumulative time in <prefix>_profile.txt.
+--trace-memory   tracemalloc: a snapshot after each timed unit of work (see instrumentation),
+                 <prefix>_<stage>_<unit>.tracemalloc, and the top allocations at the end of
+                 the run in <prefix>_memory.txt.
+--sample [MS]    Sampling of the stack of the main thread every MS milliseconds (default 10),
+                 written as collapsed stacks to <prefix>.folded (for flamegraph.pl or speedscope).
+
+The modes can also be enabled without changing the job files with the environment
+variable PIPELINE_PROFILE (e.g. PIPELINE_PROFILE=profile,sample). The outputs are written
+to PIPELINE_PROFILE_DIR (default: <log dir>/profiles) with the prefix
+<stage>_<run id>_<host>_<pid>, the run ID being TC_RUN_ID if set and the start time otherwise.
+Worker processes of pools are not profiled.
+
+--storage PROFILE sets the storage profile of the hazard outputs (HAZARD_STORAGE, see
+hazard_storage.py) for the script and its worker processes.
+"""
+import os
+import sys
+import pstats
+import socket
+import cProfile
+import argparse
+import threading
+import tracemalloc
+from collections import Counter
+from contextlib import contextmanager
+from datetime import datetime
+
+import instrumentation
+import hazard_storage
+
+PROFILE_ENV = 'PIPELINE_PROFILE'
+PROFILE_DIR_ENV = 'PIPELINE_PROFILE_DIR'
+PROFILE_DIR = os.environ.get(PROFILE_DIR_ENV) or os.path.join(instrumentation.LOG_DIR, 'profiles')
+SAMPLE_INTERVAL_MS = 10
+TRACE_FRAMES = 10  # frames stored per allocation by tracemalloc
+REQUIRED = object()  # default of the arguments that must be given
+
+
+def int_list(value):
+    """Comma-separated integers, e.g. 26,45."""
+    return [int(item) for item in value.split(',')]
+
+
+def str_list(value):
+    """Comma-separated strings, e.g. rcp26,rcp85."""
+    return value.split(',')
+
+
+def boolean(value):
+    """true/false, yes/no or 1/0."""
+    if value.lower() in ('true', 'yes', '1'):
+        return True
+    if value.lower() in ('false', 'no', '0'):
+        return False
+    raise argparse.ArgumentTypeError(f"not a boolean: {value}")
+
+
+def storage_profile(value):
+    """Storage profile of the hazard outputs, e.g. float32+zstd."""
+    try:
+        return hazard_storage.parse_profile(value)['spec']
+    except (ValueError, ImportError) as err:
+        raise argparse.ArgumentTypeError(str(err))
+
+
+def run_id():
+    """TC_RUN_ID if set, otherwise the current time."""
+    return os.environ.get('TC_RUN_ID') or datetime.now().strftime('%Y%m%d_%H%M%S')
+
+
+class StackSampler:
+    """
+    Sample the stack of the main thread at a fixed interval from a background thread and
+    count the collapsed stacks. Time spent in C code holding the GIL is attributed to the
+    Python frame that called it.
+    """
+
+    def __init__(self, interval_ms=SAMPLE_INTERVAL_MS):
+        self.interval = interval_ms / 1000
+        self.counts = Counter()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._ident = threading.main_thread().ident
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            frame = sys._current_frames().get(self._ident)
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+                frame = frame.f_back
+            if stack:
+                self.counts[';'.join(reversed(stack))] += 1
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+
+    def write(self, path):
+        """Write the collapsed stacks ('frame;frame;... count' per line)."""
+        with open(path, 'w') as file:
+            for stack, count in self.counts.most_common():
+                file.write(f"{stack} {count}\n")
+
+
+@contextmanager
+def profiling(prefix, profile=False, trace_memory=False, sample_ms=None):
+    """
+    Profile the enclosed code with the selected modes and write the outputs.
+
+    Parameters:
+        prefix (str): Path prefix of the outputs.
+        profile (bool): cProfile the code.
+        trace_memory (bool): Trace the allocations with tracemalloc.
+        sample_ms (float, optional): Interval of the stack sampling in ms. No sampling if None.
+    """
+    if not (profile or trace_memory or sample_ms):
+        yield
+        return
+    os.makedirs(os.path.dirname(prefix), exist_ok=True)
+    outputs = []
+    if trace_memory:
+        tracemalloc.start(TRACE_FRAMES)
+        instrumentation.set_snapshot_prefix(prefix)
+    sampler = StackSampler(sample_ms) if sample_ms else None
+    if sampler:
+        sampler.start()
+    profiler = cProfile.Profile() if profile else None
+    if profiler:
+        profiler.enable()
+    try:
+        yield
+    finally:
+        #stop all modes before writing any output
+        if profiler:
+            profiler.disable()
+        if sampler:
+            sampler.stop()
+        if trace_memory:
+            snapshot = tracemalloc.take_snapshot()
+            current, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+            instrumentation.set_snapshot_prefix(None)
+
+        if profiler:
+            profiler.dump_stats(prefix + '.prof')
+            with open(prefix + '_profile.txt', 'w') as file:
+                pstats.Stats(profiler, stream=file).sort_stats('cumulative').print_stats(40)
+            outputs += [prefix + '.prof', prefix + '_profile.txt']
+        if sampler:
+            sampler.write(prefix + '.folded')
+            outputs.append(prefix + '.folded')
+        if trace_memory:
+            with open(prefix + '_memory.txt', 'w') as file:
+                file.write(f"traced memory: {current / 2**20:.1f} MB, peak {peak / 2**20:.1f} MB\n\n")
+                for stat in snapshot.statistics('lineno')[:40]:
+                    file.write(f"{stat}\n")
+            outputs.append(prefix + '_memory.txt')
+        print("Profiling outputs: " + ', '.join(outputs))
+
+
+def parse_args(arguments, description=None, argv=None):
+    """
+    Parse the command line of a script.
+
+    Parameters:
+        arguments (list of tuple): (name, type, default, help) of the arguments, in the
+            order in which they can be given positionally. Arguments with the default
+            REQUIRED must be given.
+        description (str, optional): Description of the script.
+        argv (list of str, optional): Command line. Default: sys.argv[1:].
+
+    Returns:
+        kwargs (dict): Values of the arguments by name.
+        options (argparse.Namespace): Profiling options (profile, trace_memory, sample, profile_dir)
+            and storage profile (storage).
+    """
+    parser = argparse.ArgumentParser(description=description)
+    for name, type_, default, help_ in arguments:
+        flag = '--' + name.replace('_', '-')
+        parser.add_argument(name, type=type_, nargs='?', default=None,
+                            help=f"{help_} (or {flag}; default: {'required' if default is REQUIRED else default})")
+        parser.add_argument(flag, type=type_, dest=name + '_opt', default=None, help=argparse.SUPPRESS)
+    modes = os.environ.get(PROFILE_ENV, '').split(',')
+    parser.add_argument('--profile', action='store_true', default='profile' in modes,
+                        help="cProfile the run.")
+    parser.add_argument('--trace-memory', action='store_true', default='trace-memory' in modes,
+                        help="Trace the allocations with tracemalloc.")
+    parser.add_argument('--sample', type=float, nargs='?', const=SAMPLE_INTERVAL_MS,
+                        default=SAMPLE_INTERVAL_MS if 'sample' in modes else None, metavar='MS',
+                        help=f"Sample the stack every MS milliseconds (default {SAMPLE_INTERVAL_MS}).")
+    parser.add_argument('--profile-dir', default=PROFILE_DIR, help="Directory of the profiling outputs.")
+    parser.add_argument('--storage', type=storage_profile, default=None, metavar='PROFILE',
+                        help="Storage profile of the hazard outputs, e.g. float32+zstd (see hazard_storage.py; "
+                             f"default: {hazard_storage.STORAGE_ENV} or float64).")
+    args = parser.parse_args(argv)
+
+    kwargs = {}
+    for name, _, default, _ in arguments:
+        value = getattr(args, name + '_opt')
+        if value is None:
+            value = getattr(args, name)
+        if value is None:
+            if default is REQUIRED:
+                parser.error(f"the argument {name} (or --{name.replace('_', '-')}) is required")
+            value = default
+        kwargs[name] = value
+    return kwargs, args
+
+
+def run(main, stage, arguments=(), description=None, argv=None):
+    """
+    Run the main function of a script with the arguments of its command line, under the
+    profiling modes selected on the command line or in PIPELINE_PROFILE.
+
+    Parameters:
+        main (callable): Function called with the arguments as keywords.
+        stage (str): Name of the stage in the names of the profiling outputs.
+        arguments (list of tuple): (name, type, default, help) of the arguments (see parse_args).
+        description (str, optional): Description of the script.
+        argv (list of str, optional): Command line. Default: sys.argv[1:].
+
+    Returns:
+        The return value of main.
+    """
+    kwargs, options = parse_args(arguments, description=description, argv=argv)
+    if options.storage:
+        os.environ[hazard_storage.STORAGE_ENV] = options.storage  # inherited by the worker processes
+    prefix = os.path.join(options.profile_dir, f"{stage}_{run_id()}_{socket.gethostname()}_{os.getpid()}")
+    with profiling(prefix, profile=options.profile, trace_memory=options.trace_memory,
+                   sample_ms=options.sample):
+        return main(**kwargs)
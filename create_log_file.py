@@ -1,4 +1,10 @@
+import os
+
+from instrumentation import log_event
+
+
 def log_msg(msg, filename):
-    with open(filename, 'a') as file:
-        file.write(msg)
+    """Print a progress message and record it in the event log (see instrumentation),
+    with the name of the former progress file as stage."""
+    log_event(os.path.splitext(os.path.basename(filename))[0], msg=msg.strip())
     print(msg)
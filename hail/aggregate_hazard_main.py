@@ -5,6 +5,7 @@ Main script to aggregate hazard to new grid
 @author: Raphael Portmann
 
 """
+import os
 import numpy as np
 import sys
 from climada import CONFIG
@@ -12,97 +13,109 @@ from climada.util.save import save,load
 
 #from climada.hazard import Hazard
 sys.path.append(str(CONFIG.local_data.func_dir))
-from utility import hazard_from_radar,aggregate_hazard
+from utility import hazard_from_radar,aggregate_hazard_pyramid
 import time
 import pandas as pd
-#%%
-hazard_filedir = f"{CONFIG.local_data.data_dir}/hazard/radar/v5/"
 
-#%%
+# Add parent directory to sys.path to access the command line and instrumentation
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+from instrumentation import timed
+import cli
+from output_manifest import write_atomic
 
-""" AGGREGATE HAZARD DATA MESHS"""
+#dmgdates
+DATES=['2017-06-27','2017-07-08','2017-08-01','2019-06-15','30-06-2019','2019-07-01','2021-06-20','2021-06-21','2021-06-28','2021-07-12','2021-07-13','2021-07-24']
 
-#read hazard data MESHS
 
-# set directory
-MESHS_dir = hazard_filedir+'MZC/'
+@timed('hail_aggregate')
+def main(kms=None, aggfunc='max'):
+    """
+    Aggregate the radar hazards MESHS and POH to regular grids.
 
-#define start and endyear
-startyear = 2017
-endyear = 2021
+    Parameters:
+        kms (list of int): Cell sizes of the aggregations in km. Default: 1 to 32 km.
+        aggfunc (str): Aggregation function, e.g. 'max'.
+    """
+    #define aggregations (in km)
+    if kms is None:
+        kms=[1,2,4,8,16,32]
 
-#define aggregations (in km)
-kms=[1,2,4,8,16,32]
+    hazard_filedir = f"{CONFIG.local_data.data_dir}/hazard/radar/v5/"
 
-#define aggfunc
-aggfunc='max'
+    #%%
 
-#dmgdates
-dates=['2017-06-27','2017-07-08','2017-08-01','2019-06-15','30-06-2019','2019-07-01','2021-06-20','2021-06-21','2021-06-28','2021-07-12','2021-07-13','2021-07-24']
-
-#create list of files
-filenames_MESH = [MESHS_dir+'MZC_X1d66_'+str(yyyy)+'.nc' for yyyy in np.arange(startyear,endyear+1,1)]
-
-#read data
-MESHS_rad, MESHS_xarray = hazard_from_radar(filenames_MESH,varname='MESHS',time_dim = 'time',spatial_dims = ['chy','chx'],country_code=None,month=None,get_xarray=True) # extent=[5.5,10.5,45.5,48])
-outfile = f'{MESHS_dir}MZC_2002_2021_1km.p'
-#save(outfile, MESHS_rad)
-# Aggregate data
-for km in kms:
-    gridsize = km*1000
-    MESHS_agg,MESHS_agg_xr=aggregate_hazard(MESHS_rad, original_grid_epsg = 2056,
+    """ AGGREGATE HAZARD DATA MESHS"""
+
+    #read hazard data MESHS
+
+    # set directory
+    MESHS_dir = hazard_filedir+'MZC/'
+
+    #define start and endyear
+    startyear = 2017
+    endyear = 2021
+
+    #create list of files
+    filenames_MESH = [MESHS_dir+'MZC_X1d66_'+str(yyyy)+'.nc' for yyyy in np.arange(startyear,endyear+1,1)]
+
+    #read data
+    MESHS_rad, MESHS_xarray = hazard_from_radar(filenames_MESH,varname='MESHS',time_dim = 'time',spatial_dims = ['chy','chx'],country_code=None,month=None,get_xarray=True,chunk_size='auto') # extent=[5.5,10.5,45.5,48])
+    outfile = f'{MESHS_dir}MZC_2002_2021_1km.p'
+    #save(outfile, MESHS_rad)
+    # Aggregate data once to the finest grid and derive the coarser grids by block reduction
+    MESHS_pyramid=aggregate_hazard_pyramid(MESHS_rad, cell_sizes = [km*1000 for km in kms],
+                                  original_grid_epsg = 2056,
                                   extent_new = None,
-                                  cell_size_new = gridsize,
                                   projection_new_epsg = 4326,
                                   aggfunc = aggfunc,
-                                  treat_zeros_as_nans = True,
                                   return_xr=True,
-                                  dates_xr=[pd.Timestamp(d).toordinal() for d in dates])
-    outfile = f'{MESHS_dir}MZC_2002_2021_{aggfunc}_{km}km.p'
-    # save output
-    save(outfile, MESHS_agg)
-    outfile_xr = f'{MESHS_dir}MZC_12_events_2017_2021_{aggfunc}_{km}km.nc'
-    MESHS_agg_xr=MESHS_agg_xr.rename({'intensity': 'MZC'})
-    MESHS_agg_xr.to_netcdf(outfile_xr)
-
-#%%
-""" AGGREGATE HAZARD DATA POH """
-
-""" read hazard data"""
-# set directory
-POH_dir = hazard_filedir+'BZC/'
-
-#define start and endyear
-startyear = 2002
-endyear = 2021
-
-#define aggregations (in km)
-kms=[1,2,4,8,16,32]
-
-#define aggfunc
-aggfunc='max'
-
-#create list of files
-filenames = [POH_dir+'BZC_X1d66_'+str(yyyy)+'.nc' for yyyy in np.arange(startyear,endyear+1,1)]
-
-POH_rad, POH_xarray = hazard_from_radar(filenames,varname='POH',time_dim = 'time',spatial_dims = ['chy','chx'],country_code=None,month=None,get_xarray=True) # extent=[5.5,10.5,45.5,48])
-outfile = f'{POH_dir}BZC_2002_2021_1km.p'
-save(outfile, POH_rad)
-# Aggregate
-for km in kms:
-    gridsize = km*1000
-    POH_agg,POH_agg_xr=aggregate_hazard(POH_rad, original_grid_epsg = 2056,
+                                  dates_xr=[pd.Timestamp(d).toordinal() for d in DATES])
+    for km in kms:
+        MESHS_agg,MESHS_agg_xr=MESHS_pyramid[km*1000]
+        outfile = f'{MESHS_dir}MZC_2002_2021_{aggfunc}_{km}km.p'
+        # save output
+        write_atomic(outfile, lambda tmp_path: save(tmp_path, MESHS_agg))
+        outfile_xr = f'{MESHS_dir}MZC_12_events_2017_2021_{aggfunc}_{km}km.nc'
+        MESHS_agg_xr=MESHS_agg_xr.rename({'intensity': 'MZC'})
+        write_atomic(outfile_xr, MESHS_agg_xr.to_netcdf)
+
+    #%%
+    """ AGGREGATE HAZARD DATA POH """
+
+    """ read hazard data"""
+    # set directory
+    POH_dir = hazard_filedir+'BZC/'
+
+    #define start and endyear
+    startyear = 2002
+    endyear = 2021
+
+    #create list of files
+    filenames = [POH_dir+'BZC_X1d66_'+str(yyyy)+'.nc' for yyyy in np.arange(startyear,endyear+1,1)]
+
+    POH_rad, POH_xarray = hazard_from_radar(filenames,varname='POH',time_dim = 'time',spatial_dims = ['chy','chx'],country_code=None,month=None,get_xarray=True,chunk_size='auto') # extent=[5.5,10.5,45.5,48])
+    outfile = f'{POH_dir}BZC_2002_2021_1km.p'
+    write_atomic(outfile, lambda tmp_path: save(tmp_path, POH_rad))
+    # Aggregate once to the finest grid and derive the coarser grids by block reduction
+    POH_pyramid=aggregate_hazard_pyramid(POH_rad, cell_sizes = [km*1000 for km in kms],
+                                  original_grid_epsg = 2056,
                                   extent_new = None,
-                                  cell_size_new = gridsize,
                                   projection_new_epsg = 4326,
                                   aggfunc = aggfunc,
-                                  treat_zeros_as_nans = True,
                                   return_xr=True,
-                                  dates_xr=[pd.Timestamp(d).toordinal() for d in dates])
-    outfile = f'{POH_dir}BZC_2002_2021_{aggfunc}_{km}km.p'
-    # save output
-    save(outfile, POH_agg)
-    outfile_xr = f'{POH_dir}BZC_12_events_2017_2021_{aggfunc}_{km}km.nc'
-    POH_agg_xr=POH_agg_xr.rename({'intensity': 'BZC'})
-    POH_agg_xr.to_netcdf(outfile_xr)
-
+                                  dates_xr=[pd.Timestamp(d).toordinal() for d in DATES])
+    for km in kms:
+        POH_agg,POH_agg_xr=POH_pyramid[km*1000]
+        outfile = f'{POH_dir}BZC_2002_2021_{aggfunc}_{km}km.p'
+        # save output
+        write_atomic(outfile, lambda tmp_path: save(tmp_path, POH_agg))
+        outfile_xr = f'{POH_dir}BZC_12_events_2017_2021_{aggfunc}_{km}km.nc'
+        POH_agg_xr=POH_agg_xr.rename({'intensity': 'BZC'})
+        write_atomic(outfile_xr, POH_agg_xr.to_netcdf)
+
+
+if __name__ == "__main__":
+    cli.run(main, 'hail_aggregate', [
+        ('kms', cli.int_list, None, "Cell sizes of the aggregations in km, e.g. 1,2,4"),
+        ('aggfunc', str, 'max', "Aggregation function"),
+    ], description="Aggregate the radar hail hazards MESHS and POH to regular grids.")
@@ -25,11 +25,12 @@ import xarray as xr
 from climada.entity import Exposures
 from climada.hazard import Hazard, Centroids
 from climada.engine import Impact
+import climada.util.dates_times as u_dt
 
 import shapely.geometry as sg
 
 import geopandas as gpd
-from pyproj import CRS
+from pyproj import CRS, Transformer
 from scipy import sparse
 import copy
 import warnings
@@ -45,6 +46,9 @@ en_names={'Weizen_Mais_Gerste_Raps': 'field crops',
           'Gerste':'barley',
           'Reben': 'grapevine'}
 
+#bounds of the LV95 grid (xmin, ymin, xmax, ymax)
+LV95_BOUNDS = (2255000, 840000, 2964000, 1479000)
+
 #data directory
 data_dir='C:/Users/F80840370/projects/scClim/climada/scClim/subproj_D/papers/NHESS/code_and_data/data/'
 
@@ -53,7 +57,7 @@ data_dir='C:/Users/F80840370/projects/scClim/climada/scClim/subproj_D/papers/NHE
 def hazard_from_radar(files, varname='MESHS', time_dim='time', forecast_init=None,
                       ensemble_dim=None, spatial_dims = None, country_code=None,
                       extent=None, subdaily = False, month=None, ignore_date=False,
-                      n_year_input=None, get_xarray=False):
+                      n_year_input=None, get_xarray=False, chunk_size=None):
     """Create a new Hail hazard from MeteoCH radar data
     or COSMO HAILCAST ouput (single- or multi-member)
 
@@ -80,6 +84,11 @@ def hazard_from_radar(files, varname='MESHS', time_dim='time', forecast_init=Non
         If True: ignores netcdf dates (e.g. for synthetic data).
     n_year_input : int
         Number of years: will only be used if ignore_date=True
+    chunk_size : int or 'auto'
+        If given, the intensity is read lazily in chunks of chunk_size time steps
+        (or along the dask chunks of the time dimension for 'auto') and each chunk
+        is converted to a sparse matrix right away, such that the dense data is
+        never loaded at once. Not used with ensemble_dim. default: None
     Returns
     -------
     haz : Hazard object
@@ -213,9 +222,20 @@ def hazard_from_radar(files, varname='MESHS', time_dim='time', forecast_init=Non
         event_dim = 'time_ensemble'
     else:
         event_dim = time_dim
-    coord_vars = dict(event=event_dim,longitude='lon',latitude='lat')
-    haz = Hazard.from_xarray_raster(netcdf,'HL',unit,intensity=varname_xr,
-                                    coordinate_vars=coord_vars)
+    if chunk_size is not None and not ensemble_dim:
+        intensity, date = sparse_from_radar_chunks(netcdf[varname_xr], time_dim=time_dim,
+                                                   spatial_dims=spatial_dims,
+                                                   chunk_size=chunk_size)
+        lat, lon = xr.broadcast(netcdf['lat'], netcdf['lon'])
+        centroids = Centroids(lat=lat.transpose(*spatial_dims).values.ravel(),
+                              lon=lon.transpose(*spatial_dims).values.ravel())
+        haz = Hazard('HL', units=unit, centroids=centroids, event_id=event_id,
+                     date=date, intensity=intensity,
+                     fraction=sparse.csr_matrix(intensity.shape))
+    else:
+        coord_vars = dict(event=event_dim,longitude='lon',latitude='lat')
+        haz = Hazard.from_xarray_raster(netcdf,'HL',unit,intensity=varname_xr,
+                                        coordinate_vars=coord_vars)
     #set correct event_name, frequency, date
     haz.event_name = event_name
     haz.frequency = np.ones(n_ev)/n_years
@@ -232,55 +252,98 @@ def hazard_from_radar(files, varname='MESHS', time_dim='time', forecast_init=Non
     else:
         return haz
 
-#%% Regridding
-def add_zero_values(merged):
-    """ Add for each grid cell of output grid, specified by 'index_right'
-    in merged, rows with intensity zero such that the total number
-    values for the aggregation is equal to n=gridsize_output**2/gridsize_input**2
+def sparse_from_radar_chunks(data, time_dim='time', spatial_dims=None, chunk_size='auto'):
+    """Read a (lazy) radar DataArray chunk by chunk along time into a sparse matrix
 
+    Each chunk is computed, converted to a sparse matrix and released before the
+    next one is read, such that the peak memory scales with one chunk only.
 
     Parameters
     ----------
-    merged : geopandas.GeoDataframe
-        merged dataframe of input data and output grid, with m values per grid cell
+    data : xarray.DataArray
+        Radar data with dimensions time_dim and spatial_dims (e.g. from
+        xr.open_mfdataset, with thresholds applied lazily)
+    time_dim : str
+        Name of time dimension, default: 'time'
+    spatial_dims : list of str
+        Names of spatial dimensions, default: ['chy','chx']
+    chunk_size : int or 'auto'
+        Number of time steps per chunk. With 'auto', the dask chunks of the
+        time dimension are used (e.g. one chunk per yearly file). default: 'auto'
 
     Returns
     -------
-    new_merged : geopandas.GEoDataframe
-        merged datafarame with n-m zero values added for each grid cell
+    intensity : scipy.sparse.csr_matrix
+        Sparse matrix of shape (n_time, n_centroids), NaNs are set to zero
+    date : np.array
+        Ordinal dates of the time steps
     """
-    dates = []
-    indices_right = []
-    x = []
-    y = []
-    intensity = []
+    if spatial_dims is None: spatial_dims = ['chy','chx']
+    data = data.transpose(time_dim, *spatial_dims)
 
-    nmax=np.nanmax(merged.groupby(['date','index_right']).size())
-    print(nmax)
-    for (date, index), count in merged.groupby(['date','index_right']).size().loc[merged.groupby(['date','index_right']).size()<16].iteritems():
+    #time steps at which a new chunk starts
+    n_time = data[time_dim].size
+    if chunk_size == 'auto':
+        if data.chunks is None:
+            chunk_sizes = [n_time]
+        else:
+            chunk_sizes = data.chunksizes[time_dim]
+    else:
+        chunk_sizes = [int(chunk_size)] * int(np.ceil(n_time / int(chunk_size)))
+    chunk_starts = np.cumsum([0] + list(chunk_sizes))[:-1]
 
-        dates = dates + list(np.ones(nmax-count)*date)
-        indices_right = indices_right + list(np.ones(nmax-count)*index)
-        intensity = intensity + list(np.zeros(nmax-count))
+    intensities = []
+    dates = []
+    for start, size in zip(chunk_starts, chunk_sizes):
+        chunk = data.isel({time_dim: slice(start, start+size)})
+        values = np.nan_to_num(chunk.values.reshape(chunk[time_dim].size, -1), nan=0)
+        intensities.append(sparse.csr_matrix(values))
+        dates.append(date_ordinals(chunk[time_dim]))
+        del values
 
-        #geometry
-        geometry = merged.loc[merged['index_right'] == index]['geometry']
-        x = x + list(np.ones(nmax-count)*geometry.x.values[0])
-        y = y + list(np.ones(nmax-count)*geometry.y.values[0])
+    intensity = sparse.vstack(intensities, format='csr')
+    date = np.concatenate(dates).astype(int)
+    return intensity, date
 
-    gdf=gpd.GeoDataFrame({'intensity': intensity,
-                        'date': dates, 'index_right': indices_right},
-                        geometry = gpd.points_from_xy(x,y), crs=merged.crs)
+def date_ordinals(time):
+    """Ordinal dates of a time coordinate, as read by Hazard.from_xarray_raster
 
-    new_merged = pd.concat([merged, gdf])
+    Integer values are taken as ordinals, datetimes are converted. Values that
+    are neither (e.g. event indices or strings) give a warning and dates of one.
 
-    return new_merged
+    Parameters
+    ----------
+    time : xarray.DataArray
+        Time coordinate
+
+    Returns
+    -------
+    date : np.array
+        Ordinal dates
+    """
+    try:
+        if np.issubdtype(time.dtype, np.integer):
+            if (time.values <= 0).any():
+                raise ValueError('ordinal dates must be positive')
+            return time.values.astype(int)
+        return np.array(u_dt.datetime64_to_ordinal(time.values))
+    except (ValueError, TypeError, AttributeError):
+        warnings.warn(f"Failed to read values of '{time.name}' as dates or ordinals. "
+                      "Hazard.date will be ones only")
+        return np.ones(time.size, int)
 
+#%% Regridding
 def aggregate_hazard(hazard_in, original_grid_epsg = 2056, extent_new = None, cell_size_new = 2000,
                      projection_new_epsg = 4326, aggfunc = 'max', treat_zeros_as_nans = True,
                      return_xr=False,dates_xr=None):
     """Aggregating a hazard object to a coarser grid
 
+    The grid cell of each hazard centroid is computed arithmetically from the
+    regular output grid (see cell_index_from_coords) and the nonzero intensities
+    are reduced per (event, cell) with aggregate_sparse, so that no spatial join
+    and no loop over events is needed. If zero values are included in the
+    aggregation, they are accounted for analytically from the number of hazard
+    centroids in each output grid cell instead of adding rows with zero intensity.
 
     Parameters
     ----------
@@ -296,20 +359,25 @@ def aggregate_hazard(hazard_in, original_grid_epsg = 2056, extent_new = None, ce
     projection_new_epsg : int, optional
         projection of the centroid coordinates of the new hazard. The default is 4326.
     aggfunc : str, optional
-        Function to be used for aggregation. The default is 'mean'.
+        Function to be used for aggregation. 'max', 'min', 'sum', 'mean' and 'count'
+        are computed with NumPy, any other pandas aggregation name is passed to
+        pandas.Series.groupby().agg. The default is 'max'.
     treat_zeros_as_nans : boolean, optional
         If True, treat zero values as nans and neglect for aggregation
-        If False, treat zero values as zeros and include for aggregation (time consuming).
-        The default is True.
+        If False, treat zero values as zeros and include for aggregation
+        (only 'max', 'min', 'sum', 'mean' and 'count'). The default is True.
     return_xr: boolean, optional
         If True, return the aggregated hazard also as xarray.Dataset
         If False, only return hazard
+    dates_xr : list of int, optional
+        Ordinal dates of the events to be returned as xarray.Dataset.
+        The default is None (all dates of hazard_in).
 
     Raises
     ------
     ValueError
-        If aggregation function is 'max' and treat_zeros_as_nans is False,
-        an error is raised to avoid unnecessary time consuming computation.
+        If treat_zeros_as_nans is False and aggfunc is not one of
+        'max', 'min', 'sum', 'mean' or 'count'.
 
     Returns
     -------
@@ -320,104 +388,190 @@ def aggregate_hazard(hazard_in, original_grid_epsg = 2056, extent_new = None, ce
 
 
     original_grid_epsg = int(original_grid_epsg)
-    original_crs = CRS.from_epsg(original_grid_epsg)
     projection_new_epsg = int(projection_new_epsg)
-    proj_new_crs=CRS.from_epsg(projection_new_epsg)
-
-    intensities=[] #list to store new intensity values
-    xr_out_list=[] #list to store xarray; only needed if return_xr=True
-    if dates_xr is None:
-        dates_xr=hazard_in.date
 
-    if aggfunc == 'max' and treat_zeros_as_nans == False:
-        raise ValueError('Set treat_zeros_as_nans for aggfunc = "max" to avoid uneccesary slow down of the code')
-
-    if treat_zeros_as_nans == False:
-        warnings.warn('treat_zeros_as_nans = False is currently very slow.')
+    if hazard_in.event_id.shape != hazard_in.date.shape:
+        sys.exit("Number of events and dates in hazard are not equal. Abort hazard aggregation.")
 
     # create empty output grid
     print(f'create empty grid with extent {extent_new}, cell size: {cell_size_new}')
     cell, crs, extent = create_empty_grid(epsg = original_grid_epsg,
                                              cell_size = cell_size_new, extent = extent_new)
+    bounds = grid_bounds(epsg = original_grid_epsg, extent = extent_new)
 
-    # create a geodataframe with all nonzero values of the hazard intensity over all dates
-    # project grid back to original data if not the same
-    gdf = gdf_from_hazard(hazard_in)
+    print('Compute output grid cell of each hazard centroid...')
+    cell_index = _hazard_cell_index(hazard_in, original_grid_epsg, cell_size_new, bounds)
 
-    # reproject geometry to original grid if hazard grid and original grid are not of identical projection
-    if hazard_in.centroids.crs.to_epsg() != original_grid_epsg:
-            gdf = gdf.to_crs(crs=original_crs)
+    # number of hazard centroids per output cell to account for zero intensities
+    n_values = None
+    if treat_zeros_as_nans == False:
+        n_values = np.bincount(cell_index[cell_index >= 0], minlength=len(cell))
 
-    print('Merge hazard with output grid...')
-    # merge hazard intensity data with output grid
-    merged = gpd.sjoin(gdf, cell, how='left')
+    print(f'Aggregate hazard intensity in output grid using the following aggregation function: {aggfunc}')
+    intensities_all = aggregate_sparse(hazard_in.intensity, cell_index, len(cell),
+                                       aggfunc=aggfunc, n_values=n_values)
 
-    # if missing values have to be treated as zeros add required columns to the dataframe
-    if treat_zeros_as_nans == False:
-        merged = add_zero_values(merged)
+    return _hazard_on_grid(hazard_in, intensities_all, cell, cell_size_new, bounds,
+                           original_grid_epsg=original_grid_epsg,
+                           projection_new_epsg=projection_new_epsg,
+                           return_xr=return_xr, dates_xr=dates_xr)
 
-    print(f'Dissolve hazard intensity in output grid using the following aggregation function: {aggfunc}')
-    # dissolve orignal intensity data in the new grid using the user specified aggfunc
-    dissolve = merged.dissolve(by=['event_id','index_right'], aggfunc={
-                "intensity": aggfunc})
+def aggregate_hazard_pyramid(hazard_in, cell_sizes=(1000, 2000, 4000, 8000, 16000, 32000),
+                             original_grid_epsg = 2056, extent_new = None,
+                             projection_new_epsg = 4326, aggfunc = 'max',
+                             treat_zeros_as_nans = True, return_xr=False, dates_xr=None):
+    """Aggregating a hazard object to several nested coarser grids in one pass
 
-    # loop over events and create sparse matrix of hazard intensities for the new grid
-    year_now = 0 # counter to catch year changes
-    if hazard_in.event_id.shape != hazard_in.date.shape:
-        sys.exit("Number of events and dates in hazard are not equal. Abort hazard aggregation.")
-    for event, date in zip(hazard_in.event_id, hazard_in.date):
-        # print year first time it appears
-        year = pd.Timestamp.fromordinal(date).year
-        if year > year_now:
-            year_now = year
-            print(f"Aggregating hazard data from {year}.")
-
-        # since gdf is produced from hazard_in it should always contain the event_id
-        # instead, check if event still exists after dissolve (events with zero intensity
-        # in the domain of extent_new are lost through the aggregation)
-        if event in dissolve.index.get_level_values(0):
-
-            #create deep copy of output grid
-            cell_now=cell.copy(deep = True)
-
-            #select the event subset of the dissolved gdf
-            dissolve_now=dissolve.loc[event, :] # multi-index, thus two indices given
-
-            #fill output cell with new intensities
-            cell_now.loc[dissolve_now.index, 'intensity'] = dissolve_now['intensity'].values
-
-            #create intensity sparse matrix
-            cell_now=cell_now.fillna(0)
-            intensities.append(sparse.csr_matrix(cell_now['intensity'].values))
-
-            if return_xr == True:
-
-                if date in dates_xr:
-                    print(pd.Timestamp.fromordinal(date))
-                    #create deep copy of data
-                    cell_xr=cell_now.copy(deep = True)
-                    cell_xr['geometry'] = cell_now.geometry.centroid
-                    cell_xr["chx"] = cell_xr.geometry.x
-                    cell_xr["chy"] = cell_xr.geometry.y
-                    cell_xr = cell_xr.round({'chx': 0, 'chy': 0})
-                    cell_xr['geometry'] = gpd.points_from_xy(cell_xr.chx, cell_xr.chy)
-
-                    #get lat lon values
-                    geometry_latlon=cell_xr['geometry'].to_crs(crs=CRS.from_epsg(int(4326)))
-                    cell_xr["lon"]=geometry_latlon.geometry.x
-                    cell_xr["lat"]=geometry_latlon.geometry.y
-
-                    cell_multiindex = cell_xr.drop(columns='geometry').set_index(['chy','chx'])
-                    cell_xarray=cell_multiindex.to_xarray().set_coords(('chy','chx'))
-                    cell_xarray = cell_xarray.expand_dims(time=[pd.Timestamp.fromordinal(date)])
-                    xr_out_list.append(cell_xarray)
+    The hazard is aggregated once to the finest grid. Each coarser level is then
+    derived from the level below by a block reduction (e.g. 2x2 cells for nested
+    powers of two). Maxima and minima are reduced directly, means are recombined
+    from the block sums and counts of nonzero values. If zero values are included,
+    the number of hazard centroids per cell is summed up along with the blocks.
+
+    Parameters
+    ----------
+    hazard_in : climada.hazard
+        Climada hazard to aggregate to coarser grids
+    cell_sizes : list of float, optional
+        Cell sizes of the new grids (in units of the original CRS). Each cell size must
+        be an integer multiple of the previous one. The default is 1, 2, 4, 8, 16 and 32 km.
+    original_grid_epsg : int, optional
+        EPSG number of the original coordinate reference sytem
+        of the hazard. The default is 2056.
+    extent_new : list of ints, optional if original_grid_epsg is 2056.
+        Extent of the new grids (xmin,ymin,xmax,ymax). The default is None.
+    projection_new_epsg : int, optional
+        projection of the centroid coordinates of the new hazards. The default is 4326.
+    aggfunc : str, optional
+        'max', 'min', 'sum', 'mean' or 'count'. The default is 'max'.
+    treat_zeros_as_nans : boolean, optional
+        If True, treat zero values as nans and neglect for aggregation
+        If False, treat zero values as zeros and include for aggregation.
+        The default is True.
+    return_xr: boolean, optional
+        If True, return the aggregated hazards also as xarray.Dataset
+    dates_xr : list of int, optional
+        Ordinal dates of the events to be returned as xarray.Dataset.
+        The default is None (all dates of hazard_in).
+
+    Raises
+    ------
+    ValueError
+        If aggfunc can not be recombined from block reductions or the
+        cell sizes are not nested.
+
+    Returns
+    -------
+    pyramid : dict
+        Dictionary with the cell sizes as keys and the tuples (hazard_out, xr_out)
+        of aggregate_hazard as values
+    """
+    if aggfunc not in ['max', 'min', 'sum', 'mean', 'count']:
+        raise ValueError(f'aggfunc "{aggfunc}" can not be recombined from block reductions')
+    cell_sizes = sorted(cell_sizes)
+    for cell_size, cell_size_coarse in zip(cell_sizes[:-1], cell_sizes[1:]):
+        if cell_size_coarse % cell_size != 0:
+            raise ValueError(f'Cell size {cell_size_coarse} is not a multiple of {cell_size}')
+
+    original_grid_epsg = int(original_grid_epsg)
+    projection_new_epsg = int(projection_new_epsg)
+    bounds = grid_bounds(epsg = original_grid_epsg, extent = extent_new)
+
+    # aggregate to finest level; means are carried as sums and counts of nonzero values
+    print(f'Aggregate hazard intensity to finest grid with cell size {cell_sizes[0]}')
+    cell_index = _hazard_cell_index(hazard_in, original_grid_epsg, cell_sizes[0], bounds)
+    n_cells = np.prod(grid_shape(cell_sizes[0], bounds))
+    n_values = np.bincount(cell_index[cell_index >= 0], minlength=n_cells)
+    keys = ['sum', 'count'] if aggfunc == 'mean' else [aggfunc]
+    if treat_zeros_as_nans == False and 'count' not in keys:
+        keys.append('count')
+    levels = {key: aggregate_sparse(hazard_in.intensity, cell_index, n_cells, key)
+              for key in keys}
+
+    pyramid = {}
+    for i_level, cell_size in enumerate(cell_sizes):
+        if i_level > 0:
+            # block reduction of the level below
+            print(f'Reduce grid with cell size {cell_sizes[i_level-1]} to cell size {cell_size}')
+            cell_index = coarsen_cell_index(cell_sizes[i_level-1], cell_size, bounds)
+            n_cells = np.prod(grid_shape(cell_size, bounds))
+            inside = cell_index >= 0
+            n_values = np.bincount(cell_index[inside], weights=n_values[inside],
+                                   minlength=n_cells)
+            levels = {key: aggregate_sparse(matrix, cell_index, n_cells,
+                                            'sum' if key == 'count' else key)
+                      for key, matrix in levels.items()}
+
+        if aggfunc == 'mean':
+            intensity = levels['sum'].multiply(levels['count'].power(-1)).tocsr()
         else:
-            intensities.append(sparse.csr_matrix(np.zeros(len(cell))))
+            intensity = levels[aggfunc]
+
+        if treat_zeros_as_nans == False:
+            # include the zeros of the cells where not all values are nonzero
+            counts = levels['count'].tocoo()
+            agg = np.asarray(intensity[counts.row, counts.col]).ravel()
+            agg = _with_implicit_zeros(agg, counts.data, n_values[counts.col], aggfunc)
+            intensity = sparse.csr_matrix((agg, (counts.row, counts.col)), shape=intensity.shape)
+            intensity.eliminate_zeros()
+
+        cell, _, _ = create_empty_grid(epsg = original_grid_epsg,
+                                       cell_size = cell_size, extent = extent_new)
+        pyramid[cell_size] = _hazard_on_grid(hazard_in, intensity, cell, cell_size, bounds,
+                                             original_grid_epsg=original_grid_epsg,
+                                             projection_new_epsg=projection_new_epsg,
+                                             return_xr=return_xr, dates_xr=dates_xr)
+    return pyramid
+
+def _hazard_cell_index(hazard_in, original_grid_epsg, cell_size, bounds):
+    """Index of the output grid cell of each hazard centroid (see cell_index_from_coords)"""
+    # project the hazard centroids (not every nonzero value) to the original grid
+    # if hazard grid and original grid are not of identical projection
+    x, y = hazard_in.centroids.lon, hazard_in.centroids.lat
+    if hazard_in.centroids.crs.to_epsg() != original_grid_epsg:
+        transformer = Transformer.from_crs(hazard_in.centroids.crs,
+                                           CRS.from_epsg(original_grid_epsg), always_xy=True)
+        x, y = transformer.transform(x, y)
+    return cell_index_from_coords(x, y, cell_size, bounds)
 
-    #stack sparse matrices together
-    intensities_all = sparse.vstack(intensities)
+def _hazard_on_grid(hazard_in, intensity, cell, cell_size, bounds, original_grid_epsg=2056,
+                    projection_new_epsg=4326, return_xr=False, dates_xr=None):
+    """Create the aggregated hazard (and optionally xarray) from an intensity matrix on a grid
+
+    Parameters
+    ----------
+    hazard_in : climada.hazard
+        Climada hazard that was aggregated
+    intensity : scipy.sparse.csr_matrix
+        Aggregated intensity of shape (n_events, n_cells)
+    cell : geopandas.GeoDataFrame
+        Output grid from create_empty_grid
+    cell_size : float or int
+        Size of the grid cells
+    bounds : tuple
+        Bounds of the grid (xmin, ymin, xmax, ymax) as used in create_empty_grid
+    original_grid_epsg : int, optional
+        EPSG number of the grid. The default is 2056.
+    projection_new_epsg : int, optional
+        projection of the centroid coordinates of the new hazard. The default is 4326.
+    return_xr: boolean, optional
+        If True, return the aggregated hazard also as xarray.Dataset
+    dates_xr : list of int, optional
+        Ordinal dates of the events to be returned as xarray.Dataset.
+
+    Returns
+    -------
+    hazard_out : climada.hazard
+        Climada hazard on the grid
+    xr_out : xarray.Dataset or None
+        Selected events on the grid if return_xr is True
+    """
+    proj_new_crs=CRS.from_epsg(projection_new_epsg)
+    if dates_xr is None:
+        dates_xr=hazard_in.date
 
     #compute hazard centroids
+    cell = cell.copy()
     cell.geometry = cell.geometry.centroid
 
     # if projection of the new centroids is not the same as coordinate reference
@@ -432,20 +586,238 @@ def aggregate_hazard(hazard_in, original_grid_epsg = 2056, extent_new = None, ce
     # get new hazard with aggregated intensity and new centroids
     hazard_out = copy.deepcopy(hazard_in)
     hazard_out.centroids = centroids
-    hazard_out.intensity = intensities_all
+    hazard_out.intensity = intensity
 
     # adjust shape of hazard.fraction (to make hazard.check() pass) in case it contains no data
     if hazard_in.fraction.data.shape[0] == 0:
-        hazard_out.fraction = sparse.csr_matrix(np.zeros(hazard_out.intensity.shape))
+        hazard_out.fraction = sparse.csr_matrix(hazard_out.intensity.shape)
     else:
         print("Shape of aggregated hazard's intensity and fraction disagree. Hazard.check() will fail.")
 
     if return_xr==True:
-        xr_out = xr.concat(xr_out_list, dim = 'time')
+        # events with zero intensity in the domain of extent_new are not exported
+        sel_ev = np.isin(hazard_in.date, dates_xr) & (intensity.getnnz(axis=1) > 0)
+        xr_out = xarray_from_grid(intensity[sel_ev], hazard_in.date[sel_ev], cell_size, bounds,
+                                  epsg=original_grid_epsg)
     else:
         xr_out = None
     return hazard_out, xr_out
 
+def xarray_from_grid(intensity, dates, cell_size, bounds, epsg=2056, name='intensity'):
+    """Convert a sparse (event x cell) matrix on the grid of create_empty_grid to xarray
+
+    The chy/chx and lat/lon coordinates of the grid cell centers are computed once
+    and the sparse entries are written directly into a (time, chy, chx) array.
+
+    Parameters
+    ----------
+    intensity : scipy.sparse matrix
+        Matrix of shape (n_events, n_cells) with the cell order of create_empty_grid
+    dates : np.array
+        Ordinal dates of the events
+    cell_size : float or int
+        Size of the grid cells
+    bounds : tuple
+        Bounds of the grid (xmin, ymin, xmax, ymax) as used in create_empty_grid
+    epsg : int, optional
+        EPSG number of the grid. The default is 2056.
+    name : str, optional
+        Name of the data variable. The default is 'intensity'.
+
+    Returns
+    -------
+    ds : xarray.Dataset
+        Dataset with the variable name of dimensions (time, chy, chx) and
+        the 2D coordinates lat and lon (EPSG 4326) of the cell centers
+    """
+    xmin, ymin, _, _ = bounds
+    n_x, n_y = grid_shape(cell_size, bounds)
+
+    #coordinates of the cell centers
+    chx = np.round(xmin + (np.arange(n_x) + 0.5) * cell_size)
+    chy = np.round(ymin + (np.arange(n_y) + 0.5) * cell_size)
+    chx_2d, chy_2d = np.meshgrid(chx, chy)
+    transformer = Transformer.from_crs(CRS.from_epsg(int(epsg)), CRS.from_epsg(4326),
+                                       always_xy=True)
+    lon, lat = transformer.transform(chx_2d, chy_2d)
+
+    #fill preallocated array with the nonzero values (cell index = i_x * n_y + i_y)
+    intensity = sparse.coo_matrix(intensity)
+    values = np.zeros((intensity.shape[0], n_y, n_x))
+    i_x, i_y = np.divmod(intensity.col, n_y)
+    values[intensity.row, i_y, i_x] = intensity.data
+
+    time = pd.DatetimeIndex([pd.Timestamp.fromordinal(int(date)) for date in dates])
+    return xr.Dataset({name: (('time', 'chy', 'chx'), values)},
+                      coords={'time': time, 'chy': chy, 'chx': chx,
+                              'lat': (('chy', 'chx'), lat), 'lon': (('chy', 'chx'), lon)})
+
+def aggregate_sparse(matrix, cell_index, n_cells, aggfunc='max', n_values=None):
+    """Aggregate the columns of a sparse (event x centroid) matrix onto grid cells
+
+    Only the nonzero entries are aggregated (zeros are treated as nans), unless
+    the number of values per cell n_values is given. The values are reduced per
+    (event, cell) key with a single sort and numpy.ufunc.reduceat, and the output
+    matrix is built directly in CSR format.
+
+    Parameters
+    ----------
+    matrix : scipy.sparse matrix
+        Sparse matrix of shape (n_events, n_centroids), e.g. hazard.intensity
+    cell_index : np.array
+        Index of the output grid cell of each centroid (column of matrix),
+        negative for centroids outside of the output grid
+    n_cells : int
+        Number of cells of the output grid
+    aggfunc : str, optional
+        'max', 'min', 'sum', 'mean', 'count' or any other pandas aggregation name.
+        The default is 'max'.
+    n_values : np.array, optional
+        Number of values (centroids) of each output grid cell. If given, the
+        zero values are included in the aggregation (see _with_implicit_zeros).
+        The default is None.
+
+    Returns
+    -------
+    matrix_out : scipy.sparse.csr_matrix
+        Aggregated matrix of shape (n_events, n_cells)
+    """
+    matrix = sparse.coo_matrix(matrix)
+    cell_index = np.asarray(cell_index, dtype=np.int64)
+    n_rows = matrix.shape[0]
+
+    # keep nonzero values inside the output grid
+    cells = cell_index[matrix.col]
+    keep = (matrix.data != 0) & (cells >= 0)
+    if not keep.any():
+        return sparse.csr_matrix((n_rows, n_cells))
+
+    # one integer key per (event, cell) pair, sorted such that groups are contiguous
+    keys = matrix.row[keep].astype(np.int64) * n_cells + cells[keep]
+    values = matrix.data[keep]
+    order = np.argsort(keys, kind='stable')
+    keys = keys[order]
+    values = values[order]
+    unique_keys, starts, counts = np.unique(keys, return_index=True, return_counts=True)
+
+    if aggfunc == 'max':
+        agg = np.maximum.reduceat(values, starts)
+    elif aggfunc == 'min':
+        agg = np.minimum.reduceat(values, starts)
+    elif aggfunc == 'sum':
+        agg = np.add.reduceat(values, starts)
+    elif aggfunc == 'mean':
+        agg = np.add.reduceat(values, starts) / counts
+    elif aggfunc == 'count':
+        agg = counts.astype(float)
+    else:
+        agg = pd.Series(values).groupby(keys, sort=True).agg(aggfunc).to_numpy(dtype=float)
+
+    if n_values is not None:
+        agg = _with_implicit_zeros(agg, counts, np.asarray(n_values)[unique_keys % n_cells],
+                                   aggfunc)
+
+    matrix_out = sparse.csr_matrix((agg, (unique_keys // n_cells, unique_keys % n_cells)),
+                                   shape=(n_rows, n_cells))
+    matrix_out.eliminate_zeros()
+    return matrix_out
+
+def _with_implicit_zeros(agg, counts, n_values, aggfunc):
+    """Include the zero values, which are not stored in a sparse matrix, in aggregated values
+
+    Parameters
+    ----------
+    agg : np.array
+        Values aggregated over the nonzero values of each group
+    counts : np.array
+        Number of nonzero values of each group
+    n_values : np.array
+        Total number of values (including zeros) of each group
+    aggfunc : str
+        'max', 'min', 'sum', 'mean' or 'count'
+
+    Returns
+    -------
+    agg : np.array
+        Values aggregated over all values of each group
+    """
+    missing = counts < n_values
+    if aggfunc == 'max':
+        return np.where(missing, np.maximum(agg, 0), agg)
+    if aggfunc == 'min':
+        return np.where(missing, np.minimum(agg, 0), agg)
+    if aggfunc == 'sum':
+        return agg
+    if aggfunc == 'mean':
+        return agg * counts / n_values
+    if aggfunc == 'count':
+        return np.asarray(n_values, dtype=float)
+    raise ValueError(f'aggfunc "{aggfunc}" is not implemented for treat_zeros_as_nans=False')
+
+def cell_index_from_coords(x, y, cell_size, bounds):
+    """Get the index of the regular grid cell containing each point
+
+    The index follows the cell order of create_empty_grid (loop over x, then y),
+    i.e. index = floor((x-xmin)/cell_size) * n_y + floor((y-ymin)/cell_size).
+
+    Parameters
+    ----------
+    x, y : np.array
+        Coordinates of the points (in the coordinate system of the grid)
+    cell_size : float or int
+        Size of the grid cells
+    bounds : tuple
+        Bounds of the grid (xmin, ymin, xmax, ymax) as used in create_empty_grid
+
+    Returns
+    -------
+    cell_index : np.array
+        Index of the grid cell of each point, -1 for points outside of the grid
+    """
+    xmin, ymin, _, _ = bounds
+    n_x, n_y = grid_shape(cell_size, bounds)
+    i_x = np.floor((np.asarray(x, dtype=float) - xmin) / cell_size).astype(np.int64)
+    i_y = np.floor((np.asarray(y, dtype=float) - ymin) / cell_size).astype(np.int64)
+    inside = (i_x >= 0) & (i_x < n_x) & (i_y >= 0) & (i_y < n_y)
+    return np.where(inside, i_x * n_y + i_y, -1)
+
+def coarsen_cell_index(cell_size, cell_size_coarse, bounds):
+    """Index of the coarse grid cell containing each cell of a finer nested grid
+
+    Parameters
+    ----------
+    cell_size : float or int
+        Size of the grid cells of the fine grid
+    cell_size_coarse : float or int
+        Size of the grid cells of the coarse grid (a multiple of cell_size)
+    bounds : tuple
+        Bounds of both grids (xmin, ymin, xmax, ymax) as used in create_empty_grid
+
+    Returns
+    -------
+    cell_index : np.array
+        Index of the coarse grid cell of each fine grid cell, -1 outside of the coarse grid
+    """
+    xmin, ymin, _, _ = bounds
+    n_x, n_y = grid_shape(cell_size, bounds)
+    i_x, i_y = np.divmod(np.arange(n_x * n_y), n_y)
+    return cell_index_from_coords(xmin + (i_x + 0.5) * cell_size,
+                                  ymin + (i_y + 0.5) * cell_size,
+                                  cell_size_coarse, bounds)
+
+def grid_shape(cell_size, bounds):
+    """Number of grid cells in x and y direction of the grid from create_empty_grid"""
+    xmin, ymin, xmax, ymax = bounds
+    n_x = np.arange(xmin, xmax+cell_size, cell_size).size
+    n_y = np.arange(ymin, ymax+cell_size, cell_size).size
+    return n_x, n_y
+
+def grid_bounds(epsg=2056, extent=None):
+    """Bounds (xmin, ymin, xmax, ymax) of the grid from create_empty_grid"""
+    if epsg == 2056:
+        return LV95_BOUNDS
+    return tuple(extent)
+
 def gdf_from_hazard(hazard):
     """Create GeoDataFrame from hazard object with columns 'intensity', 'date', 'event_id', and hazard centroids as geometry
 
@@ -493,12 +865,9 @@ def create_empty_grid(epsg=2056, cell_size = 1000, extent = None):
    """
 
    # specify extent of the grid (here: LV95 bounds)
-   if epsg == 2056:
-       xmin, ymin, xmax, ymax = (2255000, 840000, 2964000, 1479000)
-       if extent is not None:
-           warnings.warn('Extent of grid EPSG 2056 is predefined. Argument extent is ignored.')
-   else:
-       xmin, ymin, xmax, ymax = extent
+   if epsg == 2056 and extent is not None:
+       warnings.warn('Extent of grid EPSG 2056 is predefined. Argument extent is ignored.')
+   xmin, ymin, xmax, ymax = grid_bounds(epsg=epsg, extent=extent)
 
    # create the cells in a loop
    grid_cells = []
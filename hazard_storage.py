@@ -0,0 +1,273 @@
+"""
+Storage profiles of the intensity and fraction of the hazard outputs.
+
+CLIMADA writes the sparse intensity and fraction matrices as uncompressed float64
+(<matrix>/data, indices, indptr), while wind speeds and flood depths need far less
+precision. A storage profile rewrites these datasets with a smaller type and an HDF5
+filter chain (shuffle and compression):
+
+    float64      as written by CLIMADA (default, no rewrite)
+    float32      data as float32
+    quantized    data as uint16 fixed point: value = stored * scale_factor + add_offset,
+                 with the scale of QUANTIZATION_SCALE by hazard type (FRACTION_SCALE for
+                 the fraction) declared as attributes of the dataset
+
+optionally followed by +<compression> (none, gzip, lzf, zstd or lz4), e.g. float32+zstd.
+zstd and lz4 need the hdf5plugin package, for writing and for reading. The compression
+defaults to zstd if hdf5plugin is installed and gzip otherwise, for all profiles but float64.
+
+The profile of the pipeline outputs is HAZARD_STORAGE if set (see also --storage in
+cli.py), float64 otherwise. Files written with a profile are read with read_hazard,
+which restores float64 matrices. float32 files can also be read with from_hdf5 directly.
+"""
+import os
+import sys
+import tempfile
+import warnings
+
+import h5py
+import numpy as np
+from scipy import sparse
+
+try:
+    import hdf5plugin  # registers the zstd and lz4 filters
+except ImportError:
+    hdf5plugin = None
+
+STORAGE_ENV = 'HAZARD_STORAGE'
+PROFILES = {
+    'float64': None,
+    'float32': np.float32,
+    'quantized': np.uint16,
+}
+COMPRESSIONS = ['none', 'gzip', 'lzf', 'zstd', 'lz4']
+GZIP_LEVEL = 4
+ZSTD_LEVEL = 5
+MATRICES = ['intensity', 'fraction']
+# resolution of the quantized intensity by hazard type (0.01 m/s for wind, 1 mm for the
+# flood depth of RiverFlood, whose haz_type is 'RF')
+QUANTIZATION_SCALE = {'TC': 0.01, 'RF': 0.001}
+DEFAULT_SCALE = 0.01
+FRACTION_SCALE = 1 / 65535  # 0 and 1 are exact
+
+
+def parse_profile(spec):
+    """
+    Parse a storage profile.
+
+    Parameters:
+        spec (str): <profile>[+<compression>], e.g. float32+zstd.
+
+    Returns:
+        dict: name, dtype (None for float64) and compression of the profile, and its spec.
+    """
+    name, _, compression = spec.partition('+')
+    if name not in PROFILES:
+        raise ValueError(f"unknown storage profile {name}, expected one of {list(PROFILES)}")
+    if not compression:
+        compression = 'none' if name == 'float64' else ('zstd' if hdf5plugin else 'gzip')
+    if compression not in COMPRESSIONS:
+        raise ValueError(f"unknown compression {compression}, expected one of {COMPRESSIONS}")
+    if compression in ('zstd', 'lz4') and hdf5plugin is None:
+        raise ImportError(f"the {compression} compression requires the hdf5plugin package")
+    return {'name': name, 'dtype': PROFILES[name], 'compression': compression,
+            'spec': f"{name}+{compression}"}
+
+
+def default_profile():
+    """Storage profile of HAZARD_STORAGE, float64 if it is not set."""
+    return parse_profile(os.environ.get(STORAGE_ENV) or 'float64')
+
+
+def is_default(profile):
+    """True if the profile stores the matrices as written by CLIMADA."""
+    return profile['dtype'] is None and profile['compression'] == 'none'
+
+
+def dataset_filters(compression, size):
+    """Keyword arguments of create_dataset for the filter chain."""
+    if compression == 'none' or size == 0:
+        return {}
+    if compression == 'gzip':
+        return dict(shuffle=True, compression='gzip', compression_opts=GZIP_LEVEL)
+    if compression == 'lzf':
+        return dict(shuffle=True, compression='lzf')
+    if compression == 'zstd':
+        return dict(shuffle=True, **hdf5plugin.Zstd(clevel=ZSTD_LEVEL))
+    return dict(shuffle=True, **hdf5plugin.LZ4())
+
+
+def quantization_scale(haz_type, matrix):
+    """Scale of the quantized values of a matrix ('intensity' or 'fraction') of a hazard type."""
+    if matrix == 'fraction':
+        return FRACTION_SCALE
+    return QUANTIZATION_SCALE.get(haz_type, DEFAULT_SCALE)
+
+
+def write_matrix_data(group, name, values, profile, scale=DEFAULT_SCALE, offset=0.):
+    """
+    Write the values of a sparse matrix as a dataset of a group with a storage profile.
+
+    Parameters:
+        group (h5py.Group): Group of the matrix.
+        name (str): Name of the dataset, e.g. 'data'.
+        values (np.ndarray): Float values.
+        profile (dict): Storage profile (see parse_profile).
+        scale, offset (float): Fixed point of the quantized profile.
+
+    Returns:
+        int: Number of values clipped to the range of the quantized type.
+    """
+    n_clipped = 0
+    attrs = {}
+    if profile['dtype'] is None:
+        stored = values
+    elif np.issubdtype(profile['dtype'], np.floating):
+        stored = values.astype(profile['dtype'])
+    else:
+        info = np.iinfo(profile['dtype'])
+        stored = np.rint((values - offset) / scale)
+        n_clipped = int(np.count_nonzero((stored < info.min) | (stored > info.max)))
+        stored = np.clip(stored, info.min, info.max).astype(profile['dtype'])
+        attrs = {'scale_factor': scale, 'add_offset': offset}
+    dset = group.create_dataset(name, data=stored, **dataset_filters(profile['compression'], stored.size))
+    dset.attrs.update(attrs)
+    return n_clipped
+
+
+def decode(values, attrs):
+    """Float64 values of a dataset written with write_matrix_data."""
+    if 'scale_factor' in attrs:
+        return values * float(attrs['scale_factor']) + float(attrs['add_offset'])
+    return values.astype(np.float64, copy=False)
+
+
+def write_stored(haz, path, profile=None):
+    """
+    Write a hazard with its write_hdf5 method and a storage profile.
+
+    The hazard is written to a temporary file, which is copied to path with the intensity
+    and fraction rewritten with the profile and all other objects unchanged.
+
+    Parameters:
+        haz (Hazard): Hazard to write.
+        path (str): Path of the file.
+        profile (dict, optional): Storage profile. Default: default_profile().
+    """
+    profile = profile or default_profile()
+    if is_default(profile):
+        haz.write_hdf5(path)
+        return
+    raw_path = path + '.raw'
+    haz.write_hdf5(raw_path)
+    try:
+        with h5py.File(raw_path, 'r') as src, h5py.File(path, 'w') as dst:
+            dst.attrs.update(src.attrs)
+            for name in src:
+                if name not in MATRICES or not isinstance(src[name], h5py.Group):
+                    src.copy(src[name], dst, name=name)
+                    continue
+                group = dst.create_group(name)
+                group.attrs.update(src[name].attrs)
+                n_clipped = write_matrix_data(group, 'data', src[name]['data'][:], profile,
+                                              scale=quantization_scale(haz.haz_type, name))
+                if n_clipped:
+                    warnings.warn(f"{n_clipped} values of the {name} clipped to the range of {profile['spec']}")
+                for index in ('indices', 'indptr'):
+                    values = src[name][index][:]
+                    group.create_dataset(index, data=values, **dataset_filters(profile['compression'], values.size))
+    finally:
+        os.remove(raw_path)
+
+
+def read_hazard(path, haz_class):
+    """
+    Read a hazard written with any storage profile, with float64 intensity and fraction.
+
+    Parameters:
+        path (str): Path of the file.
+        haz_class (type): Class of the hazard, e.g. TropCyclone.
+
+    Returns:
+        Hazard
+    """
+    haz = haz_class.from_hdf5(path)
+    with h5py.File(path, 'r') as file:
+        for name in MATRICES:
+            if name not in file or not isinstance(file[name], h5py.Group):
+                continue
+            dset = file[name]['data']
+            if dset.dtype == np.float64:
+                continue
+            matrix = getattr(haz, name)
+            if matrix.nnz == dset.shape[0]:
+                # the decoding is elementwise, independent of the order of the entries
+                matrix = matrix.copy()
+                matrix.data = decode(matrix.data, dset.attrs)
+            else:
+                # entries were dropped when loading (stored zeros), rebuild from the file
+                group = file[name]
+                matrix = sparse.csr_matrix((decode(dset[:], dset.attrs), group['indices'][:], group['indptr'][:]),
+                                           shape=tuple(group.attrs['shape']))
+            setattr(haz, name, matrix)
+    return haz
+
+
+def check_round_trip(haz, haz_class, profile=None):
+    """
+    Write a hazard with a storage profile, read it back and compare its matrices.
+
+    Parameters:
+        haz (Hazard): Hazard to write.
+        haz_class (type): Class of the hazard, e.g. RiverFlood.
+        profile (dict, optional): Storage profile. Default: default_profile().
+
+    Returns:
+        dict: Largest absolute error of each matrix.
+
+    Raises:
+        ValueError: If an error exceeds the resolution of the profile (half the quantization
+            scale of the hazard type for the quantized profile).
+    """
+    profile = profile or default_profile()
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        path = os.path.join(tmp_dir, 'round_trip.hdf5')
+        write_stored(haz, path, profile)
+        read = read_hazard(path, haz_class)
+    errors = {}
+    for name in MATRICES:
+        expected, actual = getattr(haz, name), getattr(read, name)
+        if expected.shape != actual.shape:
+            raise ValueError(f"The {name} was read with shape {actual.shape} instead of {expected.shape}.")
+        errors[name] = float(abs(expected - actual).max()) if expected.nnz or actual.nnz else 0.
+        if profile['dtype'] is None:
+            tolerance = 0.
+        elif np.issubdtype(profile['dtype'], np.floating):
+            tolerance = float(abs(expected).max()) * np.finfo(profile['dtype']).eps if expected.nnz else 0.
+        else:
+            tolerance = quantization_scale(haz.haz_type, name) / 2 * (1 + 1e-9)
+        if errors[name] > tolerance:
+            raise ValueError(f"The {name} of {haz.haz_type} differs by {errors[name]} after a round trip "
+                             f"with {profile['spec']} (resolution {tolerance}).")
+    return errors
+
+
+if __name__ == "__main__":
+    # Usage: python hazard_storage.py [<profile>]  (round trip of a synthetic river flood)
+    from climada.hazard import Centroids
+    from climada_petals.hazard.river_flood import RiverFlood
+
+    rng = np.random.default_rng(0)
+    lat, lon = np.meshgrid(np.arange(45, 47, 0.1), np.arange(5, 7, 0.1), indexing='ij')
+    n_events = 10
+    depth = sparse.random(n_events, lat.size, density=0.1, format='csr', random_state=0,
+                          data_rvs=lambda size: rng.uniform(0, 10, size))
+    fraction = depth.copy()
+    fraction.data = rng.uniform(0, 1, fraction.nnz)
+    flood = RiverFlood(centroids=Centroids(lat=lat.ravel(), lon=lon.ravel()), units='m',
+                       event_id=np.arange(1, n_events + 1), event_name=[str(i) for i in range(n_events)],
+                       date=np.full(n_events, 730000), frequency=np.ones(n_events), orig=np.ones(n_events, bool),
+                       intensity=depth, fraction=fraction)
+    profile = parse_profile(sys.argv[1] if len(sys.argv) > 1 else 'quantized')
+    print(flood.haz_type, profile['spec'], 'scale', quantization_scale(flood.haz_type, 'intensity'),
+          check_round_trip(flood, RiverFlood, profile))
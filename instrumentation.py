@@ -0,0 +1,193 @@
+"""
+Structured progress logging and timing of the pipeline stages.
+
+Events are buffered in memory and appended as JSON lines to one file per process
+(<log_dir>/events_<host>_<pid>.jsonl), such that concurrent workers never interleave
+their writes. Each event records the stage, the unit (e.g. basin, country) and, for
+timed stages, the wall and CPU time, the peak RSS of the process and the bytes written.
+Forked processes (e.g. the workers of a process pool) write each event unbuffered, as
+they exit with os._exit, which skips the flush at exit.
+
+The log directory is PIPELINE_LOG_DIR if set, otherwise logs/ in the repository.
+
+Usage: python instrumentation.py [<log_dir>]  (prints the summary report)
+"""
+import os
+import sys
+import glob
+import json
+import time
+import atexit
+import socket
+import resource
+import threading
+import tracemalloc
+from contextlib import ContextDecorator
+
+import pandas as pd
+
+LOG_DIR_ENV = 'PIPELINE_LOG_DIR'
+LOG_DIR = os.environ.get(LOG_DIR_ENV) or os.path.join(os.path.dirname(os.path.abspath(__file__)), 'logs')
+FLUSH_EVENTS = 100  # flush the buffer after this number of events
+FLUSH_SECONDS = 5  # or after this time since the last flush
+
+_buffer = []
+_pid = os.getpid()  # process buffering its events, the processes forked from it do not
+_last_flush = time.time()
+_snapshot_prefix = None
+_lock = threading.Lock()  # events may be logged by background threads (see prefetch.py)
+
+
+def _reset_after_fork():
+    """Forked workers start with an empty buffer, events of the parent are flushed by the parent."""
+    global _last_flush, _lock
+    _lock = threading.Lock()
+    _buffer.clear()
+    _last_flush = time.time()
+
+
+os.register_at_fork(after_in_child=_reset_after_fork)
+
+
+def event_file(log_dir=LOG_DIR):
+    """Event log of the current process."""
+    return os.path.join(log_dir, f"events_{socket.gethostname()}_{os.getpid()}.jsonl")
+
+
+def flush(log_dir=LOG_DIR):
+    """Append the buffered events to the event log of the process."""
+    global _last_flush
+    with _lock:
+        _last_flush = time.time()
+        if not _buffer:
+            return
+        events, _buffer[:] = list(_buffer), []
+        os.makedirs(log_dir, exist_ok=True)
+        lines = ''.join(json.dumps(event) + '\n' for event in events)
+        with open(event_file(log_dir), 'a') as file:
+            file.write(lines)
+
+
+atexit.register(flush)
+
+
+def log_event(stage, unit=None, **fields):
+    """
+    Record an event.
+
+    Parameters:
+        stage (str): Stage of the pipeline, e.g. 'tc_genesis_basin'.
+        unit (str, optional): Unit of work within the stage, e.g. a basin or a country.
+        fields: Further fields of the event (e.g. msg, wall_s).
+    """
+    event = dict(time=time.time(), stage=stage, unit=None if unit is None else str(unit), pid=os.getpid(), **fields)
+    with _lock:  # events are logged from the prefetch and writer threads as well
+        _buffer.append(event)
+        due = (len(_buffer) >= FLUSH_EVENTS or time.time() - _last_flush > FLUSH_SECONDS
+               or os.getpid() != _pid)  # atexit does not run in forked workers
+    if due:
+        flush()
+
+
+def set_snapshot_prefix(prefix):
+    """Dump a tracemalloc snapshot to <prefix>_<stage>_<unit>.tracemalloc after each timed unit (None: no snapshots)."""
+    global _snapshot_prefix
+    _snapshot_prefix = prefix
+
+
+def _bytes_written():
+    """Bytes written by the process so far (Linux only, 0 otherwise)."""
+    try:
+        with open('/proc/self/io') as file:
+            for line in file:
+                if line.startswith('wchar:'):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return 0
+
+
+def peak_rss_mb():
+    """Peak resident memory of the process in MB."""
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+class timed(ContextDecorator):
+    """
+    Time a stage, as context manager or decorator, and record it as an event with wall
+    and CPU time, peak RSS, bytes written and status ('ok' or the exception name). If
+    tracemalloc is tracing, the peak of the traced memory during the unit is recorded too.
+
+    Example:
+        with timed('tc_climate_change', unit=f'{basin}_rcp{scenario}_{year}'):
+            ...
+
+        @timed('tc_concat_basins')
+        def main(...):
+            ...
+    """
+
+    def __init__(self, stage, unit=None, **fields):
+        self.stage = stage
+        self.unit = unit
+        self.fields = fields
+
+    def __enter__(self):
+        if tracemalloc.is_tracing():
+            tracemalloc.reset_peak()
+        self._start = (time.perf_counter(), time.process_time(), _bytes_written())
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        wall, cpu, written = self._start
+        fields = dict(self.fields)
+        if tracemalloc.is_tracing():
+            fields['traced_peak_mb'] = round(tracemalloc.get_traced_memory()[1] / 2**20, 1)
+            if _snapshot_prefix:
+                unit = '' if self.unit is None else f"_{self.unit}"
+                tracemalloc.take_snapshot().dump(f"{_snapshot_prefix}_{self.stage}{unit}.tracemalloc")
+        log_event(self.stage, self.unit, wall_s=round(time.perf_counter() - wall, 3),
+                  cpu_s=round(time.process_time() - cpu, 3), peak_rss_mb=round(peak_rss_mb(), 1),
+                  bytes_written=_bytes_written() - written,
+                  status='ok' if exc_type is None else exc_type.__name__, **fields)
+        if time.perf_counter() - wall > 1:  # negligible cost, and not lost if a pool worker is killed
+            flush()
+        return False
+
+
+def read_events(log_dir=LOG_DIR):
+    """Events of all processes as a DataFrame."""
+    rows = []
+    for path in sorted(glob.glob(os.path.join(log_dir, 'events_*.jsonl'))):
+        with open(path) as file:
+            rows.extend(json.loads(line) for line in file if line.strip())
+    return pd.DataFrame(rows)
+
+
+def summary(log_dir=LOG_DIR):
+    """
+    Summarise the timed events by stage: number of units, failures, total and maximum
+    wall time, total CPU time, maximum peak RSS and bytes written.
+
+    Parameters:
+        log_dir (str): Directory of the event logs.
+
+    Returns:
+        pd.DataFrame: One row per stage, sorted by total wall time.
+    """
+    events = read_events(log_dir)
+    if events.empty or 'wall_s' not in events:
+        return pd.DataFrame()
+    timed_events = events.dropna(subset=['wall_s'])
+    report = timed_events.groupby('stage').agg(
+        n_units=('wall_s', 'size'), n_failed=('status', lambda status: int((status != 'ok').sum())),
+        wall_s=('wall_s', 'sum'), max_wall_s=('wall_s', 'max'), cpu_s=('cpu_s', 'sum'),
+        peak_rss_mb=('peak_rss_mb', 'max'), bytes_written=('bytes_written', 'sum'))
+    report['share_wall'] = (report['wall_s'] / report['wall_s'].sum()).round(3)
+    return report.sort_values('wall_s', ascending=False)
+
+
+if __name__ == "__main__":
+    log_dir = sys.argv[1] if len(sys.argv) > 1 else LOG_DIR
+    with pd.option_context('display.width', 200, 'display.max_columns', None):
+        print(summary(log_dir))
@@ -11,6 +11,9 @@ from climada.entity import LitPop
 sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
 from config import DATA_DIR
 from create_log_file import log_msg
+from output_manifest import write_hdf5
+from instrumentation import timed
+import cli
 
 missing_country = []
 
@@ -57,6 +60,7 @@ target_grid = {
     "transform": transform,
 }
 
+@timed('litpop')
 def make_litpop(exposure, use_aligned_grid=True):
     """
     Create LitPop exposures at a country level and then concatenate them to create a global exposure.
@@ -85,7 +89,7 @@ def make_litpop(exposure, use_aligned_grid=True):
             # Save country-level output
             out_path = os.path.join(OUT_DIR_COUNTRIES, exposure)
             os.makedirs(out_path, exist_ok=True)
-            litpop.write_hdf5(os.path.join(out_path, OUT_FILE_COUNTRY.format(
+            write_hdf5(litpop, os.path.join(out_path, OUT_FILE_COUNTRY.format(
                 exposure=EXP_STR[exposure], country=country.alpha_3)))
 
             log_msg(f"Country {country.alpha_3} processed.\n", LOG_FILE)
@@ -101,13 +105,26 @@ def make_litpop(exposure, use_aligned_grid=True):
 
         out_path = os.path.join(OUT_DIR, exposure)
         os.makedirs(out_path, exist_ok=True)
-        litpop_concat.write_hdf5(os.path.join(out_path, OUT_FILE.format(exposure=EXP_STR[exposure])))
+        write_hdf5(litpop_concat, os.path.join(out_path, OUT_FILE.format(exposure=EXP_STR[exposure])))
         log_msg(f"Global file saved.\n", LOG_FILE)
     else:
         log_msg("No successful country data to concatenate.\n", LOG_FILE)
 
     log_msg(f"The following countries were not successful: {missing_country}.\n", LOG_FILE)
 
+def main(exposures=('assets',), use_aligned_grid=True):
+    """
+    Create the LitPop exposures of several exposure types.
+
+    Parameters:
+        exposures (list of str): Exposure types, 'pop', 'default' or 'assets'.
+        use_aligned_grid (bool): If False, target_grid is skipped
+    """
+    for exposure in exposures:
+        make_litpop(exposure, use_aligned_grid=use_aligned_grid)
+
 if __name__ == "__main__":
-    for exposure in ['assets']:
-        make_litpop(exposure, use_aligned_grid=True)  # Set to False to skip target_grid
+    cli.run(main, 'litpop', [
+        ('exposures', cli.str_list, ['assets'], "Exposure types, e.g. pop,assets"),
+        ('use_aligned_grid', cli.boolean, True, "Align the exposures on the centroids grid"),
+    ], description="Create the country and global LitPop exposures.")
@@ -0,0 +1,204 @@
+"""
+Atomic, checksummed writes of the pipeline outputs.
+
+Outputs are written to a temporary file next to their final path, fsynced, checksummed
+and atomically renamed. Each output is then recorded (size, sha256 and, for hazards,
+number of events and non-zero intensities) in the manifest.json of its directory. An
+output counts as complete only if it is in the manifest with the recorded size, such
+that files of killed jobs are recomputed when a job is resumed.
+"""
+import os
+import json
+import fcntl
+import shutil
+import hashlib
+from contextlib import contextmanager
+from datetime import datetime
+
+import hazard_storage
+
+MANIFEST_NAME = "manifest.json"
+
+
+def manifest_path(path):
+    """Manifest of the directory of path."""
+    return os.path.join(os.path.dirname(os.path.abspath(path)), MANIFEST_NAME)
+
+
+@contextmanager
+def _locked_manifest(path):
+    """Lock the manifest of the directory of path, yield its entries and write them back."""
+    manifest = manifest_path(path)
+    with open(manifest + '.lock', 'a') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        entries = read_manifest(path)
+        yield entries
+        tmp_file = manifest + f'.{os.getpid()}.tmp'
+        with open(tmp_file, 'w') as file:
+            json.dump(entries, file, indent=1, sort_keys=True)
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(tmp_file, manifest)
+        fcntl.flock(lock, fcntl.LOCK_UN)
+
+
+def read_manifest(path):
+    """Entries of the manifest of the directory of path (empty if there is none)."""
+    manifest = manifest_path(path)
+    if not os.path.exists(manifest):
+        return {}
+    with open(manifest) as file:
+        return json.load(file)
+
+
+def _file_list(path):
+    """Files of path (path itself if it is a file), sorted."""
+    if os.path.isfile(path):
+        return [path]
+    return sorted(os.path.join(root, name) for root, _, names in os.walk(path) for name in names)
+
+
+def checksum(path):
+    """sha256 of a file, or of the names and contents of the files of a directory."""
+    digest = hashlib.sha256()
+    for file_path in _file_list(path):
+        if file_path != path:
+            digest.update(os.path.relpath(file_path, path).encode())
+        with open(file_path, 'rb') as file:
+            for block in iter(lambda: file.read(1 << 23), b''):
+                digest.update(block)
+    return digest.hexdigest()
+
+
+def output_size(path):
+    """Size in bytes of a file, or of all files of a directory."""
+    return sum(os.path.getsize(file_path) for file_path in _file_list(path))
+
+
+def _fsync(path):
+    """Flush a file, or all files of a directory, and the directory entries to disk."""
+    for file_path in _file_list(path):
+        with open(file_path, 'rb') as file:
+            os.fsync(file.fileno())
+    dir_fd = os.open(os.path.dirname(os.path.abspath(path)), os.O_RDONLY)
+    try:
+        os.fsync(dir_fd)
+    finally:
+        os.close(dir_fd)
+
+
+def is_complete(path, verify=False):
+    """
+    Check whether an output was completely written.
+
+    Parameters:
+        path (str): Path of the output (file or directory).
+        verify (bool): If True, also compare the checksum (reads the whole output).
+
+    Returns:
+        bool: True if path is in the manifest of its directory with its current size
+            (and checksum).
+    """
+    path = str(path)
+    entry = read_manifest(path).get(os.path.basename(path))
+    if entry is None or not os.path.exists(path):
+        return False
+    if output_size(path) != entry['size']:
+        return False
+    return not verify or checksum(path) == entry['sha256']
+
+
+@contextmanager
+def atomic_output(path, info=None, directory=False):
+    """
+    Write an output atomically and record it in the manifest of its directory, for
+    outputs written over time rather than by a single function (see write_atomic).
+
+    Parameters:
+        path (str): Final path of the output.
+        info (dict, optional): Additional information recorded in the manifest.
+        directory (bool): If True, the output is a directory, created before it is yielded.
+
+    Yields:
+        tmp_path (str): Path to write the output to, renamed to path when the block exits
+            without an exception and removed otherwise.
+        entry (dict): Manifest entry of the output, can be extended within the block and
+            is completed (size, checksum) when the block exits.
+    """
+    path = str(path)
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    tmp_path = os.path.join(os.path.dirname(os.path.abspath(path)),
+                            f".{os.path.basename(path)}.{os.getpid()}.tmp")
+    if directory:
+        os.makedirs(tmp_path)
+    entry = dict(info or {})
+    try:
+        yield tmp_path, entry
+        _fsync(tmp_path)
+        entry.update(size=output_size(tmp_path), sha256=checksum(tmp_path),
+                     written=datetime.now().isoformat(timespec='seconds'))
+    except BaseException:
+        if os.path.isdir(tmp_path):
+            shutil.rmtree(tmp_path)
+        elif os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+    with _locked_manifest(path) as entries:
+        entries.pop(os.path.basename(path), None)
+        if directory and os.path.isdir(path):
+            shutil.rmtree(path)
+        os.replace(tmp_path, path)
+        _fsync(path)
+        entries[os.path.basename(path)] = entry
+
+
+def write_atomic(path, write_func, info=None, directory=False):
+    """
+    Write an output atomically and record it in the manifest of its directory.
+
+    Parameters:
+        path (str): Final path of the output.
+        write_func (callable): Function writing the output to the path it is given.
+        info (dict, optional): Additional information recorded in the manifest.
+        directory (bool): If True, the output is a directory, created before write_func is called.
+
+    Returns:
+        dict: Manifest entry of the output.
+    """
+    with atomic_output(path, info, directory) as (tmp_path, entry):
+        write_func(tmp_path)
+    return entry
+
+
+def hdf5_info(obj):
+    """Manifest information of a CLIMADA object: events and non-zero intensities of hazards, size otherwise."""
+    if hasattr(obj, 'intensity'):
+        return {'n_events': int(obj.intensity.shape[0]), 'nnz': int(obj.intensity.nnz)}
+    if hasattr(obj, 'gdf'):
+        return {'n_rows': int(len(obj.gdf))}
+    return {}
+
+
+def write_hdf5(obj, path, storage=None, **info):
+    """
+    Write a CLIMADA object (Hazard, Exposures, Centroids) with its write_hdf5 method,
+    atomically and recorded in the manifest. Hazards are written with a storage profile
+    (see hazard_storage.py).
+
+    Parameters:
+        obj: Object with a write_hdf5 method.
+        path (str): Final path of the file.
+        storage (str, optional): Storage profile of hazards, e.g. float32+zstd.
+            Default: HAZARD_STORAGE, float64 if it is not set.
+        info: Additional information recorded in the manifest.
+
+    Returns:
+        dict: Manifest entry of the file.
+    """
+    if hasattr(obj, 'intensity'):
+        profile = hazard_storage.parse_profile(storage) if storage else hazard_storage.default_profile()
+        if not hazard_storage.is_default(profile):
+            return write_atomic(path, lambda tmp_path: hazard_storage.write_stored(obj, tmp_path, profile),
+                                dict(hdf5_info(obj), storage=profile['spec'], **info))
+    return write_atomic(path, obj.write_hdf5, dict(hdf5_info(obj), **info))
@@ -0,0 +1,197 @@
+"""
+Overlap of the reads and writes of the hazard files with the computation.
+
+The concat and country scripts read one hazard file after the other and compute on
+each, such that the CPU waits for the file system during the reads and the file system
+idles during the computation. prefetch_hazards reads the next files on background
+threads while the current one is processed, within a memory budget, and AsyncWriter
+writes the outputs on a background thread while the next ones are computed.
+
+The threads overlap the waiting for the file system (reading the raw file, fsync and
+checksum of the atomic writes), which release the GIL. The decoding of the HDF5 datasets
+by h5py does not release it and takes turns with the computation.
+
+The read-ahead is HAZARD_PREFETCH files if set (0 disables it), PREFETCH_FILES otherwise.
+
+Example:
+    for path, haz in prefetch_hazards(paths, TropCyclone):
+        ...
+    with AsyncWriter() as writer:
+        writer.submit(write_hdf5, haz, out_file)
+"""
+import os
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from queue import Queue
+
+import h5py
+
+from hazard_storage import MATRICES, read_hazard
+
+PREFETCH_ENV = 'HAZARD_PREFETCH'
+PREFETCH_FILES = 2
+MAX_PREFETCH_GB = 20  # default memory budget of the prefetched hazards
+READ_BLOCK = 16 * 2**20
+WRITE_QUEUE = 2  # pending writes before submit blocks
+
+
+def prefetch_files():
+    """Number of files read ahead, from HAZARD_PREFETCH."""
+    return int(os.environ.get(PREFETCH_ENV) or PREFETCH_FILES)
+
+
+def hazard_nbytes(path):
+    """
+    Estimated memory of a hazard file once read, from the shapes of its datasets (the
+    matrix values are decoded to float64).
+
+    Parameters:
+        path (str): HDF5 hazard file.
+
+    Returns:
+        int
+    """
+    nbytes = 0
+
+    def visit(name, obj):
+        nonlocal nbytes
+        if isinstance(obj, h5py.Dataset):
+            group, _, dset = name.rpartition('/')
+            itemsize = 8 if group in MATRICES and dset == 'data' else obj.dtype.itemsize
+            nbytes += obj.size * itemsize
+    try:
+        with h5py.File(path, 'r') as file:
+            file.visititems(visit)
+    except OSError:  # not an HDF5 file (yet), the read reports the error
+        return os.path.getsize(path) if os.path.exists(path) else 0
+    return nbytes
+
+
+def read_ahead(path):
+    """Read a file into the page cache, with unbuffered reads that release the GIL."""
+    with open(path, 'rb', buffering=0) as file:
+        while file.read(READ_BLOCK):
+            pass
+
+
+def prefetch(paths, read, n_ahead=None, max_bytes=None, size=os.path.getsize):
+    """
+    Read files in the background, in order, while the previous ones are processed.
+
+    A file is read ahead while fewer than n_ahead files are pending and the estimated size
+    of the pending files and of the file being processed stays within max_bytes (at least
+    one file is always read ahead). Errors of a read are raised when its file is reached.
+
+    Parameters:
+        paths (iterable of str): Files to read.
+        read (callable): Function reading a file, called with its path on a background thread.
+        n_ahead (int, optional): Number of files read ahead. Default: prefetch_files().
+            Files are read in the foreground if 0.
+        max_bytes (int, optional): Memory budget. Default: MAX_PREFETCH_GB.
+        size (callable): Estimated memory of a file once read.
+
+    Yields:
+        tuple: Path and result of read of each file.
+    """
+    n_ahead = prefetch_files() if n_ahead is None else n_ahead
+    max_bytes = MAX_PREFETCH_GB * 2**30 if max_bytes is None else max_bytes
+    paths = iter(paths)
+    if n_ahead <= 0:
+        for path in paths:
+            yield path, read(path)
+        return
+
+    pending = deque()  # (path, estimated size, future)
+    next_path = next(paths, None)
+    next_size = None
+    with ThreadPoolExecutor(max_workers=n_ahead, thread_name_prefix='prefetch') as pool:
+        try:
+            current = 0  # estimated size of the file being processed
+            while pending or next_path is not None:
+                while next_path is not None and len(pending) < n_ahead:
+                    if next_size is None:
+                        next_size = size(next_path)
+                    in_memory = current + sum(item[1] for item in pending)
+                    if pending and in_memory + next_size > max_bytes:
+                        break
+                    pending.append((next_path, next_size, pool.submit(read, next_path)))
+                    next_path, next_size = next(paths, None), None
+                path, current, future = pending.popleft()
+                yield path, future.result()
+        finally:
+            for _, _, future in pending:
+                future.cancel()
+
+
+def prefetch_hazards(paths, haz_class, n_ahead=None, max_bytes=None):
+    """
+    Read hazard files (with read_hazard) in the background while the previous ones are
+    processed (see prefetch).
+
+    Parameters:
+        paths (iterable of str): Hazard files.
+        haz_class (type): Class of the hazards, e.g. TropCyclone.
+        n_ahead (int, optional): Number of files read ahead. Default: prefetch_files().
+        max_bytes (int, optional): Memory budget. Default: MAX_PREFETCH_GB.
+
+    Yields:
+        tuple: Path and hazard of each file.
+    """
+    def read(path):
+        read_ahead(path)
+        return read_hazard(path, haz_class)
+    return prefetch(paths, read, n_ahead=n_ahead, max_bytes=max_bytes, size=hazard_nbytes)
+
+
+class AsyncWriter:
+    """
+    Writes on a background thread, in the order of submission. The submitted objects must
+    not be modified until they are written. submit blocks while max_pending writes are
+    queued, which bounds the memory of the pending outputs. The first error of a write is
+    raised by the next submit or by close, and the remaining writes are dropped.
+
+    Example:
+        with AsyncWriter() as writer:
+            writer.submit(write_hdf5, tc_country, output_file)
+    """
+
+    def __init__(self, max_pending=WRITE_QUEUE):
+        self.error = None
+        self._queue = Queue(maxsize=max(max_pending, 1))
+        self._thread = threading.Thread(target=self._run, name='async-writer', daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        for func, args, kwargs in iter(self._queue.get, None):
+            if self.error is None:
+                try:
+                    func(*args, **kwargs)
+                except BaseException as err:
+                    self.error = err
+
+    def _raise(self):
+        if self.error is not None:
+            raise self.error
+
+    def submit(self, func, *args, **kwargs):
+        """Queue the call func(*args, **kwargs)."""
+        self._raise()
+        self._queue.put((func, args, kwargs))
+
+    def close(self):
+        """Wait for the queued writes."""
+        self._queue.put(None)
+        self._thread.join()
+        self._raise()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.close()
+        else:  # wait for the writes, the error of the block takes precedence
+            self._queue.put(None)
+            self._thread.join()
+        return False
@@ -0,0 +1,275 @@
+"""
+Region-sorted layout of global hazard files, for fast country extraction.
+
+The global hazards keep their centroids in grid order, such that extracting a country
+requires to read the whole intensity matrix. In the region-sorted layout, the centroids
+are sorted by region_id (keeping the grid order within a region) and the intensity and
+fraction are stored column-major (CSC) in HDF5, with an index of the column range of
+each region:
+
+    /centroids/lat, lon, region_id, ...   sorted by region_id
+    /events/event_id, event_name, ...     as in the hazard
+    /intensity/data, indices, indptr      CSC matrix (shape as attribute)
+    /fraction/data, indices, indptr
+    /regions/region_id, start, stop       columns [start, stop) of each region
+
+Reading a region then only reads its slice of indptr, data and indices. The layout is
+written next to the global file as <name>_by_region.h5 (see region_layout_path) and
+used for country extraction as long as it was written from the current global file.
+"""
+import os
+
+import h5py
+import numpy as np
+from scipy import sparse
+
+from climada.hazard import Centroids, Hazard
+
+import hazard_storage
+from output_manifest import hdf5_info, is_complete, read_manifest, write_atomic
+
+LAYOUT_NAME = 'region_csc'
+#event attributes stored with the events (if the hazard has them)
+EVENT_ATTRS = ['event_id', 'event_name', 'date', 'frequency', 'orig', 'category', 'basin']
+#event attributes accepted by Hazard.__init__, the others (e.g. category and basin of
+#TropCyclone) are set after the construction
+HAZARD_EVENT_ARGS = ['event_id', 'event_name', 'date', 'frequency', 'orig']
+
+
+def region_layout_path(path):
+    """Path of the region-sorted layout of a global hazard file."""
+    return os.path.splitext(str(path))[0] + '_by_region.h5'
+
+
+def current_region_layout(path):
+    """
+    Region-sorted layout of a global hazard file, if it is complete and was written from
+    the current global file (see write_region_layout).
+
+    Returns:
+        str or None: Path of the layout, or None if there is no valid layout.
+    """
+    region_path = region_layout_path(path)
+    if not (is_complete(path) and is_complete(region_path)):
+        return None
+    entries = read_manifest(path)
+    if entries[os.path.basename(region_path)].get('source_sha256') != entries[os.path.basename(str(path))]['sha256']:
+        return None
+    return region_path
+
+
+def _write_csc(group, matrix, profile, scale):
+    """Write a sparse matrix as CSC datasets of a group, the data with a storage profile."""
+    matrix = sparse.csc_matrix(matrix)
+    matrix.sort_indices()
+    group.attrs['shape'] = matrix.shape
+    hazard_storage.write_matrix_data(group, 'data', matrix.data, profile, scale=scale)
+    group.create_dataset('indices', data=matrix.indices)
+    group.create_dataset('indptr', data=matrix.indptr.astype(np.int64))
+
+
+def read_csc_columns(group, ranges, n_rows):
+    """Read the columns of several ranges [start, stop) of a CSC group as a CSC matrix."""
+    indptr = group['indptr']
+    data, indices, counts = [], [], []
+    for start, stop in ranges:
+        ptr = indptr[start:stop + 1]
+        data.append(hazard_storage.decode(group['data'][ptr[0]:ptr[-1]], group['data'].attrs))
+        indices.append(group['indices'][ptr[0]:ptr[-1]])
+        counts.append(np.diff(ptr))
+    counts = np.concatenate(counts) if counts else np.zeros(0, np.int64)
+    indptr = np.concatenate([[0], np.cumsum(counts)])
+    matrix = sparse.csc_matrix((np.concatenate(data) if data else np.zeros(0),
+                                np.concatenate(indices) if indices else np.zeros(0, np.int32),
+                                indptr), shape=(n_rows, counts.size))
+    return matrix
+
+
+def write_region_sorted(haz, path, storage=None):
+    """
+    Write a hazard in the region-sorted layout.
+
+    Parameters:
+        haz (Hazard): Hazard with region_id set on its centroids.
+        path (str): HDF5 file to write.
+        storage (str, optional): Storage profile of the intensity and fraction data (see
+            hazard_storage.py). Only the data is stored with the profile, the indices stay
+            unfiltered for fast partial reads. Default: HAZARD_STORAGE, float64 if not set.
+
+    Returns:
+        dict: Information on the file (n_events, nnz, n_regions) for the manifest.
+    """
+    region_id = np.asarray(haz.centroids.region_id)
+    order = np.argsort(region_id, kind='stable')
+    regions, start = np.unique(region_id[order], return_index=True)
+    stop = np.append(start[1:], region_id.size)
+    n_events = haz.intensity.shape[0]
+    profile = hazard_storage.parse_profile(storage) if storage else hazard_storage.default_profile()
+
+    with h5py.File(path, 'w') as file:
+        file.attrs['layout'] = LAYOUT_NAME
+        file.attrs['haz_type'] = haz.haz_type
+        file.attrs['units'] = haz.units
+        file.attrs['frequency_unit'] = getattr(haz, 'frequency_unit', '1/year')
+        file.attrs['crs'] = str(haz.centroids.crs)
+
+        cent = file.create_group('centroids')
+        gdf = haz.centroids.gdf
+        for name in gdf.columns:
+            if name not in ('geometry', 'lat', 'lon') and gdf[name].dtype.kind in 'biuf':
+                cent.create_dataset(name, data=gdf[name].to_numpy()[order])
+        cent.create_dataset('lat', data=np.asarray(haz.centroids.lat)[order])
+        cent.create_dataset('lon', data=np.asarray(haz.centroids.lon)[order])
+
+        events = file.create_group('events')
+        for name in EVENT_ATTRS:
+            value = getattr(haz, name, None)
+            if value is None or len(value) != n_events:
+                continue
+            value = np.asarray(value)
+            if value.dtype.kind in 'UO':
+                value = value.astype(h5py.string_dtype())
+            events.create_dataset(name, data=value)
+
+        for name in ['intensity', 'fraction']:
+            matrix = getattr(haz, name)
+            if matrix.shape != haz.intensity.shape:
+                matrix = sparse.csr_matrix(haz.intensity.shape)
+            _write_csc(file.create_group(name), matrix[:, order], profile,
+                       hazard_storage.quantization_scale(haz.haz_type, name))
+
+        index = file.create_group('regions')
+        index.create_dataset('region_id', data=regions)
+        index.create_dataset('start', data=start)
+        index.create_dataset('stop', data=stop)
+
+    return {'n_events': int(n_events), 'nnz': int(haz.intensity.nnz), 'n_regions': int(regions.size)}
+
+
+def write_region_layout(haz, path):
+    """
+    Write the region-sorted layout of a global hazard file written with
+    output_manifest.write_hdf5, atomically and recorded in the manifest with the
+    checksum of the global file.
+
+    Parameters:
+        haz (Hazard): The global hazard.
+        path (str): Path of the global hazard file.
+
+    Returns:
+        dict: Manifest entry of the layout.
+    """
+    source = read_manifest(path).get(os.path.basename(str(path)), {})
+    return write_atomic(region_layout_path(path), lambda tmp_path: write_region_sorted(haz, tmp_path),
+                        dict(hdf5_info(haz), source_sha256=source.get('sha256')))
+
+
+def region_ids(path):
+    """Region ids of a file in the region-sorted layout, with their number of centroids."""
+    with h5py.File(path, 'r') as file:
+        index = file['regions']
+        return dict(zip(index['region_id'][:].tolist(), (index['stop'][:] - index['start'][:]).tolist()))
+
+
+def read_events(file):
+    """Event attributes of an open file in the region-sorted layout."""
+    events = {}
+    for name, dset in file['events'].items():
+        value = dset[:]
+        events[name] = value.astype(str).tolist() if h5py.check_string_dtype(dset.dtype) else value
+    return events
+
+
+def make_hazard(file, cent_attrs, intensity, fraction, haz_class=Hazard, events=None):
+    """
+    Hazard on a subset of the centroids of an open file in the region-sorted layout.
+
+    Parameters:
+        file (h5py.File): File in the region-sorted layout.
+        cent_attrs (dict): Centroid attributes (lat, lon, region_id, ...) of the subset.
+        intensity, fraction (sparse.csr_matrix): Matrices on the subset (events x centroids).
+        haz_class (type): Class of the hazard to return, e.g. TropCyclone.
+        events (dict, optional): Event attributes, read from the file if None. Those not
+            accepted by Hazard.__init__ are set as attributes of the hazard.
+
+    Returns:
+        Hazard
+    """
+    events = read_events(file) if events is None else events
+    cent_attrs = dict(cent_attrs)
+    centroids = Centroids(lat=cent_attrs.pop('lat'), lon=cent_attrs.pop('lon'),
+                          crs=file.attrs['crs'], **cent_attrs)
+    haz = haz_class(
+        units=file.attrs['units'],
+        frequency_unit=file.attrs['frequency_unit'],
+        centroids=centroids,
+        intensity=intensity,
+        fraction=fraction,
+        **{name: value for name, value in events.items() if name in HAZARD_EVENT_ARGS},
+    )
+    haz.haz_type = file.attrs['haz_type']
+    for name, value in events.items():
+        if name not in HAZARD_EVENT_ARGS:
+            setattr(haz, name, value)
+    return haz
+
+
+def read_region(path, reg_id, haz_class=Hazard):
+    """
+    Read the hazard of one or several regions from a file in the region-sorted layout,
+    equivalent to haz.select(reg_id=reg_id) on the global hazard.
+
+    Parameters:
+        path (str): File in the region-sorted layout.
+        reg_id (int or list of int): Region id(s), e.g. the ISO numeric code of a country.
+        haz_class (type): Class of the hazard to return, e.g. TropCyclone.
+
+    Returns:
+        Hazard: Hazard with all events on the centroids of the regions, or None if none
+            of the regions is in the file.
+    """
+    reg_ids = np.atleast_1d(reg_id)
+    with h5py.File(path, 'r') as file:
+        index = file['regions']
+        regions = index['region_id'][:]
+        sel = np.isin(regions, reg_ids)
+        if not sel.any():
+            return None
+        ranges = sorted(zip(index['start'][:][sel].tolist(), index['stop'][:][sel].tolist()))
+
+        cent = file['centroids']
+        cent_attrs = {name: np.concatenate([cent[name][start:stop] for start, stop in ranges]) for name in cent}
+        n_events = file['intensity'].attrs['shape'][0]
+        haz = make_hazard(file, cent_attrs,
+                          read_csc_columns(file['intensity'], ranges, n_events).tocsr(),
+                          read_csc_columns(file['fraction'], ranges, n_events).tocsr(),
+                          haz_class)
+    return haz
+
+
+if __name__ == "__main__":
+    # Usage: python region_layout.py  (round trip of a synthetic TC-style hazard, with the
+    # TropCyclone event attributes category and basin, read back as a base Hazard)
+    import tempfile
+    from climada.hazard import TropCyclone
+
+    rng = np.random.default_rng(0)
+    n_events, n_centroids = 20, 500
+    region_id = rng.choice([4, 756, 840], n_centroids)
+    centroids = Centroids(lat=rng.uniform(-60, 60, n_centroids), lon=rng.uniform(-180, 180, n_centroids),
+                          region_id=region_id)
+    intensity = sparse.random(n_events, n_centroids, density=0.1, format='csr', random_state=0)
+    tc = TropCyclone(units='m/s', centroids=centroids, intensity=intensity, fraction=intensity.copy(),
+                     event_id=np.arange(1, n_events + 1), event_name=[f"tc{i}" for i in range(n_events)],
+                     date=np.full(n_events, 730000), frequency=np.ones(n_events), orig=np.ones(n_events, bool),
+                     category=rng.integers(0, 6, n_events), basin=['EP'] * n_events)
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        path = os.path.join(tmp_dir, 'tc_by_region.h5')
+        write_region_sorted(tc, path)
+        for haz_class in (Hazard, TropCyclone):
+            haz = read_region(path, 756, haz_class)
+            select = region_id == 756
+            assert (haz.intensity != intensity[:, select]).nnz == 0
+            assert np.array_equal(haz.category, tc.category) and list(haz.basin) == tc.basin
+            assert haz.haz_type == 'TC' and list(haz.event_name) == tc.event_name
+    print("region layout round trip of a TC-style hazard: ok")
@@ -2,16 +2,19 @@ import os
 import sys
 import glob
 import datetime
-from pathlib import Path
 
 # Add parent directory to sys.path to access config and utils
 sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
 
-from climada.hazard import Centroids
 from climada_petals.hazard.river_flood import RiverFlood
 from climada.util.api_client import Client
 from config import DATA_DIR
+from centroid_cache import load_centroids
 from create_log_file import log_msg
+from output_manifest import write_hdf5
+from region_layout import write_region_layout
+from instrumentation import timed
+import cli
 
 # Output file naming template
 OUT_FILE_NAME = 'river_flood_150arcsec_{scenario}_{years_str}.hdf5'
@@ -23,7 +26,8 @@ DATA_LINKS = {
     'ISIMIP2a': 'https://zenodo.org/record/4446364',
     'ISIMIP2b': 'https://zenodo.org/record/4627841',
 }
-def main(years=None, scenario='hist', aligned='litpop'):
+@timed('river_flood')
+def main(years=None, scenario='hist', aligned='litpop', region_layout=False):
     """
     Compute river flood hazard for a given year range and scenario, then save to file.
 
@@ -31,16 +35,14 @@ def main(years=None, scenario='hist', aligned='litpop'):
         years (list of int): Start and end year, e.g. [1980, 2010].
         scenario (str): Scenario name (e.g., 'hist', 'rcp85', etc.)
         aligned (str):  Which grid to align the centroids on land ('litpop' or 'climate_data').
+        region_layout (bool): If True, also write the region-sorted layout of the global file
+            (see region_layout.py) for fast country extraction.
     """
     # === Set up date-based folder and logging ===
     today = datetime.date.today()
     date_folder = today.strftime("%m_%Y")  # e.g. '03_2025'
     years_str = f"{years[0]}_{years[1]}"
     LOG_FILE = f"progress_make_river_flood_global_{scenario}_{date_folder}.txt"
-    log_path = Path(LOG_FILE)
-
-    if log_path.exists():
-        log_path.unlink()
 
     log_msg(f"Started computing floods for scenario '{scenario}' and years {years_str}\n", LOG_FILE)
 
@@ -52,12 +54,12 @@ def main(years=None, scenario='hist', aligned='litpop'):
 
     # === Set centroids ===
     if aligned == "litpop":
-        centroids = Centroids.from_hdf5(os.path.join(
+        centroids = load_centroids(os.path.join(
             DATA_DIR, 'centroids', DATE_CENTROIDS,
             'earth_centroids_150asland_1800asoceans_distcoast_region_litpop_aligned.hdf5'))
         out_file_name_template = OUT_FILE_NAME_LP_GRID
     elif aligned == 'climate_data':
-        centroids = Centroids.from_hdf5(os.path.join(
+        centroids = load_centroids(os.path.join(
             DATA_DIR, 'centroids', DATE_CENTROIDS,
             'earth_centroids_150asland_1800asoceans_distcoast_region.hdf5'))
         out_file_name_template = OUT_FILE_NAME
@@ -92,18 +94,19 @@ def main(years=None, scenario='hist', aligned='litpop'):
     if rf_list:
         rf_concat = rf.concat(rf_list)
         rf_concat.frequency = rf_concat.frequency / len(rf_list)
-        rf_concat.write_hdf5(out_file)
+        write_hdf5(rf_concat, out_file)
+        if region_layout:
+            write_region_layout(rf_concat, out_file)
         log_msg(f"Completed flood hazard for scenario '{scenario}' and years {years_str}\n", LOG_FILE)
     else:
         log_msg(f"No flood data was processed successfully for scenario '{scenario}' and years {years_str}\n", LOG_FILE)
 
 if __name__ == "__main__":
-    if len(sys.argv) < 4:
-        print("Usage: python compute_river_flood.py <start_year> <end_year> <scenario>")
-        sys.exit(1)
-
-    start_year = int(sys.argv[1])
-    end_year = int(sys.argv[2])
-    scenario = sys.argv[3]
-
-    main(years=[start_year, end_year], scenario=scenario)
+    cli.run(lambda start_year, end_year, scenario, region_layout: main(
+                years=[start_year, end_year], scenario=scenario, region_layout=region_layout),
+            'river_flood', [
+                ('start_year', int, cli.REQUIRED, "First year"),
+                ('end_year', int, cli.REQUIRED, "End year (excluded)"),
+                ('scenario', str, cli.REQUIRED, "Scenario, e.g. hist or rcp26"),
+                ('region_layout', cli.boolean, False, "Also write the region-sorted layout of the global file"),
+            ], description="Compute the global river flood hazard of a scenario and period.")
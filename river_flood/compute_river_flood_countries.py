@@ -1,6 +1,5 @@
 import os
 import sys
-from pathlib import Path
 
 import numpy as np
 
@@ -12,7 +11,13 @@ sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
 
 from config import DATA_DIR
 from create_log_file import log_msg
+from output_manifest import is_complete, write_hdf5
+from hazard_storage import read_hazard
+from region_layout import current_region_layout, read_region
+from instrumentation import timed
+import cli
 
+@timed('river_flood_countries')
 def main(years=None, scenario='rcp26', replace=True):
     """
     Process river flood hazard data from global to individual country scale.
@@ -36,8 +41,13 @@ def main(years=None, scenario='rcp26', replace=True):
     log_msg(f"Reading global flood files for scenario '{scenario}' and years {years_str}\n", LOG_FILE)
 
     for file in os.listdir(global_path):
+        if not file.endswith('.hdf5'):
+            continue  # e.g. the manifest
         file_path = os.path.join(global_path, file)
-        rf = RiverFlood.from_hdf5(file_path)
+        # read the countries from the region-sorted layout if there is one
+        region_file = current_region_layout(file_path)
+        if region_file is None:
+            rf = read_hazard(file_path, RiverFlood)
 
         file_parts = file.split('_', 4)  # Example: river_flood_150arcsec_rcp26_2010_2030.hdf5
 
@@ -45,24 +55,27 @@ def main(years=None, scenario='rcp26', replace=True):
         country_file_name = f"{file_parts[0]}_{file_parts[1]}_{file_parts[2]}_{file_parts[3]}_{country.alpha_3}_{file_parts[4]}"
         country_file_path = os.path.join(country_path, country_file_name)
 
-        if Path(country_file_path).exists() and not replace:
+        if is_complete(country_file_path) and not replace:
             continue
 
         try:
-            rf_country = rf.select(reg_id=int(country.numeric))
+            if region_file is None:
+                rf_country = rf.select(reg_id=int(country.numeric))
+            else:
+                rf_country = read_region(region_file, int(country.numeric), RiverFlood)
         except RuntimeError:
             continue
         if rf_country is None:
             continue
 
-        rf_country.write_hdf5(country_file_path)
+        write_hdf5(rf_country, country_file_path)
         log_msg(f"Saved {country.alpha_3} flood file.\n", LOG_FILE)
 
 
 if __name__ == "__main__":
-
-    start_year = sys.argv[1]
-    end_year = sys.argv[2]
-    scenario = sys.argv[3]
-
-    main(years=[start_year, end_year], scenario=scenario)
+    cli.run(lambda start_year, end_year, scenario: main(years=[start_year, end_year], scenario=scenario),
+            'river_flood_countries', [
+                ('start_year', int, cli.REQUIRED, "First year"),
+                ('end_year', int, cli.REQUIRED, "End year"),
+                ('scenario', str, cli.REQUIRED, "Scenario, e.g. hist or rcp26"),
+            ], description="Split the global river flood hazard into country files.")
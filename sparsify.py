@@ -0,0 +1,124 @@
+"""
+Minimum-intensity sparsification of hazards.
+
+The windfields of TropCyclone.from_tracks keep every centroid above the threshold of
+CLIMADA (17.5 m/s), while winds below the damage threshold of the impact functions never
+cause damage. They dominate the number of non-zero entries, the file size and the cost
+of all later select and append calls. sparsify removes the entries of the intensity (and
+the same entries of the fraction) below a floor, right after the hazard is computed, such
+that all later stages inherit the smaller matrices. The events are kept, with all their
+attributes.
+
+The floor is given per hazard type in MIN_INTENSITY ('default') or as a number, e.g.
+min_intensity=default on the command line of 2_tc_genesis_basin.py or the STORM scripts.
+Note that the climate scenarios (3_tc_climate_change.py) scale the intensities of the
+historical hazard, hence the floor should stay below the damage threshold by the largest
+intensification: the default TC floor is the damage threshold divided by MAX_INTENSIFICATION.
+
+Each sparsified hazard is recorded in the event log (stage 'sparsify').
+
+Usage: python sparsify.py [<log_dir>]  (prints the report of the removed entries)
+"""
+import sys
+
+import numpy as np
+
+from instrumentation import LOG_DIR, log_event, read_events
+
+TC_DAMAGE_THRESHOLD = 25.7  # m/s, damage threshold of the Emanuel (2011) impact functions
+# largest intensification of the climate scenarios of 3_tc_climate_change.py (upper estimates
+# of the change of the TC intensity of Knutson et al. 2020, about +10%)
+MAX_INTENSIFICATION = 1.1
+# floor of the intensity by hazard type, in the units of the hazard
+MIN_INTENSITY = {
+    'TC': round(TC_DAMAGE_THRESHOLD / MAX_INTENSIFICATION, 1),  # m/s, 23.4
+}
+
+
+def min_intensity(haz_type, value):
+    """
+    Floor of the intensity of a hazard type.
+
+    Parameters:
+        haz_type (str): Hazard type, e.g. 'TC'.
+        value (float, str or None): Floor, 'default' for MIN_INTENSITY[haz_type], or None
+            for no floor.
+
+    Returns:
+        float or None
+    """
+    if value is None:
+        return None
+    if value == 'default':
+        return MIN_INTENSITY[haz_type]
+    return float(value)
+
+
+def floor_arg(value):
+    """Command line value of a floor: a number, 'default' or 'none'."""
+    if value.lower() == 'none':
+        return None
+    return value if value == 'default' else float(value)
+
+
+def sparsify(haz, floor, unit=None):
+    """
+    Remove the entries of the intensity below a floor, and the same entries of the
+    fraction, in place.
+
+    Parameters:
+        haz (Hazard): Hazard to sparsify.
+        floor (float, str or None): Floor of the intensity (see min_intensity). Nothing is
+            removed if None.
+        unit (str, optional): Unit of work recorded in the event log, e.g. the file name.
+
+    Returns:
+        dict: Floor, non-zero entries before and after, and the estimated bytes removed
+            from the file (intensity and fraction, uncompressed).
+    """
+    floor = min_intensity(haz.haz_type, floor)
+    intensity = haz.intensity.tocsr()
+    nnz_before = intensity.nnz
+    if floor is not None:
+        keep = np.abs(intensity.data) >= floor
+        if not keep.all():
+            if haz.fraction.shape == intensity.shape:
+                mask = intensity.copy()
+                mask.data = keep.astype(haz.fraction.dtype)
+                mask.eliminate_zeros()
+                haz.fraction = haz.fraction.tocsr().multiply(mask).tocsr()
+            intensity = intensity.copy()
+            intensity.data[~keep] = 0
+            intensity.eliminate_zeros()
+    haz.intensity = intensity
+    removed = nnz_before - intensity.nnz
+    entry_bytes = intensity.data.itemsize + intensity.indices.itemsize
+    stats = {'min_intensity': floor, 'nnz_before': int(nnz_before), 'nnz_after': int(intensity.nnz),
+             'bytes_removed': int(removed * entry_bytes * (2 if haz.fraction.shape == intensity.shape else 1))}
+    log_event('sparsify', unit, haz_type=haz.haz_type, **stats)
+    return stats
+
+
+def report(log_dir=LOG_DIR):
+    """
+    Removed entries of all sparsified hazards of the event logs.
+
+    Returns:
+        pd.DataFrame: Per hazard type and floor: number of hazards, non-zero entries before
+            and after, share removed and estimated bytes removed.
+    """
+    events = read_events(log_dir)
+    if events.empty or 'stage' not in events:
+        return events
+    events = events[events['stage'] == 'sparsify']
+    if events.empty:
+        return events
+    result = events.groupby(['haz_type', 'min_intensity'], dropna=False).agg(
+        n_hazards=('nnz_before', 'size'), nnz_before=('nnz_before', 'sum'),
+        nnz_after=('nnz_after', 'sum'), bytes_removed=('bytes_removed', 'sum'))
+    result['share_removed'] = (1 - result['nnz_after'] / result['nnz_before']).round(3)
+    return result
+
+
+if __name__ == "__main__":
+    print(report(sys.argv[1] if len(sys.argv) > 1 else LOG_DIR))
@@ -0,0 +1,363 @@
+"""
+Local HTTP server of country and bounding-box subsets of the global hazards.
+
+Instead of pre-exporting one file per country for every scenario, year and number of
+tracks, the subsets are extracted on request from the region-sorted layout of the global
+files (see region_layout.py). The server keeps the files open and caches the decoded
+column blocks of the intensity and fraction (BLOCK_COLUMNS centroids each) in an LRU
+cache of bounded size, such that repeated and neighbouring requests do not read from
+disk again. The number of concurrent extractions is bounded, further requests wait up
+to QUEUE_TIMEOUT seconds and are answered with 503 otherwise.
+
+Endpoints:
+    GET /hazards                               Region-sorted files below the root directory.
+    GET /subset?file=<path>&reg_id=756,438     Hazard of the regions (e.g. ISO numeric codes).
+    GET /subset?file=<path>&bbox=lon_min,lat_min,lon_max,lat_max
+                                               Hazard of the centroids within the box
+                                               (lon_min > lon_max crosses the antimeridian).
+    GET /metrics                               Request counts and latencies, cache statistics.
+
+The subsets are returned as CLIMADA HDF5 files written with the storage profile of
+HAZARD_STORAGE (see hazard_storage.py), readable with read_hazard or, for float64 and
+float32, with e.g. TropCyclone.from_hdf5.
+<path> is the path of the file relative to the root directory, as listed by /hazards.
+
+Usage: python subset_server.py [<root> [<port> [<cache_mb> [<max_concurrent>]]]]
+Example: curl -o CHE.hdf5 'http://127.0.0.1:8765/subset?file=...&reg_id=756'
+"""
+import os
+import json
+import time
+import tempfile
+import threading
+from contextlib import contextmanager
+from collections import OrderedDict, defaultdict, deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+import h5py
+import numpy as np
+from scipy import sparse
+
+from config import DATA_DIR
+from instrumentation import log_event
+from hazard_storage import write_stored
+import cli
+from region_layout import LAYOUT_NAME, make_hazard, read_csc_columns, read_events
+
+BLOCK_COLUMNS = 8192  # centroids per cached column block
+QUEUE_TIMEOUT = 60  # seconds a request waits for a free extraction slot
+LATENCY_WINDOW = 1000  # latencies per endpoint kept for the percentiles
+LAYOUT_SUFFIX = '_by_region.h5'
+
+
+class BlockCache:
+    """Thread-safe LRU cache of decoded column blocks, bounded by their size in bytes."""
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.n_bytes = 0
+        self.hits = self.misses = self.evictions = 0
+        self._blocks = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, load):
+        """Block of key, loaded with load() if it is not cached."""
+        with self._lock:
+            block = self._blocks.get(key)
+            if block is not None:
+                self._blocks.move_to_end(key)
+                self.hits += 1
+                return block
+            self.misses += 1
+        block = load()
+        size = block.data.nbytes + block.indices.nbytes + block.indptr.nbytes
+        with self._lock:
+            if key not in self._blocks:
+                self._blocks[key] = block
+                self.n_bytes += size
+            while self.n_bytes > self.max_bytes and len(self._blocks) > 1:
+                _, old = self._blocks.popitem(last=False)
+                self.n_bytes -= old.data.nbytes + old.indices.nbytes + old.indptr.nbytes
+                self.evictions += 1
+        return block
+
+    def drop(self, path, stat=None):
+        """
+        Remove the blocks of a file (keys start with the path and its stat key), e.g. after it
+        was rewritten, of all its versions or of the version with the given stat key.
+        """
+        with self._lock:
+            for key in [key for key in self._blocks if key[0] == path and stat in (None, key[1])]:
+                old = self._blocks.pop(key)
+                self.n_bytes -= old.data.nbytes + old.indices.nbytes + old.indptr.nbytes
+
+    def stats(self):
+        with self._lock:
+            return {'n_blocks': len(self._blocks), 'size_mb': round(self.n_bytes / 2**20, 1),
+                    'max_mb': round(self.max_bytes / 2**20, 1), 'hits': self.hits,
+                    'misses': self.misses, 'evictions': self.evictions}
+
+
+class LayoutFile:
+    """
+    An open file in the region-sorted layout, with its centroids, regions and events in memory.
+    The file is closed once it was retired (rewritten) and the requests using it finished.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.stat = _stat_key(path)
+        self.users = 0  # requests using the file, counted under the lock of the server
+        self.retired = False
+        self.file = h5py.File(path, 'r')
+        if self.file.attrs.get('layout') != LAYOUT_NAME:
+            self.file.close()
+            raise ValueError(f"not in the region-sorted layout: {path}")
+        self.centroids = {name: dset[:] for name, dset in self.file['centroids'].items()}
+        index = self.file['regions']
+        self.regions = {reg: (start, stop) for reg, start, stop in
+                        zip(index['region_id'][:].tolist(), index['start'][:].tolist(), index['stop'][:].tolist())}
+        self.events = read_events(self.file)
+        self.n_events, self.n_centroids = (int(size) for size in self.file['intensity'].attrs['shape'])
+        self.lock = threading.Lock()  # h5py reads of one file are serialised anyway
+
+    def columns(self, reg_ids=None, bbox=None):
+        """Sorted columns of the regions or of the centroids within the bounding box."""
+        if reg_ids is not None:
+            ranges = [self.regions[reg] for reg in reg_ids if reg in self.regions]
+            if not ranges:
+                return np.zeros(0, np.int64)
+            return np.concatenate([np.arange(start, stop) for start, stop in sorted(ranges)])
+        lon_min, lat_min, lon_max, lat_max = bbox
+        lat, lon = self.centroids['lat'], self.centroids['lon']
+        in_lon = (lon >= lon_min) & (lon <= lon_max) if lon_min <= lon_max else (lon >= lon_min) | (lon <= lon_max)
+        return np.flatnonzero(in_lon & (lat >= lat_min) & (lat <= lat_max))
+
+    def read_block(self, name, block):
+        start = block * BLOCK_COLUMNS
+        with self.lock:
+            return read_csc_columns(self.file[name], [(start, min(start + BLOCK_COLUMNS, self.n_centroids))],
+                                    self.n_events)
+
+    def matrix(self, name, columns, cache):
+        """Columns of the intensity or fraction (CSR), assembled from cached column blocks."""
+        blocks = columns // BLOCK_COLUMNS
+        parts = []
+        for block in np.unique(blocks):
+            # the stat key of the file in the key: blocks of a rewritten file are never served
+            data = cache.get((self.path, self.stat, name, int(block)), lambda: self.read_block(name, int(block)))
+            parts.append(data[:, columns[blocks == block] - block * BLOCK_COLUMNS])
+        return sparse.hstack(parts, format='csr')
+
+    def subset(self, columns, cache):
+        """Hazard on the given columns."""
+        cent_attrs = {name: values[columns] for name, values in self.centroids.items()}
+        return make_hazard(self.file, cent_attrs, self.matrix('intensity', columns, cache),
+                           self.matrix('fraction', columns, cache), events=self.events)
+
+    def close(self):
+        self.file.close()
+
+
+def _stat_key(path):
+    stat = os.stat(path)
+    return stat.st_ino, stat.st_size, stat.st_mtime_ns
+
+
+def _parse_floats(value, n):
+    values = [float(item) for item in value.split(',')]
+    if len(values) != n:
+        raise ValueError(f"expected {n} comma-separated numbers: {value}")
+    return values
+
+
+class SubsetServer(ThreadingHTTPServer):
+    """HTTP server holding the open layout files, the block cache and the metrics."""
+
+    daemon_threads = True
+
+    def __init__(self, address, root, cache_mb, max_concurrent):
+        super().__init__(address, SubsetHandler)
+        self.root = os.path.realpath(root)
+        self.cache = BlockCache(cache_mb * 2**20)
+        self.slots = threading.BoundedSemaphore(max_concurrent)
+        self.max_concurrent = max_concurrent
+        self.in_flight = 0
+        self._files = {}
+        self._lock = threading.Lock()
+        self._latencies = defaultdict(lambda: deque(maxlen=LATENCY_WINDOW))
+        self._counts = defaultdict(lambda: defaultdict(int))
+        self.started = time.time()
+
+    @contextmanager
+    def layout_file(self, rel_path):
+        """
+        Open layout file of a path relative to the root, reopened if it was rewritten. The
+        previous layout of a rewritten file is closed when the last request using it exits.
+        """
+        path = os.path.realpath(os.path.join(self.root, rel_path))
+        if os.path.commonpath([path, self.root]) != self.root or not path.endswith(LAYOUT_SUFFIX):
+            raise PermissionError(rel_path)
+        if not os.path.isfile(path):
+            raise FileNotFoundError(rel_path)
+        with self._lock:
+            layout = self._files.get(path)
+            if layout is not None and layout.stat != _stat_key(path):
+                self._retire(self._files.pop(path))
+                layout = None
+            if layout is None:
+                layout = self._files[path] = LayoutFile(path)
+            layout.users += 1
+        try:
+            yield layout
+        finally:
+            with self._lock:
+                layout.users -= 1
+                if layout.retired and layout.users == 0:
+                    self._close(layout)
+
+    def _retire(self, layout):
+        """Close a layout that is no longer served, once its requests finished (under the lock)."""
+        layout.retired = True
+        if layout.users == 0:
+            self._close(layout)
+
+    def _close(self, layout):
+        # blocks cached by the requests that were reading the retired layout
+        self.cache.drop(layout.path, layout.stat)
+        layout.close()
+
+    def list_files(self):
+        return sorted(os.path.relpath(os.path.join(root, name), self.root)
+                      for root, _, names in os.walk(self.root) for name in names
+                      if name.endswith(LAYOUT_SUFFIX))
+
+    def busy(self, change):
+        with self._lock:
+            self.in_flight += change
+
+    def record(self, endpoint, status, latency):
+        with self._lock:
+            self._latencies[endpoint].append(latency)
+            self._counts[endpoint][status] += 1
+
+    def metrics(self):
+        with self._lock:
+            requests = {}
+            for endpoint, latencies in self._latencies.items():
+                latencies = np.array(latencies) * 1000
+                requests[endpoint] = dict(
+                    counts={str(status): count for status, count in self._counts[endpoint].items()},
+                    latency_ms={'p50': round(float(np.percentile(latencies, 50)), 1),
+                                'p95': round(float(np.percentile(latencies, 95)), 1),
+                                'p99': round(float(np.percentile(latencies, 99)), 1),
+                                'max': round(float(latencies.max()), 1)})
+            open_files = len(self._files)
+        return {'uptime_s': round(time.time() - self.started), 'in_flight': self.in_flight,
+                'max_concurrent': self.max_concurrent, 'open_files': open_files,
+                'cache': self.cache.stats(), 'requests': requests}
+
+
+class SubsetHandler(BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        start = time.perf_counter()
+        url = urlparse(self.path)
+        endpoint = url.path.rstrip('/') or '/'
+        query = {key: values[-1] for key, values in parse_qs(url.query).items()}
+        status, unit = 200, None
+        try:
+            if endpoint == '/hazards':
+                self._send_json(self.server.list_files())
+            elif endpoint == '/metrics':
+                self._send_json(self.server.metrics())
+            elif endpoint == '/subset':
+                unit = query.get('reg_id') or query.get('bbox')
+                status = self._subset(query)
+            else:
+                status = self._send_error(404, f"unknown endpoint {endpoint}")
+        except (KeyError, ValueError) as err:
+            status = self._send_error(400, f"bad request: {err}")
+        except PermissionError as err:
+            status = self._send_error(403, f"outside of the served files: {err}")
+        except FileNotFoundError as err:
+            status = self._send_error(404, f"no such file: {err}")
+        except Exception as err:  # keep serving, the error is reported to the client and logged
+            status = self._send_error(500, f"{type(err).__name__}: {err}")
+        latency = time.perf_counter() - start
+        self.server.record(endpoint if endpoint in ('/hazards', '/metrics', '/subset') else 'other', status, latency)
+        if endpoint == '/subset':
+            log_event('subset_server', unit, file=query.get('file'), status=status, wall_s=round(latency, 3))
+
+    def _subset(self, query):
+        if not self.server.slots.acquire(timeout=QUEUE_TIMEOUT):
+            return self._send_error(503, "too many concurrent requests")
+        try:
+            self.server.busy(+1)
+            with self.server.layout_file(query['file']) as layout:
+                if 'reg_id' in query:
+                    columns = layout.columns(reg_ids=[int(reg) for reg in query['reg_id'].split(',')])
+                else:
+                    columns = layout.columns(bbox=_parse_floats(query['bbox'], 4))
+                if columns.size == 0:
+                    return self._send_error(404, "no centroids in the requested subset")
+                haz = layout.subset(columns, self.server.cache)
+            with tempfile.TemporaryDirectory() as tmp_dir:
+                tmp_path = os.path.join(tmp_dir, 'subset.hdf5')
+                write_stored(haz, tmp_path)
+                with open(tmp_path, 'rb') as file:
+                    body = file.read()
+        finally:
+            self.server.busy(-1)
+            self.server.slots.release()
+        self._send(200, body, 'application/x-hdf5')
+        return 200
+
+    def _send(self, status, body, content_type):
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _send_json(self, obj, status=200):
+        self._send(status, json.dumps(obj, indent=1).encode(), 'application/json')
+
+    def _send_error(self, status, message):
+        self._send_json({'error': message}, status)
+        return status
+
+    def log_message(self, format, *args):
+        pass  # requests are recorded in the metrics and the event log
+
+
+def main(root=None, port=8765, cache_mb=1024, max_concurrent=4, host='127.0.0.1'):
+    """
+    Serve country and bounding-box subsets of the region-sorted global hazards.
+
+    Parameters:
+        root (str): Directory searched for region-sorted files (default: DATA_DIR).
+        port (int): Port of the server.
+        cache_mb (int): Maximum size of the cache of decoded column blocks in MB.
+        max_concurrent (int): Maximum number of concurrent extractions.
+        host (str): Interface to listen on (default: localhost only).
+    """
+    server = SubsetServer((host, port), root or DATA_DIR, cache_mb, max_concurrent)
+    print(f"Serving subsets of {server.root} on http://{host}:{server.server_address[1]}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == "__main__":
+    cli.run(main, 'subset_server', [
+        ('root', str, None, "Directory of the region-sorted global hazards (default: DATA_DIR)"),
+        ('port', int, 8765, "Port of the server"),
+        ('cache_mb', int, 1024, "Size of the cache of decoded column blocks in MB"),
+        ('max_concurrent', int, 4, "Maximum number of concurrent extractions"),
+        ('host', str, '127.0.0.1', "Interface to listen on"),
+    ], description="Serve country and bounding-box subsets of the global hazards over HTTP.")
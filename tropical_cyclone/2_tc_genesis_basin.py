@@ -1,15 +1,21 @@
 import os
 import sys
-from datetime import datetime
 from pathlib import Path
 
-from climada.hazard import Centroids, TropCyclone, TCTracks
+from climada.hazard import TropCyclone, TCTracks
 from pathos.pools import ProcessPool as Pool
 
 # Add parent directory to sys.path to access config and utils
 sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
 from config import DATA_DIR
+from centroid_cache import load_centroids
 from create_log_file import log_msg
+from instrumentation import timed
+import cli
+from output_manifest import is_complete, write_hdf5
+from merge_chunks import BackgroundMerge, main as merge_basin
+from pipeline import HIST_FILE_NAME, get_run_id
+from sparsify import floor_arg, sparsify
 
 # Path to precomputed centroids
 CENT_FILE_PATH = os.path.join(
@@ -19,11 +25,29 @@ CENT_FILE_PATH = os.path.join(
     "earth_centroids_150asland_1800asoceans_distcoast_region.hdf5"
 )
 
-def main(basin='EP', n_tracks=10, min_year=1980, max_year=2020, time_step_h=1):
+def main(basin='EP', n_tracks=10, min_year=1980, max_year=2020, time_step_h=1, min_intensity=None,
+         merge=None):
+    """
+    Compute the windfields of the synthetic tracks of a basin, in chunks of tracks.
+
+    Parameters:
+        basin (str): TC genesis basin code (e.g., 'EP').
+        n_tracks (int): Number of synthetic tracks per historical track.
+        min_year (int): Start year of the historical tracks.
+        max_year (int): End year of the historical tracks.
+        time_step_h (int): Not used.
+        min_intensity (float or str, optional): Floor of the wind speeds in m/s, 'default'
+            for the floor of sparsify.MIN_INTENSITY. No floor if None.
+        merge (str, optional): Merge the chunks into the historical basin file (see
+            merge_chunks.py) 'after' all chunks are computed, or in the 'background' while
+            the next chunks are computed. Not merged if None.
+    """
     LOG_FILE = "progress_make_tc_basin.txt"
+    if merge not in (None, 'after', 'background'):
+        raise ValueError(f"merge must be after or background, not {merge}")
     log_msg(f"Starting computing TC for basin {basin}.\n", LOG_FILE)
 
-    current_ym = datetime.now().strftime("%m_%Y")  
+    current_ym = get_run_id()
 
     # Define output directory (genesis files)
     output_dir = os.path.join(
@@ -51,9 +75,15 @@ def main(basin='EP', n_tracks=10, min_year=1980, max_year=2020, time_step_h=1):
     all_tracks = TCTracks.from_netcdf(path_tracks)
 
     # Load centroids and restrict to extent of track data
-    centroids = Centroids.from_hdf5(CENT_FILE_PATH)
+    centroids = load_centroids(CENT_FILE_PATH)
     centroids = centroids.select(extent=all_tracks.get_extent(5))
 
+    merger = None
+    if merge == 'background':
+        hist_file = os.path.join(output_dir, HIST_FILE_NAME.format(
+            tracks=f"{n_tracks}synth_tracks", basin=basin, start_year=min_year, end_year=max_year))
+        merger = BackgroundMerge(hist_file, year_range=(min_year, max_year))
+
     pool = Pool()
     chunk_size = 10  # Number of tracks per parallel job
 
@@ -65,7 +95,9 @@ def main(basin='EP', n_tracks=10, min_year=1980, max_year=2020, time_step_h=1):
         file_name = f"tropical_cyclone_{n_tracks}synth_tracks_150arcsec_genesis_{basin}_{min_year}_{max_year}_{n}.hdf5"
         file_path = Path(output_dir) / file_name
 
-        if file_path.exists():
+        if is_complete(file_path):
+            if merger:
+                merger.add(file_path)
             continue
 
         # Create a new TCTracks object and assign the selected subset
@@ -81,18 +113,30 @@ def main(basin='EP', n_tracks=10, min_year=1980, max_year=2020, time_step_h=1):
                 setattr(tracks, attr, getattr(all_tracks, attr))
 
         # Generate hazard and save
-        tc = TropCyclone.from_tracks(tracks, centroids=centroids, pool=pool)
-        tc.write_hdf5(file_path)
+        with timed('tc_genesis_basin', unit=f'{basin}_{n}'):
+            tc = TropCyclone.from_tracks(tracks, centroids=centroids, pool=pool)
+            stats = sparsify(tc, min_intensity, unit=f'{basin}_{n}')
+            write_hdf5(tc, file_path, min_intensity=stats['min_intensity'],
+                       nnz_removed=stats['nnz_before'] - stats['nnz_after'])
+        if merger:
+            merger.add(file_path)
 
     pool.close()
     pool.join()
 
+    if merger:
+        merger.finish()
+    elif merge == 'after':
+        merge_basin(basin, n_tracks, min_year, max_year, replace=True)
+
     log_msg(f"Finished computing TC for basin {basin}.\n", LOG_FILE)
 
 if __name__ == "__main__":
-    basin = sys.argv[1] if len(sys.argv) > 1 else 'EP'
-    n_tracks = int(sys.argv[2]) if len(sys.argv) > 2 else 10
-    min_year = int(sys.argv[3]) if len(sys.argv) > 3 else 1980
-    max_year = int(sys.argv[4]) if len(sys.argv) > 4 else 2020
-
-    main(basin, n_tracks, min_year, max_year)
+    cli.run(main, 'tc_genesis_basin', [
+        ('basin', str, 'EP', "Basin, e.g. EP"),
+        ('n_tracks', int, 10, "Number of synthetic tracks per historical track"),
+        ('min_year', int, 1980, "First year of the historical tracks"),
+        ('max_year', int, 2020, "Last year of the historical tracks"),
+        ('min_intensity', floor_arg, None, "Floor of the wind speeds in m/s, default or none"),
+        ('merge', str, None, "Merge the chunks into the basin file: after or background"),
+    ], description="Compute the windfields of the tracks of a basin in chunks.")
@@ -1,23 +1,17 @@
 import os
 import sys
 import numpy as np
-from datetime import datetime
 from climada.hazard import TropCyclone
 
 # Add parent directory to sys.path to access config and utils
 sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
 from config import DATA_DIR
 from create_log_file import log_msg
-
-from datetime import datetime
-
-
-import os
-import numpy as np
-from datetime import datetime
-from climada.hazard import TropCyclone
-from config import DATA_DIR
-from create_log_file import log_msg
+from instrumentation import timed
+import cli
+from pipeline import get_run_id
+from output_manifest import is_complete, write_hdf5
+from hazard_storage import read_hazard
 
 OUT_FILE_NAME = "tropical_cyclone_{tracks}_150arcsec_genesis_{basin}_{scenario}_{year}.hdf5"
 HIST_FILE_NAME = "tropical_cyclone_{tracks}_150arcsec_genesis_{basin}_{start_year}_{end_year}.hdf5"
@@ -40,7 +34,7 @@ def main(basin='EP', climate_scenarios=None, future_years=None, n_tracks=10, min
         climate_scenarios = [26, 45, 60, 85]
 
     LOG_FILE = "progress_make_tc_climate.txt"
-    current_ym = datetime.now().strftime("%m_%Y")  # e.g., "03_2025"
+    current_ym = get_run_id()  # e.g., "03_2025"
 
     # Define root output directory for this basin
     genesis_output_dir = os.path.join(
@@ -54,12 +48,12 @@ def main(basin='EP', climate_scenarios=None, future_years=None, n_tracks=10, min
     )
     hist_file_path = os.path.join(path_hist, file_name_hist)
 
-    if not os.path.exists(hist_file_path):
-        print(f"Error: Historical file {hist_file_path} not found. Ensure that compute_tc_genesis_basin.py has run successfully.")
+    if not is_complete(hist_file_path):
+        print(f"Error: Historical file {hist_file_path} not found or incomplete. Ensure that compute_tc_genesis_basin.py has run successfully.")
         return
 
     # Load historical TC hazard
-    tc_haz = TropCyclone.from_hdf5(hist_file_path)
+    tc_haz = read_hazard(hist_file_path, TropCyclone)
 
     for climate_scenario in climate_scenarios:
         for year in future_years:
@@ -70,26 +64,30 @@ def main(basin='EP', climate_scenarios=None, future_years=None, n_tracks=10, min
             os.makedirs(path_future, exist_ok=True)
 
             file_name_future = OUT_FILE_NAME.format(
-                tracks=f"{n_tracks}synth_tracks", basin=basin, scenario=climate_scenario, year=year
+                tracks=f"{n_tracks}synth_tracks", basin=basin, scenario=rcp_str, year=year
             )
             output_file = os.path.join(path_future, file_name_future)
 
-            if os.path.exists(output_file):
-                print(f"Warning: Output file {output_file} already exists.")
+            if is_complete(output_file):
+                print(f"Warning: Output file {output_file} already exists. Skipping.")
+                continue
 
             # Apply climate scenario transformation
-            scenario_str = f"{str(climate_scenario)[0]}.{str(climate_scenario)[1]}"
-            tc_haz_future = tc_haz.apply_climate_scenario_knu(target_year=year, scenario=scenario_str)
+            with timed('tc_climate_change', unit=f'{basin}_{rcp_str}_{year}'):
+                scenario_str = f"{str(climate_scenario)[0]}.{str(climate_scenario)[1]}"
+                tc_haz_future = tc_haz.apply_climate_scenario_knu(target_year=year, scenario=scenario_str)
 
-            # Save output
-            tc_haz_future.write_hdf5(output_file)
+                # Save output
+                write_hdf5(tc_haz_future, output_file)
             log_msg(f"Finished computing climate change for scenario {climate_scenario} and year {year}.\n", LOG_FILE)
 
 
 if __name__ == "__main__":
-    print(sys.argv)
-    basin = sys.argv[1] if len(sys.argv) > 1 else 'EP'
-    n_tracks = int(sys.argv[2]) if len(sys.argv) > 2 else 10
-    min_year = int(sys.argv[3]) if len(sys.argv) > 3 else 1980
-    max_year = int(sys.argv[4]) if len(sys.argv) > 4 else 2020
-    main(basin, n_tracks=n_tracks, min_year=min_year, max_year=max_year)
\ No newline at end of file
+    cli.run(main, 'tc_climate_change', [
+        ('basin', str, 'EP', "Basin, e.g. EP"),
+        ('n_tracks', int, 10, "Number of synthetic tracks per historical track"),
+        ('min_year', int, 1980, "First year of the historical tracks"),
+        ('max_year', int, 2020, "Last year of the historical tracks"),
+        ('climate_scenarios', cli.int_list, None, "RCP scenarios, e.g. 26,85"),
+        ('future_years', cli.int_list, None, "Future years, e.g. 2040,2060"),
+    ], description="Apply the climate change factors to the historical hazard of a basin.")
@@ -1,23 +1,32 @@
 import os
 import sys
 import numpy as np
-from datetime import datetime
 from climada.hazard import TropCyclone
+
+# Add parent directory to sys.path to access config and utils
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
 from config import DATA_DIR
 from create_log_file import log_msg
+from instrumentation import timed
+import cli
+from pipeline import get_run_id
+from output_manifest import write_hdf5
+from prefetch import AsyncWriter, prefetch_hazards
+from region_layout import write_region_layout
 
 # List of basins to concatenate
 BASINS = ['EP', 'WP', 'SP', 'NI', 'SI']  # Replace with your actual list
 
 # File naming templates
 FILE_NAME = "tropical_cyclone_{n_tracks}synth_tracks_150arcsec_genesis_{basin}_{scenario}_{year}.hdf5"
-FILE_NAME_HIST = "tropical_cyclone_{n_tracks}synth_tracks_150arcsec_genesis_{basin}_historical_{year}.hdf5"
+FILE_NAME_HIST = "tropical_cyclone_{n_tracks}synth_tracks_150arcsec_genesis_{basin}_{year}.hdf5"
 FILE_NAME_GLOBAL = "tropical_cyclone_{n_tracks}synth_tracks_150arcsec_genesis_global_{scenario}_{year}.hdf5"
 FILE_NAME_GLOBAL_HIST = "tropical_cyclone_{n_tracks}synth_tracks_150arcsec_genesis_global_historical_{year}.hdf5"
 
 LOG_FILE = "progress_concat_tc_genesis.txt"
 
-def main(climate_scenarios=None, n_tracks=10, years=None):
+@timed('tc_concat_basins')
+def main(climate_scenarios=None, n_tracks=10, years=None, region_layout=False):
     """
     Concatenate basin-level TC genesis files into global datasets, per scenario and year.
 
@@ -25,6 +34,8 @@ def main(climate_scenarios=None, n_tracks=10, years=None):
         climate_scenarios (list of str): List of scenarios, e.g., ['rcp26', 'rcp85', 'historical']
         n_tracks (int): Number of synthetic tracks (default: 10)
         years (list of str): Target years as strings, e.g., ['2040', '2060', '2080']
+        region_layout (bool): If True, also write the region-sorted layout of the global files
+            (see region_layout.py) for fast country extraction.
     """
     if climate_scenarios is None:
         climate_scenarios = ['rcp85']
@@ -32,81 +43,68 @@ def main(climate_scenarios=None, n_tracks=10, years=None):
         years = ['2040', '2060', '2080']
 
     tracks_str = f"{n_tracks}synth_tracks"
-    current_ym = datetime.now().strftime("%m_%Y")  # e.g. "03_2025"
-
-    for scenario in climate_scenarios:
-        for year in years:
-            log_msg(f"Starting concatenating basins for year {year} and scenario {scenario}\n", LOG_FILE)
-
-            tc = TropCyclone()
-            basin_base_path = os.path.join(DATA_DIR, 'tropical_cyclones', current_ym, 'genesis_basin', tracks_str)
-
-            # Read NI basin as the base
-            ni_path = os.path.join(basin_base_path, 'NI')
-            if scenario == 'historical':
-                tc_file = FILE_NAME_HIST.format(n_tracks=n_tracks, basin='NI', year=year)
-                tc_file_path = os.path.join(ni_path, scenario, tc_file)
-            else:
-                tc_file = FILE_NAME.format(n_tracks=n_tracks, basin='NI', year=year, scenario=scenario)
-                tc_file_path = os.path.join(ni_path, scenario, year, tc_file)
-
-            tc.read_hdf5(tc_file_path)
-            max_event_id = np.max(tc.event_id)
-
-            # Append other basins
-            for basin in BASINS:
-                if basin == 'NI':
-                    continue  # Already included
-
-                basin_path = os.path.join(basin_base_path, basin)
+    current_ym = get_run_id()  # e.g. "03_2025"
+    with AsyncWriter(max_pending=1) as writer:  # global hazards are large
+        for scenario in climate_scenarios:
+            for year in years:
+                log_msg(f"Starting concatenating basins for year {year} and scenario {scenario}\n", LOG_FILE)
+
+                basin_base_path = os.path.join(DATA_DIR, 'tropical_cyclones', current_ym, 'genesis_basin', tracks_str)
+
+                # NI basin first, as the base
+                basin_file_paths = []
+                for basin in ['NI'] + [basin for basin in BASINS if basin != 'NI']:
+                    basin_path = os.path.join(basin_base_path, basin)
+                    if scenario == 'historical':
+                        basin_file = FILE_NAME_HIST.format(n_tracks=n_tracks, basin=basin, year=year)
+                        basin_file_path = os.path.join(basin_path, scenario, basin_file)
+                    else:
+                        basin_file = FILE_NAME.format(n_tracks=n_tracks, basin=basin, year=year, scenario=scenario)
+                        basin_file_path = os.path.join(basin_path, scenario, year, basin_file)
+
+                        # Sanity check: only one file per directory
+                        basin_dir = os.path.join(basin_path, scenario, year)
+                        if basin != 'NI' and os.path.exists(basin_dir):
+                            all_files = [name for name in os.listdir(basin_dir) if name.endswith('.hdf5')]
+                            if len(all_files) > 1:
+                                raise ValueError(f"Multiple files found in {basin_dir}")
+                    basin_file_paths.append(basin_file_path)
+
+                # Append the other basins, the next files are read while appending
+                tc = None
+                for _, basin_tc in prefetch_hazards(basin_file_paths, TropCyclone):
+                    if tc is None:
+                        tc = basin_tc
+                        max_event_id = np.max(tc.event_id)
+                        continue
+                    basin_tc.event_id += max_event_id
+                    max_event_id = np.max(basin_tc.event_id)
+
+                    tc.append(basin_tc)
+
+                # Save global file in date-based directory
                 if scenario == 'historical':
-                    basin_file = FILE_NAME_HIST.format(n_tracks=n_tracks, basin=basin, year=year)
-                    basin_file_path = os.path.join(basin_path, scenario, basin_file)
+                    global_file = FILE_NAME_GLOBAL_HIST.format(n_tracks=n_tracks, scenario=scenario, year=year)
                 else:
-                    basin_file = FILE_NAME.format(n_tracks=n_tracks, basin=basin, year=year, scenario=scenario)
-                    basin_file_path = os.path.join(basin_path, scenario, year, basin_file)
-
-                    # Sanity check: only one file per directory
-                    basin_dir = os.path.join(basin_path, scenario, year)
-                    if os.path.exists(basin_dir):
-                        all_files = os.listdir(basin_dir)
-                        if len(all_files) > 1:
-                            raise ValueError(f"Multiple files found in {basin_dir}")
-
-                basin_tc = TropCyclone()
-                basin_tc.read_hdf5(basin_file_path)
-                basin_tc.event_id += max_event_id
-                max_event_id = np.max(basin_tc.event_id)
-
-                tc.append(basin_tc)
-
-            # Save global file in date-based directory
-            if scenario == 'historical':
-                global_file = FILE_NAME_GLOBAL_HIST.format(n_tracks=n_tracks, scenario=scenario, year=year)
-            else:
-                global_file = FILE_NAME_GLOBAL.format(n_tracks=n_tracks, scenario=scenario, year=year)
+                    global_file = FILE_NAME_GLOBAL.format(n_tracks=n_tracks, scenario=scenario, year=year)
 
-            global_output_dir = os.path.join(
-                DATA_DIR, 'tropical_cyclones', current_ym, 'genesis_basin', tracks_str, 'global', scenario, str(year)
-            )
-            os.makedirs(global_output_dir, exist_ok=True)
+                global_output_dir = os.path.join(
+                    DATA_DIR, 'tropical_cyclones', current_ym, 'genesis_basin', tracks_str, 'global', scenario, str(year)
+                )
+                os.makedirs(global_output_dir, exist_ok=True)
 
-            tc.write_hdf5(os.path.join(global_output_dir, global_file))
-            log_msg(f"Finished concatenating basins for year {year} and scenario {scenario}\n", LOG_FILE)
+                # written while the basins of the next scenario and year are read
+                global_file_path = os.path.join(global_output_dir, global_file)
+                writer.submit(write_hdf5, tc, global_file_path)
+                if region_layout:
+                    writer.submit(write_region_layout, tc, global_file_path)
+                log_msg(f"Finished concatenating basins for year {year} and scenario {scenario}\n", LOG_FILE)
 
 
 if __name__ == "__main__":
-    print(sys.argv)
-    scenario_input = sys.argv[1] if len(sys.argv) > 1 else 'rcp85'
-    n_tracks = int(sys.argv[2]) if len(sys.argv) > 2 else 10
-    year_input = sys.argv[3] if len(sys.argv) > 3 else '2040,2060,2080'
-
-    # Parse scenarios and years
-    scenarios = scenario_input.split(',')
-    years_list = year_input.split(',')
-
-    main(
-        climate_scenarios=scenarios,
-        n_tracks=n_tracks,
-        years=years_list
-    )
\ No newline at end of file
+    cli.run(main, 'tc_concat_basins', [
+        ('climate_scenarios', cli.str_list, ['rcp85'], "Scenarios, e.g. rcp26,rcp85 or historical"),
+        ('n_tracks', int, 10, "Number of synthetic tracks per historical track"),
+        ('years', cli.str_list, ['2040', '2060', '2080'], "Years, e.g. 2040,2060 (1980_2020 for historical)"),
+        ('region_layout', cli.boolean, False, "Also write the region-sorted layout of the global files"),
+    ], description="Concatenate the basin files to global files.")
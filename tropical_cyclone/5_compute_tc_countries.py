@@ -1,6 +1,5 @@
 import os
 import sys
-from datetime import datetime
 from pathlib import Path
 import argparse
 
@@ -11,12 +10,34 @@ from pycountry import countries
 sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
 from config import DATA_DIR
 from create_log_file import log_msg
+from instrumentation import timed
+import cli
+from pipeline import get_run_id
+from output_manifest import is_complete, write_hdf5
+from hazard_storage import read_hazard
+from prefetch import AsyncWriter, hazard_nbytes, prefetch, read_ahead
+from region_layout import current_region_layout, read_region
 
 # File naming templates
 FILE_NAME = 'tropical_cyclone_{n_tracks}synth_tracks_150arcsec_{scenario}_{country}_{year}.hdf5'
 FILE_NAME_HIST = 'tropical_cyclone_{n_tracks}synth_tracks_150arcsec_genesis_{scenario}_{country}_{year}.hdf5'
 LOG_FILE = 'progress_tc_country_downscaling.txt'
 
+
+def read_global(file_path):
+    """Region-sorted layout of a global file if there is one (the countries are read from it), the hazard otherwise."""
+    region_file = current_region_layout(file_path)
+    if region_file is None:
+        read_ahead(file_path)
+        return None, read_hazard(file_path, TropCyclone)
+    return region_file, None
+
+
+def global_nbytes(file_path):
+    """Memory of a global file once read by read_global."""
+    return 0 if current_region_layout(file_path) else hazard_nbytes(file_path)
+
+
 def main(years_list=None, scenarios=None, n_tracks=10, replace=True):
     if years_list is None:
         years_list = [2040, 2060, 2080]
@@ -24,67 +45,64 @@ def main(years_list=None, scenarios=None, n_tracks=10, replace=True):
         scenarios = [26, 45, 60, 85]
 
     tracks_str = f"{n_tracks}synth_tracks"
-    current_ym = datetime.now().strftime("%m_%Y")
+    current_ym = get_run_id()
     base_path = os.path.join(DATA_DIR, "tropical_cyclones", current_ym)
+    with AsyncWriter() as writer:
+        for scenario in scenarios:
+            if scenario == 'historical':
+                scenario_str = 'historical'
+                scenario_years = ['1980_2020']
+            else:
+                scenario_str = f"rcp{scenario}"
+                scenario_years = years_list
 
-    for scenario in scenarios:
-        if scenario == 'historical':
-            scenario_str = 'historical'
-            scenario_years = ['1980_2020']
-        else:
-            scenario_str = f"rcp{scenario}"
-            scenario_years = years_list
+            for year in scenario_years:
+                log_msg(f"Processing country-level files for {scenario_str} - {year}\n", LOG_FILE)
+
+                global_path = os.path.join(base_path, 'genesis_basin', tracks_str, 'global', scenario_str, str(year))
+
+                # Adjust output path: skip year subfolder for historical
+                if scenario == 'historical':
+                    output_path_base = os.path.join(base_path, 'countries', tracks_str, scenario_str)
+                else:
+                    output_path_base = os.path.join(base_path, 'countries', tracks_str, scenario_str, str(year))
+
+                os.makedirs(output_path_base, exist_ok=True)
+
+                # hdf5 files only (not e.g. the manifest), the next file is read while the countries
+                # of the current one are extracted
+                file_paths = [os.path.join(global_path, filename) for filename in os.listdir(global_path)
+                              if filename.endswith('.hdf5')]
+                for file_path, (region_file, tc) in prefetch(file_paths, read_global, size=global_nbytes):
+                    for country in countries:
+                        if scenario == 'historical':
+                            file_name = FILE_NAME_HIST.format(
+                                scenario=scenario_str, year=year, country=country.alpha_3, n_tracks=n_tracks
+                            )
+                        else:
+                            file_name = FILE_NAME.format(
+                                scenario=scenario_str, year=year, country=country.alpha_3, n_tracks=n_tracks
+                            )
+
+                        output_file = os.path.join(output_path_base, file_name)
+
+                        if is_complete(output_file) and not replace:
+                            continue
+
+                        with timed('tc_countries', unit=f'{scenario_str}_{year}_{country.alpha_3}'):
+                            if region_file is None:
+                                tc_country = tc.select(reg_id=int(country.numeric))
+                            else:
+                                tc_country = read_region(region_file, int(country.numeric), TropCyclone)
+                            if tc_country is None:
+                                continue
+
+                            writer.submit(write_hdf5, tc_country, output_file)
 
-        for year in scenario_years:
-            log_msg(f"Processing country-level files for {scenario_str} - {year}\n", LOG_FILE)
 
-            global_path = os.path.join(base_path, 'global', tracks_str, scenario_str, str(year))
-            
-            # Adjust output path: skip year subfolder for historical
-            if scenario == 'historical':
-                output_path_base = os.path.join(base_path, 'countries', tracks_str, scenario_str)
-            else:
-                output_path_base = os.path.join(base_path, 'countries', tracks_str, scenario_str, str(year))
-            
-            os.makedirs(output_path_base, exist_ok=True)
-
-            for filename in os.listdir(global_path):
-                file_path = os.path.join(global_path, filename)
-                tc = TropCyclone.from_hdf5(file_path)
-
-                for country in countries:
-                    if scenario == 'historical':
-                        file_name = FILE_NAME_HIST.format(
-                            scenario=scenario_str, year=year, country=country.alpha_3, n_tracks=n_tracks
-                        )
-                    else:
-                        file_name = FILE_NAME.format(
-                            scenario=scenario_str, year=year, country=country.alpha_3, n_tracks=n_tracks
-                        )
-
-                    output_file = os.path.join(output_path_base, file_name)
-
-                    if os.path.exists(output_file) and not replace:
-                        continue
-
-                    tc_country = tc.select(reg_id=int(country.numeric))
-                    if tc_country is None:
-                        continue
-
-                    tc_country.write_hdf5(output_file)
-                    
 if __name__ == "__main__":
-    print(sys.argv)
-    scenario_input = sys.argv[1] if len(sys.argv) > 1 else 'rcp85'
-    n_tracks = int(sys.argv[2]) if len(sys.argv) > 2 else 10
-    year_input = sys.argv[3] if len(sys.argv) > 3 else '2040,2060,2080'
-
-    # Split input
-    scenarios = scenario_input.split(',')
-    years_list = year_input.split(',')
-
-    main(
-        years_list=years_list,
-        scenarios=scenarios,
-        n_tracks=n_tracks
-    )
+    cli.run(main, 'tc_countries', [
+        ('scenarios', cli.str_list, ['rcp85'], "RCP scenarios (e.g. 26,85) or historical"),
+        ('n_tracks', int, 10, "Number of synthetic tracks per historical track"),
+        ('years_list', cli.str_list, ['2040', '2060', '2080'], "Future years, e.g. 2040,2060"),
+    ], description="Split the global files into country files.")
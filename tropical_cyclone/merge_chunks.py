@@ -0,0 +1,359 @@
+"""
+Merge of the chunk files of 2_tc_genesis_basin.py into the historical basin file.
+
+2_tc_genesis_basin.py writes the windfields of a basin in chunks of tracks
+(..._{min_year}_{max_year}_{n}.hdf5), while 3_tc_climate_change.py reads the whole basin
+(..._{min_year}_{max_year}.hdf5). The chunks are streamed in the order of their first
+track into one HDF5 hazard: the intensity and fraction of each chunk are appended to the
+data, indices and indptr of the merged matrices, and its event attributes to the event
+datasets, such that only one chunk is held in memory. The merged datasets are
+preallocated if all chunks are known in advance. All chunks must have the same centroids
+(compared by a checksum of their centroid datasets). A chunk without fraction (the empty
+0x0 matrix written by write_hdf5) adds events without fraction values. The event ids are
+renumbered continuously and the frequencies are set for the merged event set, as
+TropCyclone.from_tracks does for all tracks at once.
+
+The merge can also run in a background thread of 2_tc_genesis_basin.py (merge=background),
+adding each chunk as soon as it is written.
+
+Usage: python merge_chunks.py <basin> [<n_tracks> [<min_year> [<max_year>]]]
+"""
+import os
+import re
+import sys
+import hashlib
+import threading
+from queue import Queue
+
+import h5py
+import numpy as np
+
+# Add parent directory to sys.path to access config and utils
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+from config import DATA_DIR
+from create_log_file import log_msg
+from instrumentation import timed
+import cli
+import hazard_storage
+from output_manifest import atomic_output, is_complete
+from pipeline import HIST_FILE_NAME, get_run_id
+
+MATRICES = ['intensity', 'fraction']
+# datasets of the hazard that do not depend on the events
+HAZARD_ATTRS = ['haz_type', 'units', 'frequency_unit']
+LOG_FILE = "progress_merge_tc_chunks.txt"
+ORDINAL_1970 = 719163  # proleptic Gregorian ordinal of 1970-01-01
+
+
+def chunk_files(hist_dir, hist_file_name):
+    """
+    Chunk files of a historical basin file, in the order of their first track.
+
+    Parameters:
+        hist_dir (str): Directory of the historical basin file.
+        hist_file_name (str): Name of the historical basin file (..._{min_year}_{max_year}.hdf5).
+
+    Returns:
+        list of str: Paths of the chunk files (..._{min_year}_{max_year}_{n}.hdf5).
+    """
+    pattern = re.compile(re.escape(hist_file_name[:-len('.hdf5')]) + r'_(\d+)\.hdf5$')
+    chunks = []
+    for name in os.listdir(hist_dir):
+        match = pattern.match(name)
+        if match:
+            chunks.append((int(match.group(1)), os.path.join(hist_dir, name)))
+    return [path for _, path in sorted(chunks)]
+
+
+def centroids_checksum(file):
+    """sha256 of the datasets of the centroids group of an open hazard file."""
+    digest = hashlib.sha256()
+
+    def visit(name, obj):
+        if isinstance(obj, h5py.Dataset):
+            digest.update(name.encode())
+            digest.update(np.ascontiguousarray(obj[()]).tobytes() if obj.dtype.kind != 'O'
+                          else repr(obj[()].tolist()).encode())
+    file['centroids'].visititems(visit)
+    return digest.hexdigest()
+
+
+def _sizes(path):
+    """Number of events and non-zero entries of the matrices of a hazard file."""
+    with h5py.File(path, 'r') as file:
+        sizes = {name: file[name]['data'].shape[0] for name in MATRICES if name in file}
+        return int(file['intensity'].attrs['shape'][0]), sizes
+
+
+def _is_empty(group):
+    """True for the 0x0 matrix written for a hazard without fraction."""
+    return tuple(int(size) for size in group.attrs['shape']) == (0, 0)
+
+
+def _event_years(dates):
+    """Years of ordinal dates."""
+    days = (np.asarray(dates, dtype=np.int64) - ORDINAL_1970).astype('timedelta64[D]')
+    return (np.datetime64('1970-01-01') + days).astype('datetime64[Y]').astype(int) + 1970
+
+
+class ChunkMerger:
+    """
+    Streaming merge of hazard chunk files into one HDF5 hazard.
+
+    Example:
+        merger = ChunkMerger(tmp_path, totals=ChunkMerger.totals(paths))
+        for path in paths:
+            merger.add(path)
+        merger.close(year_range=(1980, 2020))
+    """
+
+    def __init__(self, path, totals=None):
+        """
+        Parameters:
+            path (str): Merged file to write.
+            totals (tuple, optional): Number of events and non-zero entries of each matrix
+                of all chunks (see totals), to preallocate the datasets. The datasets grow
+                with each chunk otherwise.
+        """
+        self.file = h5py.File(path, 'w')
+        self.totals = totals
+        self.n_events = 0
+        self.nnz = {}
+        self.n_chunks = 0
+        self.centroids = None
+        self._orig = []
+        self._dates = []
+
+    @staticmethod
+    def totals(paths):
+        """Number of events and non-zero entries of each matrix of chunk files."""
+        n_events, nnz = 0, {}
+        for path in paths:
+            chunk_events, chunk_nnz = _sizes(path)
+            n_events += chunk_events
+            for name, size in chunk_nnz.items():
+                nnz[name] = nnz.get(name, 0) + size
+        return n_events, nnz
+
+    def _create(self, group, name, src, size, dtype=None):
+        """Dataset of the merged file like the dataset src of the first chunk."""
+        compression = hazard_storage.default_profile()['compression']
+        dtype = dtype or src.dtype
+        if size is None:
+            dset = group.create_dataset(name, shape=(0,) + src.shape[1:], maxshape=(None,) + src.shape[1:],
+                                        dtype=dtype, chunks=True, **hazard_storage.dataset_filters(compression, 1))
+        else:
+            dset = group.create_dataset(name, shape=(size,) + src.shape[1:], dtype=dtype,
+                                        **hazard_storage.dataset_filters(compression, size))
+        dset.attrs.update(src.attrs)
+        return dset
+
+    def _append(self, dset, start, values):
+        stop = start + values.shape[0]
+        if dset.shape[0] < stop:
+            dset.resize(stop, axis=0)
+        if values.shape[0]:
+            dset[start:stop] = values
+
+    def add(self, path):
+        """Append the events of a chunk file."""
+        with h5py.File(path, 'r') as chunk:
+            checksum = centroids_checksum(chunk)
+            n_events = int(chunk['intensity'].attrs['shape'][0])
+            if self.n_chunks == 0:
+                self._first_chunk(chunk, checksum)
+            elif checksum != self.centroids:
+                raise ValueError(f"The centroids of {path} differ from those of the first chunk.")
+
+            for name in MATRICES:
+                if name not in chunk or name not in self.nnz:
+                    continue
+                src, dst = chunk[name], self.file[name]
+                start = self.nnz[name]
+                if _is_empty(src):
+                    # no fraction (0x0 matrix, as written by write_hdf5): no values in its events
+                    self._append(dst['indptr'], self.n_events + 1, np.full(n_events, start, np.int64))
+                    continue
+                if int(src.attrs['shape'][0]) != n_events or int(src.attrs['shape'][1]) != dst.attrs['shape'][1]:
+                    raise ValueError(f"The {name} of {path} does not match its events and centroids.")
+                self._append(dst['data'], start, src['data'][:])
+                self._append(dst['indices'], start, src['indices'][:])
+                indptr = src['indptr'][:].astype(np.int64)
+                self._append(dst['indptr'], self.n_events + 1, indptr[1:] + start)
+                self.nnz[name] = start + int(indptr[-1])
+
+            for name, dset in self._event_datasets.items():
+                self._append(dset, self.n_events, chunk[name][:])
+            self._orig.append(chunk['orig'][:] if 'orig' in chunk else np.ones(n_events, bool))
+            self._dates.append(chunk['date'][:] if 'date' in chunk else np.zeros(n_events, np.int64))
+        self.n_events += n_events
+        self.n_chunks += 1
+
+    def _first_chunk(self, chunk, checksum):
+        """Copy the centroids and hazard attributes of the first chunk, create the event and matrix datasets."""
+        self.centroids = checksum
+        self.file.attrs.update(chunk.attrs)
+        n_events, n_centroids = (int(size) for size in chunk['intensity'].attrs['shape'])
+        total_events, total_nnz = self.totals or (None, {})
+        self._event_datasets = {}
+        for name, obj in chunk.items():
+            if name in MATRICES and isinstance(obj, h5py.Group):
+                group = self.file.create_group(name)
+                group.attrs.update(obj.attrs)
+                if _is_empty(obj):  # merged as a matrix without values on the events and centroids
+                    group.attrs['shape'] = (n_events, n_centroids)
+                elif int(obj.attrs['shape'][0]) != n_events:
+                    raise ValueError(f"The {name} of the first chunk does not match its events.")
+                self._create(group, 'data', obj['data'], total_nnz.get(name))
+                self._create(group, 'indices', obj['indices'], total_nnz.get(name))
+                # int64 pointers, the merged matrix may exceed the int32 range of a chunk
+                indptr = self._create(group, 'indptr', obj['indptr'],
+                                      None if total_events is None else total_events + 1, dtype=np.int64)
+                self._append(indptr, 0, np.zeros(1, np.int64))
+                self.nnz[name] = 0
+            elif (isinstance(obj, h5py.Dataset) and name not in HAZARD_ATTRS and obj.shape
+                  and obj.shape[0] == n_events):
+                self._event_datasets[name] = self._create(self.file, name, obj, total_events)
+            else:
+                chunk.copy(obj, self.file, name=name)
+
+    def close(self, year_range=None):
+        """
+        Renumber the events, set their frequency and close the merged file.
+
+        Parameters:
+            year_range (tuple, optional): First and last year of the tracks, for the
+                frequency. Default: years of the event dates.
+
+        Returns:
+            dict: Information on the merged file for the manifest.
+        """
+        if self.n_chunks == 0:
+            self.file.close()
+            raise ValueError("No chunk to merge.")
+        for name in MATRICES:
+            if name in self.nnz:
+                shape = self.file[name].attrs['shape']
+                self.file[name].attrs['shape'] = (self.n_events, shape[1])
+        if 'event_id' in self.file:
+            self.file['event_id'][:] = np.arange(1, self.n_events + 1)
+        if 'frequency' in self.file:
+            # as TropCyclone.frequency_from_tracks: one over the number of years and the ensemble size
+            if year_range is None:
+                years = _event_years(np.concatenate(self._dates))
+                year_range = (years.min(), years.max())
+            n_orig = int(np.count_nonzero(np.concatenate(self._orig)))
+            ens_size = self.n_events / n_orig if n_orig else 1
+            self.file['frequency'][:] = 1 / ((year_range[1] - year_range[0] + 1) * ens_size)
+        info = {'n_events': self.n_events, 'nnz': self.nnz.get('intensity', 0), 'n_chunks': self.n_chunks}
+        self.file.close()
+        return info
+
+
+def merge_chunks(paths, out_file, year_range=None):
+    """
+    Merge chunk files into one hazard file, atomically and recorded in the manifest.
+
+    Parameters:
+        paths (list of str): Chunk files, in the order of their events.
+        out_file (str): Merged file.
+        year_range (tuple, optional): First and last year of the tracks (see ChunkMerger.close).
+
+    Returns:
+        dict: Manifest entry of the merged file.
+    """
+    with atomic_output(out_file) as (tmp_path, entry):
+        merger = ChunkMerger(tmp_path, totals=ChunkMerger.totals(paths))
+        try:
+            for path in paths:
+                merger.add(path)
+        except BaseException:
+            merger.file.close()
+            raise
+        entry.update(merger.close(year_range))
+    return entry
+
+
+class BackgroundMerge:
+    """
+    Merge chunk files in a background thread while the next chunks are computed. The
+    chunks must be added in the order of their events; the merged file is committed by
+    finish and discarded if a chunk fails.
+    """
+
+    def __init__(self, out_file, year_range=None):
+        self.out_file = out_file
+        self.year_range = year_range
+        self.entry = None
+        self.error = None
+        self._queue = Queue()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        try:
+            with atomic_output(self.out_file) as (tmp_path, entry):
+                merger = ChunkMerger(tmp_path)
+                try:
+                    for path in iter(self._queue.get, None):
+                        merger.add(path)
+                except BaseException:
+                    merger.file.close()
+                    raise
+                entry.update(merger.close(self.year_range))
+            self.entry = entry
+        except Exception as err:
+            self.error = err
+            # keep consuming, such that add never blocks
+            for _ in iter(self._queue.get, None):
+                pass
+
+    def add(self, path):
+        """Queue a chunk file that was completely written."""
+        self._queue.put(str(path))
+
+    def finish(self):
+        """Wait for the merge of the queued chunks and commit the merged file."""
+        self._queue.put(None)
+        self._thread.join()
+        if self.error is not None:
+            raise self.error
+        return self.entry
+
+
+@timed('tc_merge_chunks')
+def main(basin='EP', n_tracks=10, min_year=1980, max_year=2020, replace=False):
+    """
+    Merge the chunk files of a basin into its historical file.
+
+    Parameters:
+        basin (str): TC genesis basin code (e.g., 'EP').
+        n_tracks (int): Number of synthetic tracks per historical track.
+        min_year (int): Start year of the historical tracks.
+        max_year (int): End year of the historical tracks.
+        replace (bool): Merge again if the historical file is complete.
+    """
+    tracks_str = f"{n_tracks}synth_tracks"
+    hist_dir = os.path.join(DATA_DIR, 'tropical_cyclones', get_run_id(), 'genesis_basin', tracks_str,
+                            basin, 'historical')
+    hist_file_name = HIST_FILE_NAME.format(tracks=tracks_str, basin=basin, start_year=min_year, end_year=max_year)
+    out_file = os.path.join(hist_dir, hist_file_name)
+    if is_complete(out_file) and not replace:
+        log_msg(f"{out_file} is complete, not merged again.\n", LOG_FILE)
+        return
+    paths = chunk_files(hist_dir, hist_file_name)
+    incomplete = [path for path in paths if not is_complete(path)]
+    if incomplete:
+        raise RuntimeError(f"Incomplete chunk files, run 2_tc_genesis_basin.py first: {incomplete}")
+    entry = merge_chunks(paths, out_file, year_range=(min_year, max_year))
+    log_msg(f"Merged {len(paths)} chunks of basin {basin}: {entry['n_events']} events.\n", LOG_FILE)
+
+
+if __name__ == "__main__":
+    cli.run(main, 'tc_merge_chunks', [
+        ('basin', str, 'EP', "Basin, e.g. EP"),
+        ('n_tracks', int, 10, "Number of synthetic tracks per historical track"),
+        ('min_year', int, 1980, "First year of the historical tracks"),
+        ('max_year', int, 2020, "Last year of the historical tracks"),
+        ('replace', cli.boolean, False, "Merge again if the historical file is complete"),
+    ], description="Merge the chunk files of a basin into the historical basin file.")
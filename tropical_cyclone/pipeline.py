@@ -0,0 +1,388 @@
+"""
+pipeline.py
+
+Runner for the tropical cyclone chain 1_tc_tracks.py -> 2_tc_genesis_basin.py ->
+merge_chunks.py -> 3_tc_climate_change.py -> 4_tc_concat_basins.py -> 5_compute_tc_countries.py.
+
+Every node of the chain (a basin, a basin x scenario x year, ...) declares its command,
+its inputs and its outputs, and the dependencies between nodes follow from them. All
+nodes of a run share one run ID (passed to the scripts in the environment variable
+TC_RUN_ID) instead of the current month. A node is skipped if its outputs are complete (see output_manifest) and the
+content hash of its inputs did not change since it last succeeded, and independent nodes
+run concurrently under a CPU and memory budget. Rebuilding after the data of one basin
+changed thus only recomputes that basin and the nodes depending on it.
+
+Usage: python pipeline.py [--run-id 03_2025] [--cpus 8] [--mem-gb 200] [--dry-run true] [--worker true]
+"""
+
+import os
+import sys
+import json
+import glob
+import time
+import hashlib
+import subprocess
+from datetime import datetime
+
+# Add parent directory to sys.path to access config and utils
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+from config import DATA_DIR
+from create_log_file import log_msg
+from output_manifest import is_complete, read_manifest
+import cli
+
+RUN_ID_ENV = 'TC_RUN_ID'
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+WORKER_SCRIPT = os.path.join(os.path.dirname(SCRIPT_DIR), 'worker_daemon.py')
+BASINS = ['NI', 'SI', 'NA', 'SP', 'WP', 'SA', 'EP']
+CONCAT_BASINS = ['EP', 'WP', 'SP', 'NI', 'SI']  # basins concatenated by 4_tc_concat_basins.py
+CLIMATE_SCENARIOS = [26, 45, 60, 85]
+FUTURE_YEARS = [2040, 2060, 2080]
+LOG_FILE = "progress_tc_pipeline.txt"
+
+#resources of the nodes of each stage (cpus, memory in GB), as in the job files
+RESOURCES = {
+    'tracks': (1, 10),
+    'genesis': (4, 200),
+    'merge': (1, 20),
+    'climate': (1, 20),
+    'concat': (1, 20),
+    'countries': (1, 20),
+}
+
+HIST_FILE_NAME = "tropical_cyclone_{tracks}_150arcsec_genesis_{basin}_{start_year}_{end_year}.hdf5"
+FUTURE_FILE_NAME = "tropical_cyclone_{tracks}_150arcsec_genesis_{basin}_{scenario}_{year}.hdf5"
+GLOBAL_FILE_NAME = "tropical_cyclone_{tracks}_150arcsec_genesis_global_{scenario}_{year}.hdf5"
+
+
+def get_run_id():
+    """Run ID of the chain: TC_RUN_ID if set, otherwise the current month (e.g. 03_2025)."""
+    return os.environ.get(RUN_ID_ENV) or datetime.now().strftime("%m_%Y")
+
+
+def file_hash(path, cache):
+    """
+    Content hash of a file. Hashes are cached by (size, mtime), such that unchanged files
+    are not read again.
+
+    Parameters:
+        path (str): Path of the file.
+        cache (dict): Cache of path -> [size, mtime_ns, hash], updated in place.
+
+    Returns:
+        str: sha256 hex digest of the file.
+    """
+    stat = os.stat(path)
+    cached = cache.get(path)
+    if cached and cached[0] == stat.st_size and cached[1] == stat.st_mtime_ns:
+        return cached[2]
+    digest = hashlib.sha256()
+    with open(path, 'rb') as file:
+        for block in iter(lambda: file.read(1 << 23), b''):
+            digest.update(block)
+    cache[path] = [stat.st_size, stat.st_mtime_ns, digest.hexdigest()]
+    return cache[path][2]
+
+
+def spec_paths(spec):
+    """Files of an input/output spec: a file path or a (directory, glob pattern) tuple."""
+    if isinstance(spec, str):
+        return [spec] if os.path.isfile(spec) else []
+    return sorted(path for path in glob.glob(os.path.join(*spec)) if os.path.isfile(path))
+
+
+def spec_complete(spec):
+    """Whether an output spec was completely written, according to the manifests (see output_manifest)."""
+    if isinstance(spec, str):
+        return is_complete(spec)
+    paths = spec_paths(spec)
+    if not paths:
+        return False
+    if read_manifest(paths[0]):  # files recorded individually
+        return all(is_complete(path) for path in paths)
+    return is_complete(spec[0])  # directory written as a whole
+
+
+def spec_hash(spec, cache):
+    """Content hash of an input spec, None if it has no files."""
+    paths = spec_paths(spec)
+    if not paths:
+        return None
+    digest = hashlib.sha256()
+    for path in paths:
+        digest.update(f"{os.path.basename(path)}:{file_hash(path, cache)}\n".encode())
+    return digest.hexdigest()
+
+
+def make_node(name, stage, cmd, inputs=(), outputs=()):
+    """Node of the chain, with the resources of its stage."""
+    cpus, mem_gb = RESOURCES[stage]
+    return dict(name=name, cmd=[str(arg) for arg in cmd], inputs=list(inputs),
+                outputs=list(outputs), cpus=cpus, mem_gb=mem_gb)
+
+
+def build_nodes(run_id, basins=BASINS, n_tracks=10, min_year=1980, max_year=2020,
+                climate_scenarios=CLIMATE_SCENARIOS, future_years=FUTURE_YEARS):
+    """
+    Declare the nodes of the chain with their inputs and outputs.
+
+    Parameters:
+        run_id (str): Run ID of the chain.
+        basins (list of str): Genesis basins.
+        n_tracks (int): Number of synthetic tracks per historical track.
+        min_year (int): Start year of the historical period.
+        max_year (int): End year of the historical period.
+        climate_scenarios (list of int): Climate scenarios (e.g. [26, 45, 60, 85]).
+        future_years (list of int): Target years of the climate scenarios.
+
+    Returns:
+        list of dict: Nodes of the chain.
+    """
+    tracks_str = f"{n_tracks}synth_tracks"
+    base_path = os.path.join(DATA_DIR, 'tropical_cyclones', run_id)
+    genesis_path = os.path.join(base_path, 'genesis_basin', tracks_str)
+    hist_years = f"{min_year}_{max_year}"
+    py = sys.executable
+
+    def hist_file(basin):
+        return os.path.join(genesis_path, basin, 'historical', HIST_FILE_NAME.format(
+            tracks=tracks_str, basin=basin, start_year=min_year, end_year=max_year))
+
+    def global_file(scenario, year):
+        return os.path.join(genesis_path, 'global', scenario, str(year), GLOBAL_FILE_NAME.format(
+            tracks=tracks_str, scenario=scenario, year=year))
+
+    nodes = []
+    for basin in basins:
+        tracks = (os.path.join(base_path, 'tracks', hist_years, tracks_str, basin), '*')
+        chunks = (os.path.join(genesis_path, basin, 'historical'),
+                  HIST_FILE_NAME.format(tracks=tracks_str, basin=basin, start_year=min_year,
+                                        end_year=f"{max_year}_*"))
+        nodes.append(make_node(f"tracks_{basin}", 'tracks',
+                               [py, '1_tc_tracks.py', basin, n_tracks, min_year, max_year],
+                               outputs=[tracks]))
+        nodes.append(make_node(f"genesis_{basin}", 'genesis',
+                               [py, '2_tc_genesis_basin.py', basin, n_tracks, min_year, max_year],
+                               inputs=[tracks], outputs=[chunks]))
+        nodes.append(make_node(f"merge_{basin}", 'merge',
+                               [py, 'merge_chunks.py', basin, n_tracks, min_year, max_year, '--replace', 'true'],
+                               inputs=[chunks], outputs=[hist_file(basin)]))
+        for scenario in climate_scenarios:
+            for year in future_years:
+                future_file = os.path.join(genesis_path, basin, f"rcp{scenario}", str(year),
+                                           FUTURE_FILE_NAME.format(tracks=tracks_str, basin=basin,
+                                                                   scenario=f"rcp{scenario}", year=year))
+                nodes.append(make_node(f"climate_{basin}_rcp{scenario}_{year}", 'climate',
+                                       [py, '3_tc_climate_change.py', basin, n_tracks, min_year,
+                                        max_year, scenario, year],
+                                       inputs=[hist_file(basin)], outputs=[future_file]))
+
+    for scenario in climate_scenarios:
+        for year in future_years:
+            scen_str = f"rcp{scenario}"
+            inputs = [os.path.join(genesis_path, basin, scen_str, str(year), FUTURE_FILE_NAME.format(
+                tracks=tracks_str, basin=basin, scenario=scen_str, year=year)) for basin in CONCAT_BASINS]
+            nodes.append(make_node(f"concat_{scen_str}_{year}", 'concat',
+                                   [py, '4_tc_concat_basins.py', scen_str, n_tracks, year],
+                                   inputs=inputs, outputs=[global_file(scen_str, year)]))
+            nodes.append(make_node(f"countries_{scen_str}_{year}", 'countries',
+                                   [py, '5_compute_tc_countries.py', scenario, n_tracks, year],
+                                   inputs=[global_file(scen_str, year)],
+                                   outputs=[(os.path.join(base_path, 'countries', tracks_str, scen_str,
+                                                          str(year)), '*.hdf5')]))
+
+    nodes.append(make_node(f"concat_historical_{hist_years}", 'concat',
+                           [py, '4_tc_concat_basins.py', 'historical', n_tracks, hist_years],
+                           inputs=[hist_file(basin) for basin in CONCAT_BASINS],
+                           outputs=[global_file('historical', hist_years)]))
+    nodes.append(make_node(f"countries_historical_{hist_years}", 'countries',
+                           [py, '5_compute_tc_countries.py', 'historical', n_tracks, hist_years],
+                           inputs=[global_file('historical', hist_years)],
+                           outputs=[(os.path.join(base_path, 'countries', tracks_str, 'historical'),
+                                     '*.hdf5')]))
+    return nodes
+
+
+def node_dependencies(nodes):
+    """Map each node name to the names of the nodes producing its inputs."""
+    producers = {}
+    for node in nodes:
+        for spec in node['outputs']:
+            producers[_spec_key(spec)] = node['name']
+    return {node['name']: sorted({producers[_spec_key(spec)] for spec in node['inputs']
+                                  if _spec_key(spec) in producers})
+            for node in nodes}
+
+
+def _spec_key(spec):
+    return spec if isinstance(spec, str) else tuple(spec)
+
+
+def node_signature(node, cache):
+    """Hash of the command and input contents of a node, None if an input is missing."""
+    digest = hashlib.sha256(json.dumps(node['cmd'][1:]).encode())
+    for spec in node['inputs']:
+        spec_digest = spec_hash(spec, cache)
+        if spec_digest is None:
+            return None
+        digest.update(spec_digest.encode())
+    return digest.hexdigest()
+
+
+def load_state(state_file):
+    """Signatures of the nodes that succeeded and the file hash cache of a run."""
+    if os.path.exists(state_file):
+        with open(state_file) as file:
+            return json.load(file)
+    return {'nodes': {}, 'files': {}}
+
+
+def save_state(state, state_file):
+    """Write the state of a run atomically."""
+    tmp_file = state_file + '.tmp'
+    with open(tmp_file, 'w') as file:
+        json.dump(state, file)
+    os.replace(tmp_file, state_file)
+
+
+def run_nodes(nodes, run_id, cpus, mem_gb, state_file, log_dir, dry_run=False, poll_s=2, worker=False):
+    """
+    Run the nodes in dependency order, concurrently within the budget. Nodes whose
+    outputs exist and whose input hashes did not change are skipped.
+
+    Parameters:
+        nodes (list of dict): Nodes from build_nodes.
+        run_id (str): Run ID passed to the scripts.
+        cpus (int): CPU budget.
+        mem_gb (float): Memory budget in GB.
+        state_file (str): JSON file with the signatures of the nodes that succeeded.
+        log_dir (str): Directory of the output logs of the nodes.
+        dry_run (bool): If True, only report which nodes would run.
+        poll_s (float): Seconds between checks of the running nodes.
+        worker (bool): If True, run the scripts in the worker daemon (see worker_daemon.py),
+            or in new processes if it is not running.
+
+    Returns:
+        dict: Status of each node ('skipped', 'done', 'failed', 'blocked' or 'pending').
+    """
+    deps = node_dependencies(nodes)
+    state = load_state(state_file)
+    os.makedirs(log_dir, exist_ok=True)
+    env = dict(os.environ, **{RUN_ID_ENV: run_id})
+
+    status = {node['name']: 'pending' for node in nodes}
+    pending = list(nodes)
+    running = {}
+    free_cpus, free_mem = cpus, mem_gb
+    while pending or running:
+        for node in list(pending):
+            node_deps = [status[dep] for dep in deps[node['name']]]
+            if any(dep in ('failed', 'blocked') for dep in node_deps):
+                status[node['name']] = 'blocked'
+                pending.remove(node)
+                log_msg(f"Blocked {node['name']}: a dependency failed\n", LOG_FILE)
+                continue
+            if not all(dep in ('skipped', 'done') for dep in node_deps):
+                continue
+
+            signature = node_signature(node, state['files'])
+            if signature is None and not dry_run:
+                status[node['name']] = 'failed'
+                pending.remove(node)
+                log_msg(f"Failed {node['name']}: missing input\n", LOG_FILE)
+                continue
+            outputs_exist = all(spec_complete(spec) for spec in node['outputs'])
+            if outputs_exist and signature is not None and state['nodes'].get(node['name']) == signature:
+                status[node['name']] = 'skipped'
+                pending.remove(node)
+                continue
+            if dry_run:
+                status[node['name']] = 'done'
+                pending.remove(node)
+                log_msg(f"Would run {node['name']}: {' '.join(node['cmd'][1:])}\n", LOG_FILE)
+                continue
+
+            #nodes larger than the budget run alone
+            need_cpus, need_mem = min(node['cpus'], cpus), min(node['mem_gb'], mem_gb)
+            if need_cpus > free_cpus or need_mem > free_mem:
+                continue
+            free_cpus -= need_cpus
+            free_mem -= need_mem
+            log_file = open(os.path.join(log_dir, f"{node['name']}.log"), 'w')
+            cmd = node['cmd'][:1] + [WORKER_SCRIPT, 'run'] + node['cmd'][1:] if worker else node['cmd']
+            process = subprocess.Popen(cmd, cwd=SCRIPT_DIR, env=env,
+                                       stdout=log_file, stderr=subprocess.STDOUT)
+            running[node['name']] = (node, process, log_file, signature, time.time())
+            pending.remove(node)
+            log_msg(f"Started {node['name']}\n", LOG_FILE)
+
+        if not running:
+            break
+        time.sleep(poll_s)
+        for name, (node, process, log_file, signature, start) in list(running.items()):
+            if process.poll() is None:
+                continue
+            log_file.close()
+            free_cpus += min(node['cpus'], cpus)
+            free_mem += min(node['mem_gb'], mem_gb)
+            del running[name]
+            if process.returncode == 0 and all(spec_complete(spec) for spec in node['outputs']):
+                status[name] = 'done'
+                state['nodes'][name] = signature
+                save_state(state, state_file)
+                log_msg(f"Finished {name} in {time.time() - start:.1f}s\n", LOG_FILE)
+            else:
+                status[name] = 'failed'
+                log_msg(f"Failed {name} (return code {process.returncode}), see {log_dir}\n", LOG_FILE)
+
+    save_state(state, state_file)
+    return status
+
+
+def main(run_id=None, basins=BASINS, n_tracks=10, min_year=1980, max_year=2020,
+         climate_scenarios=CLIMATE_SCENARIOS, future_years=FUTURE_YEARS, cpus=None, mem_gb=None,
+         dry_run=False, worker=False):
+    """
+    Run the tropical cyclone chain for one run ID.
+
+    Parameters:
+        run_id (str): Run ID of the chain. Default: TC_RUN_ID or the current month.
+        basins (list of str): Genesis basins.
+        n_tracks (int): Number of synthetic tracks per historical track.
+        min_year (int): Start year of the historical period.
+        max_year (int): End year of the historical period.
+        climate_scenarios (list of int): Climate scenarios.
+        future_years (list of int): Target years of the climate scenarios.
+        cpus (int): CPU budget. Default: all cpus.
+        mem_gb (float): Memory budget in GB. Default: the physical memory.
+        dry_run (bool): If True, only report which nodes would run.
+        worker (bool): If True, run the scripts in the worker daemon.
+    """
+    run_id = run_id or get_run_id()
+    cpus = cpus or os.cpu_count()
+    mem_gb = mem_gb or os.sysconf('SC_PAGE_SIZE')*os.sysconf('SC_PHYS_PAGES')/1e9
+    run_dir = os.path.join(DATA_DIR, 'tropical_cyclones', run_id)
+    os.makedirs(run_dir, exist_ok=True)
+
+    nodes = build_nodes(run_id, basins, n_tracks, min_year, max_year, climate_scenarios, future_years)
+    log_msg(f"Running {len(nodes)} nodes of run {run_id} with {cpus} cpus and {mem_gb:.0f} GB\n", LOG_FILE)
+    status = run_nodes(nodes, run_id, cpus, mem_gb, os.path.join(run_dir, 'pipeline_state.json'),
+                       os.path.join(run_dir, 'logs'), dry_run=dry_run, worker=worker)
+    counts = {value: list(status.values()).count(value) for value in sorted(set(status.values()))}
+    log_msg(f"Finished run {run_id}: {counts}\n", LOG_FILE)
+
+
+if __name__ == "__main__":
+    cli.run(main, 'tc_pipeline', [
+        ('run_id', str, None, "Run ID, e.g. 03_2025. Default: TC_RUN_ID or the current month"),
+        ('basins', cli.str_list, BASINS, "Genesis basins, e.g. EP,WP"),
+        ('n_tracks', int, 10, "Number of synthetic tracks per historical track"),
+        ('min_year', int, 1980, "First year of the historical tracks"),
+        ('max_year', int, 2020, "Last year of the historical tracks"),
+        ('climate_scenarios', cli.int_list, CLIMATE_SCENARIOS, "RCP scenarios, e.g. 26,85"),
+        ('future_years', cli.int_list, FUTURE_YEARS, "Future years, e.g. 2040,2060"),
+        ('cpus', int, None, "CPU budget. Default: all cpus"),
+        ('mem_gb', float, None, "Memory budget in GB. Default: the physical memory"),
+        ('dry_run', cli.boolean, False, "Only report which nodes would run"),
+        ('worker', cli.boolean, False, "Run the scripts in the worker daemon"),
+    ], description="Run the tropical cyclone chain.")
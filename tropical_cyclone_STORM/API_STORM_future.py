@@ -11,14 +11,24 @@ import sys
 import os
 
 # import CLIMADA modules:
-from climada.hazard import Centroids, TCTracks, TropCyclone
+from climada.hazard import TCTracks, TropCyclone
 from climada.util.constants import SYSTEM_DIR
 
+# Add parent directory to sys.path to access config and utils
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+from centroid_cache import load_centroids
+from output_manifest import write_hdf5
+from instrumentation import timed
+import cli
+from sparsify import floor_arg, sparsify
+from storm_tracks import read_storm_tracks
+
 ############################################################################
 # i_file = ['CMCC-CM2-VHR4', 'CNRM-CM6-1-HR', 'EC-Earth3P-HR', 'HadGEM3-GC31-HM']
 # i_ens = range(10)
 # i_basin = ['EP', 'NA', 'NI', 'SI', 'SP', 'WP']
-def main(i_file, i_ens, i_basin):
+@timed('storm_future')
+def main(i_file, i_ens, i_basin, min_intensity=None, centroids=None):
     
     i_file = str(i_file)
     i_basin = str(i_basin)
@@ -32,7 +42,7 @@ def main(i_file, i_ens, i_basin):
     def init_STORM_tracks(i_file, i_ens, i_basin):
         """ Load STORM tracks for the basin, GCM of interest."""
         fname = f"STORM_DATA_{i_file}_{i_basin}_1000_YEARS_{i_ens}_IBTRACSDELTA.txt"
-        tracks_STORM = TCTracks.from_simulations_storm(os.path.join(storm_dir, fname))
+        tracks_STORM = read_storm_tracks(os.path.join(storm_dir, fname))
         tracks_STORM.equal_timestep(time_step_h=1.)
         return tracks_STORM
     
@@ -40,13 +50,21 @@ def main(i_file, i_ens, i_basin):
     tc_tracks = TCTracks()
     tc_tracks = init_STORM_tracks(i_file, i_ens, i_basin)
     
-    # load centroids from this source
-    cent = Centroids.from_hdf5(cent_str)
+    # load centroids from this source (unless given by run_STORM_windfields.py)
+    cent = load_centroids(cent_str) if centroids is None else centroids
 
     tc_hazard = TropCyclone.from_tracks(tc_tracks, centroids=cent)
-    tc_hazard.write_hdf5(haz_dir.joinpath(haz_str))
+    # remove the winds below the floor (if any)
+    stats = sparsify(tc_hazard, min_intensity, unit=haz_str)
     tc_hazard.check()
+    write_hdf5(tc_hazard, haz_dir.joinpath(haz_str), min_intensity=stats['min_intensity'],
+               nnz_removed=stats['nnz_before'] - stats['nnz_after'])
+    return tc_hazard.event_id.size
 
 if __name__ == "__main__":
-    main(*sys.argv[1:])
-
+    cli.run(main, 'storm_future', [
+        ('i_file', str, cli.REQUIRED, "Climate model of the STORM tracks"),
+        ('i_ens', str, cli.REQUIRED, "Member of the STORM ensemble (0-9)"),
+        ('i_basin', str, cli.REQUIRED, "Basin, e.g. EP"),
+        ('min_intensity', floor_arg, None, "Floor of the wind speeds in m/s, default or none"),
+    ], description="Compute the windfields of the STORM tracks of the future climate.")
@@ -7,18 +7,26 @@ description: Load TC tracks from the STORM model and calculate the 2D windfield
 @author: simonameiler
 """
 
+import os
 import sys
 import numpy as np
-import copy as cp
 
 # import CLIMADA modules:
 from climada.hazard import TropCyclone
 from climada.util.constants import SYSTEM_DIR
 
+# Add parent directory to sys.path to access config and utils
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+from output_manifest import write_hdf5
+from prefetch import AsyncWriter, prefetch_hazards
+from instrumentation import timed
+import cli
+
 ############################################################################
 # i_file = ['CMCC-CM2-VHR4', 'CNRM-CM6-1-HR', 'EC-Earth3P-HR', 'HadGEM3-GC31-HM']
 # i_ens = range(10)
 # i_basin = ['EP', 'NA', 'NI', 'SI', 'SP', 'WP']
+@timed('storm_future_concat')
 def main(i_file):
     
     i_file = str(i_file)
@@ -56,28 +64,28 @@ def main(i_file):
         tc_haz_split = hazard.select(reg_id=reg_id[basin]) 
         return tc_haz_split
     
-    # load all STORM hazard files and append to list
-    STORM_hazard = []
-    for i_basin in ['EP', 'NA', 'NI', 'SI', 'SP', 'WP']:
-        for i_ens in range(10):
-            tc_hazard = TropCyclone.from_hdf5(haz_dir.joinpath(f"TC_{i_file}_{i_basin}_{i_ens}_0300as_STORM.hdf5"))
-            STORM_hazard.append(tc_hazard)
-    
-    # create master TropCyclone object of hazard list; save
-    STORM_master = cp.deepcopy(STORM_hazard[0])
-    for haz in range(1,len(STORM_hazard)):
-        STORM_master.append(STORM_hazard[haz])    
+    # load all STORM hazard files and append them to the first, the next files are read while appending
+    haz_files = [haz_dir.joinpath(f"TC_{i_file}_{i_basin}_{i_ens}_0300as_STORM.hdf5")
+                 for i_basin in ['EP', 'NA', 'NI', 'SI', 'SP', 'WP'] for i_ens in range(10)]
+    STORM_master = None
+    for _, tc_hazard in prefetch_hazards(haz_files, TropCyclone):
+        if STORM_master is None:
+            STORM_master = tc_hazard
+        else:
+            STORM_master.append(tc_hazard)
     freq_corr_STORM = 1/10000    
-    STORM_master.frequency = np.ones(tc_hazard.event_id.size)*freq_corr_STORM
-    STORM_master.write_hdf5(haz_dir.joinpath(f"TC_global_0300as_STORM_{i_file}.hdf5"))
+    STORM_master.frequency = np.ones(STORM_master.event_id.size)*freq_corr_STORM
+    # written before the basin split sets the region ids
+    write_hdf5(STORM_master, haz_dir.joinpath(f"TC_global_0300as_STORM_{i_file}.hdf5"))
     
-    # call basin split function and save results
-    for bsn in BASIN_BOUNDS:
-        STORM_basin = TropCyclone()
-        STORM_basin = basin_split_haz(STORM_master, bsn)
-        STORM_basin.write_hdf5(haz_dir.joinpath(f"TC_{bsn}_0300as_STORM_{i_file}.hdf5"))
+    # call basin split function and save results, each basin is written while the next is split
+    with AsyncWriter() as writer:
+        for bsn in BASIN_BOUNDS:
+            STORM_basin = TropCyclone()
+            STORM_basin = basin_split_haz(STORM_master, bsn)
+            writer.submit(write_hdf5, STORM_basin, haz_dir.joinpath(f"TC_{bsn}_0300as_STORM_{i_file}.hdf5"))
 
 if __name__ == "__main__":
-    main(*sys.argv[1:]) 
-    
-
+    cli.run(main, 'storm_future_concat', [
+        ('i_file', str, cli.REQUIRED, "Climate model of the STORM tracks"),
+    ], description="Combine the STORM windfields of the future climate to global and basin files.")
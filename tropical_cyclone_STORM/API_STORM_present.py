@@ -12,13 +12,25 @@ import os
 import numpy as np
 
 # import CLIMADA modules:
-from climada.hazard import Centroids, TCTracks, TropCyclone
+from climada.hazard import TCTracks, TropCyclone
 from climada.util.constants import SYSTEM_DIR
 
+# Add parent directory to sys.path to access config and utils
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+from centroid_cache import load_centroids
+from output_manifest import write_hdf5
+from instrumentation import timed
+import cli
+from sparsify import floor_arg, sparsify
+from storm_tracks import read_storm_tracks
+
+FREQ_CORR_STORM = 1/10000  # 10 ensemble members of 1000 years
+
 ############################################################################
 # i_ens = range(10)
 # i_basin = ['EP', 'NA', 'NI', 'SI', 'SP', 'WP']
-def main(i_basin, i_ens):
+@timed('storm_present')
+def main(i_basin, i_ens, min_intensity=None, centroids=None):
     
     i_basin = str(i_basin)
     
@@ -31,7 +43,7 @@ def main(i_basin, i_ens):
     def init_STORM_tracks(i_basin, i_ens):
         """ Load STORM tracks for the present climate."""
         fname = f"STORM_DATA_IBTRACS_{i_basin}_1000_YEARS_{i_ens}.txt"
-        tracks_STORM = TCTracks.from_simulations_storm(os.path.join(storm_dir, fname))
+        tracks_STORM = read_storm_tracks(os.path.join(storm_dir, fname))
         tracks_STORM.equal_timestep(time_step_h=1.)
         return tracks_STORM
     
@@ -39,16 +51,22 @@ def main(i_basin, i_ens):
     tc_tracks = TCTracks()
     tc_tracks = init_STORM_tracks(i_basin, i_ens)
     
-    # load centroids from this source
-    cent = Centroids.from_hdf5(cent_str)
+    # load centroids from this source (unless given by run_STORM_windfields.py)
+    cent = load_centroids(cent_str) if centroids is None else centroids
 
     tc_hazard = TropCyclone.from_tracks(tc_tracks, centroids=cent)
+    # remove the winds below the floor (if any)
+    stats = sparsify(tc_hazard, min_intensity, unit=haz_str)
     # hazard frequency correction
-    freq_corr_STORM = 1/10000
-    tc_hazard.frequency = np.ones(tc_hazard.event_id.size)*freq_corr_STORM
-    tc_hazard.write_hdf5(haz_dir.joinpath(haz_str))
+    tc_hazard.frequency = np.full(tc_hazard.event_id.size, FREQ_CORR_STORM)
     tc_hazard.check()
+    write_hdf5(tc_hazard, haz_dir.joinpath(haz_str), min_intensity=stats['min_intensity'],
+               nnz_removed=stats['nnz_before'] - stats['nnz_after'])
+    return tc_hazard.event_id.size
 
 if __name__ == "__main__":
-    main(*sys.argv[1:])
-
+    cli.run(main, 'storm_present', [
+        ('i_basin', str, cli.REQUIRED, "Basin, e.g. EP"),
+        ('i_ens', str, cli.REQUIRED, "Member of the STORM ensemble (0-9)"),
+        ('min_intensity', floor_arg, None, "Floor of the wind speeds in m/s, default or none"),
+    ], description="Compute the windfields of the STORM tracks of the present climate.")
@@ -8,12 +8,20 @@ description: Load subsets of 2D windfields from the STORM model and combine them
 @author: simonameiler
 """
 
-import copy as cp
+import os
+import sys
 
 # import CLIMADA modules:
 from climada.hazard import TropCyclone
 from climada.util.constants import SYSTEM_DIR
 
+# Add parent directory to sys.path to access config and utils
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+from output_manifest import write_hdf5
+from prefetch import AsyncWriter, prefetch_hazards
+from instrumentation import timed
+import cli
+
 haz_dir = SYSTEM_DIR/"hazard"
 
 # boundaries of (sub-)basins (lonmin, lonmax, latmin, latmax)
@@ -47,24 +55,27 @@ def basin_split_haz(hazard, basin):
     tc_haz_split = hazard.select(reg_id=reg_id[basin]) 
     return tc_haz_split
 
-# load all STORM hazard files and append to list
-STORM_hazard = []
-for i_basin in ['EP', 'NA', 'NI', 'SI', 'SP', 'WP']:
-    for i_ens in range(10):
-        tc_hazard = TropCyclone.from_hdf5(haz_dir.joinpath(f"TC_{i_basin}_{i_ens}_0300as_STORM.hdf5"))
-        STORM_hazard.append(tc_hazard)
-
-# create master TropCyclone object of hazard list; save
-STORM_master = cp.deepcopy(STORM_hazard[0])
-for haz in range(1,len(STORM_hazard)):
-    STORM_master.append(STORM_hazard[haz])    
-STORM_master.write_hdf5(haz_dir.joinpath("TC_global_0300as_STORM.hdf5"))
-
-# call basin split function and save results
-for bsn in BASIN_BOUNDS:
-    STORM_basin = TropCyclone()
-    STORM_basin = basin_split_haz(STORM_master, bsn)
-    STORM_basin.write_hdf5(haz_dir.joinpath(f"TC_{bsn}_0300as_STORM.hdf5"))
-
-    
-
+@timed('storm_present_concat')
+def main():
+    # load all STORM hazard files and append them to the first, the next files are read while appending
+    haz_files = [haz_dir.joinpath(f"TC_{i_basin}_{i_ens}_0300as_STORM.hdf5")
+                 for i_basin in ['EP', 'NA', 'NI', 'SI', 'SP', 'WP'] for i_ens in range(10)]
+    STORM_master = None
+    for _, tc_hazard in prefetch_hazards(haz_files, TropCyclone):
+        if STORM_master is None:
+            STORM_master = tc_hazard
+        else:
+            STORM_master.append(tc_hazard)
+    # written before the basin split sets the region ids
+    write_hdf5(STORM_master, haz_dir.joinpath("TC_global_0300as_STORM.hdf5"))
+
+    # call basin split function and save results, each basin is written while the next is split
+    with AsyncWriter() as writer:
+        for bsn in BASIN_BOUNDS:
+            STORM_basin = TropCyclone()
+            STORM_basin = basin_split_haz(STORM_master, bsn)
+            writer.submit(write_hdf5, STORM_basin, haz_dir.joinpath(f"TC_{bsn}_0300as_STORM.hdf5"))
+
+if __name__ == "__main__":
+    cli.run(main, 'storm_present_concat',
+            description="Combine the STORM windfields of the present climate to global and basin files.")
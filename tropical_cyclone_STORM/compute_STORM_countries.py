@@ -6,15 +6,19 @@ import os
 sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
 from config import DATA_DIR
 from create_log_file import log_msg
+from output_manifest import is_complete, write_atomic
+from instrumentation import timed
+import cli
 
 LOG_FILE = "progress_make_tc_tracks.txt"
 
+@timed('storm_countries')
 def main(basin='EP', n_tracks=10, min_year=1980, max_year=2020, time_step_h=1):
     year_range = (min_year, max_year)
     nb_syn_tracks = int(n_tracks)
     path = os.path.join(DATA_DIR, f"tracks_{str(min_year)}_{str(max_year)}_{str(time_step_h)}_{str(n_tracks)}_{basin}")
     
-    if os.path.exists(path) and os.listdir(path):  # If directory exists AND is not empty
+    if is_complete(path):  # If directory was completely written
         msg = f"Directory {path} already contains files. Skipping computation.\n"
         print(f"Warning: {msg}")
         log_msg(msg, LOG_FILE)
@@ -36,12 +40,12 @@ def main(basin='EP', n_tracks=10, min_year=1980, max_year=2020, time_step_h=1):
     if nb_syn_tracks > 0:
         tc_tracks.calc_perturbed_trajectories(nb_synth_tracks=nb_syn_tracks)
 
-    if not os.path.exists(path):
-        os.makedirs(path)
-
-    tc_tracks.write_netcdf(path)
+    write_atomic(path, tc_tracks.write_netcdf, {'n_tracks': tc_tracks.size}, directory=True)
     log_msg(f"Finished track generation for basin {basin}. Output saved to {path}\n", LOG_FILE)
 
 
 if __name__ == "__main__":
-    main(basin=sys.argv[1], n_tracks=sys.argv[2])
+    cli.run(main, 'storm_countries', [
+        ('basin', str, cli.REQUIRED, "Basin, e.g. EP"),
+        ('n_tracks', int, cli.REQUIRED, "Number of synthetic tracks per historical track"),
+    ], description="Generate the tracks of a basin.")
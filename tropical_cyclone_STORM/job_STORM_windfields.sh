@@ -0,0 +1,9 @@
+#!/bin/bash
+#SBATCH -n 1
+#SBATCH --cpus-per-task=16
+#SBATCH --time=48:00:00
+#SBATCH --mem-per-cpu=16000
+
+. ~/venv/climada_dev/bin/activate
+
+python3 run_STORM_windfields.py --processes 16
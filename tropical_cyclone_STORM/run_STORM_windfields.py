@@ -0,0 +1,142 @@
+"""
+Driver of all STORM windfields, instead of one job per basin and ensemble member.
+
+Each job of API_STORM_present.py and API_STORM_future.py loads the global centroids
+again and computes a single windfield on one core. This driver enumerates all
+(climate model, basin, member) combinations, loads the centroids once before starting a
+pool of workers, which share them with the driver (fork, copy-on-write), and computes the
+members in the workers, the largest track files first such that the long members do not
+end the run on a single core. Members whose hazard file is complete (see output_manifest)
+are skipped, such that an interrupted run is resumed by running it again. A failing
+member is reported and does not stop the other members.
+
+Usage: python run_STORM_windfields.py [--periods present,future] [--gcms ...] [--basins EP,NA]
+                                      [--members 0,1] [--processes 8] [--min-intensity default]
+"""
+import os
+import sys
+import traceback
+
+from climada.util.constants import SYSTEM_DIR
+from pathos.pools import ProcessPool as Pool
+
+# Add parent directory to sys.path to access config and utils
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+from centroid_cache import load_centroids
+from create_log_file import log_msg
+from instrumentation import timed
+import cli
+from output_manifest import is_complete
+from sparsify import floor_arg
+import API_STORM_future
+import API_STORM_present
+
+GCMS = ['CMCC-CM2-VHR4', 'CNRM-CM6-1-HR', 'EC-Earth3P-HR', 'HadGEM3-GC31-HM']
+BASINS = ['EP', 'NA', 'NI', 'SI', 'SP', 'WP']
+MEMBERS = list(range(10))
+CENT_FILE = SYSTEM_DIR.joinpath("centroids_0300as_global.hdf5")
+LOG_FILE = "progress_STORM_windfields.txt"
+
+# centroids shared with the workers, set before the pool is started
+_centroids = None
+
+
+def member_jobs(periods, gcms, basins, members):
+    """
+    Members of the STORM windfields, largest track file first.
+
+    Returns:
+        list of dict: period, arguments of the main function of the period, track file
+            and hazard file of each member.
+    """
+    jobs = []
+    for basin in basins:
+        for ens in members:
+            if 'present' in periods:
+                jobs.append(dict(
+                    period='present', args=dict(i_basin=basin, i_ens=ens),
+                    track_file=SYSTEM_DIR.joinpath('tracks', 'STORM', 'present',
+                                                   f"STORM_DATA_IBTRACS_{basin}_1000_YEARS_{ens}.txt"),
+                    haz_file=SYSTEM_DIR.joinpath('hazard', f"TC_{basin}_{ens}_0300as_STORM.hdf5")))
+            if 'future' in periods:
+                for gcm in gcms:
+                    jobs.append(dict(
+                        period='future', args=dict(i_file=gcm, i_ens=ens, i_basin=basin),
+                        track_file=SYSTEM_DIR.joinpath('tracks', 'STORM', 'future', gcm,
+                                                       f"STORM_DATA_{gcm}_{basin}_1000_YEARS_{ens}_IBTRACSDELTA.txt"),
+                        haz_file=SYSTEM_DIR.joinpath('hazard', f"TC_{gcm}_{basin}_{ens}_0300as_STORM.hdf5")))
+    size = lambda job: os.path.getsize(job['track_file']) if os.path.exists(job['track_file']) else 0
+    return sorted(jobs, key=size, reverse=True)
+
+
+def _unit(job):
+    return '_'.join(str(value) for value in [job['period'], *job['args'].values()])
+
+
+def run_member(job, min_intensity=None):
+    """
+    Compute the windfields of one member with the shared centroids.
+
+    Returns:
+        tuple: Unit of the member, number of events (None if it failed) and the error.
+    """
+    main = API_STORM_present.main if job['period'] == 'present' else API_STORM_future.main
+    try:
+        n_events = main(**job['args'], min_intensity=min_intensity, centroids=_centroids)  # timed by main
+        return _unit(job), n_events, None
+    except Exception:  # reported by the driver, the other members go on
+        return _unit(job), None, traceback.format_exc()
+
+
+@timed('storm_windfields_driver')
+def main(periods=('present', 'future'), gcms=GCMS, basins=BASINS, members=MEMBERS, processes=None,
+         min_intensity=None):
+    """
+    Compute the STORM windfields of all members in a pool of workers.
+
+    Parameters:
+        periods (list of str): 'present' and/or 'future'.
+        gcms (list of str): Climate models of the future tracks.
+        basins (list of str): Basins, e.g. ['EP', 'NA'].
+        members (list of int): Members of the STORM ensemble.
+        processes (int, optional): Number of workers. Default: number of CPUs.
+        min_intensity (float or str, optional): Floor of the wind speeds (see sparsify.py).
+
+    Returns:
+        list of str: Members that failed.
+    """
+    global _centroids
+    jobs = member_jobs(periods, gcms, basins, members)
+    todo = [job for job in jobs if not is_complete(job['haz_file'])]
+    log_msg(f"{len(todo)} of {len(jobs)} STORM members to compute.\n", LOG_FILE)
+    if not todo:
+        return []
+
+    _centroids = load_centroids(CENT_FILE)
+    pool = Pool(nodes=min(processes or os.cpu_count(), len(todo)))
+    failed = []
+    try:
+        for unit, n_events, error in pool.uimap(lambda job: run_member(job, min_intensity), todo):
+            if error is None:
+                log_msg(f"Finished {unit}: {n_events} events.\n", LOG_FILE)
+            else:
+                failed.append(unit)
+                log_msg(f"Failed {unit}:\n{error}\n", LOG_FILE)
+    finally:
+        pool.close()
+        pool.join()
+        pool.clear()
+    log_msg(f"Finished {len(todo) - len(failed)} STORM members, {len(failed)} failed: {failed}\n", LOG_FILE)
+    return failed
+
+
+if __name__ == "__main__":
+    failed = cli.run(main, 'storm_windfields', [
+        ('periods', cli.str_list, ['present', 'future'], "present and/or future"),
+        ('gcms', cli.str_list, GCMS, "Climate models of the future tracks"),
+        ('basins', cli.str_list, BASINS, "Basins, e.g. EP,NA"),
+        ('members', cli.int_list, MEMBERS, "Members of the STORM ensemble, e.g. 0,1"),
+        ('processes', int, None, "Number of workers (default: number of CPUs)"),
+        ('min_intensity', floor_arg, None, "Floor of the wind speeds in m/s, default or none"),
+    ], description="Compute the windfields of all STORM members in a pool of workers.")
+    sys.exit(1 if failed else 0)
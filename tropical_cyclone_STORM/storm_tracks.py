@@ -0,0 +1,194 @@
+"""
+Fast reader of the STORM track files, with a binary cache.
+
+TCTracks.from_simulations_storm parses the STORM_DATA_*_1000_YEARS_*.txt files (one line
+per 3-hourly time step of 1000 years of storms) with a Python converter per value and
+groups the lines with pandas, every time a file is read. read_storm_tracks reads the
+columns of the file in one vectorized read with fixed dtypes, sorts the lines by storm
+(year and number), splits them on the index boundaries of the storms and builds the same
+tracks as CLIMADA (units, time, attributes). The parsed columns are cached in
+<file>.npz next to the text file, and reloaded as long as the text file is unchanged.
+
+Usage: python storm_tracks.py <file> [<file> ...]  (writes the caches and compares the
+       tracks with TCTracks.from_simulations_storm)
+"""
+import os
+import sys
+
+import numpy as np
+import pandas as pd
+import xarray as xr
+from climada.hazard import TCTracks
+from climada.util.coordinates import lon_normalize
+
+COLUMNS = ['year', 'month', 'tc_num', 'time_step', 'basin', 'lat', 'lon', 'pres', 'wind',
+           'rmw', 'category', 'landfall', 'dist_to_land']
+BASINS = ['EP', 'NA', 'NI', 'SI', 'SP', 'WP']  # index of the basin column
+TIME_STEP_H = 3
+ENV_PRESSURE = 1010  # mb
+KM_TO_NM = 1 / 1.852
+MS_TO_KN = 3600 / 1852
+CACHE_VERSION = 1
+
+
+def cache_path(path):
+    """Binary cache of a STORM file."""
+    return str(path) + '.npz'
+
+
+def _source_key(path):
+    stat = os.stat(path)
+    return np.array([CACHE_VERSION, stat.st_size, stat.st_mtime_ns], dtype=np.int64)
+
+
+def parse_storm_file(path):
+    """
+    Read a STORM file in one vectorized read.
+
+    Duplicated time steps of a storm (a known issue of the data) are dropped, as in
+    CLIMADA, and the lines are sorted by storm, keeping the order of the time steps.
+
+    Parameters:
+        path (str): STORM text file.
+
+    Returns:
+        dict: Columns of the file (see COLUMNS), as float64 arrays but year, tc_num,
+            basin and category as integers, with the start of each storm in 'starts'.
+    """
+    table = pd.read_csv(path, header=None, names=COLUMNS, dtype=np.float64, engine='c')
+    table = table.drop_duplicates(subset=['year', 'tc_num', 'time_step'])
+    columns = {name: table[name].to_numpy() for name in COLUMNS}
+    for name in ['year', 'tc_num', 'basin', 'category']:
+        columns[name] = columns[name].astype(np.int64)
+    order = np.lexsort((columns['tc_num'], columns['year']))  # stable, by year then tc_num
+    columns = {name: values[order] for name, values in columns.items()}
+    new_storm = np.diff(columns['year']) != 0
+    new_storm |= np.diff(columns['tc_num']) != 0
+    columns['starts'] = np.concatenate([[0], np.flatnonzero(new_storm) + 1]).astype(np.int64)
+    return columns
+
+
+def load_storm_columns(path, cache=True):
+    """
+    Columns of a STORM file (see parse_storm_file), from its cache if it is current.
+
+    Parameters:
+        path (str): STORM text file.
+        cache (bool): Read and write the cache <file>.npz.
+
+    Returns:
+        dict
+    """
+    cache_file = cache_path(path)
+    source = _source_key(path)
+    if cache and os.path.exists(cache_file):
+        with np.load(cache_file) as data:
+            if np.array_equal(data['source'], source):
+                return {name: data[name] for name in data.files if name != 'source'}
+    columns = parse_storm_file(path)
+    if cache:
+        tmp_file = cache_file + f'.{os.getpid()}.tmp.npz'
+        try:
+            np.savez(tmp_file, source=source, **columns)
+            os.replace(tmp_file, cache_file)
+        except OSError:  # e.g. read-only track directory, the file is parsed again next time
+            if os.path.exists(tmp_file):
+                os.remove(tmp_file)
+    return columns
+
+
+def track_columns(columns):
+    """Variables of the tracks in CLIMADA units (kn, nm, [-180, 180] longitudes), for all lines at once."""
+    time = (np.datetime64('1980-01', 'M') + (columns['month'].astype(np.int64) - 1)).astype('datetime64[ns]')
+    return {
+        'time': time + (columns['time_step'] * TIME_STEP_H * 3600e9).astype('timedelta64[ns]'),
+        'lat': columns['lat'],
+        'lon': lon_normalize(columns['lon'].copy()),
+        'max_sustained_wind': columns['wind'] * MS_TO_KN,
+        'central_pressure': columns['pres'],
+        'radius_max_wind': columns['rmw'] * KM_TO_NM,
+        'basin': np.array(BASINS)[columns['basin']].astype('<U2'),
+    }
+
+
+def _track(variables, year, tc_num, category):
+    """Track of a storm from the slices of the variables, as built by CLIMADA."""
+    n_steps = variables['time'].size
+    return xr.Dataset({
+        'time_step': ('time', np.full(n_steps, TIME_STEP_H)),
+        'max_sustained_wind': ('time', variables['max_sustained_wind']),
+        'central_pressure': ('time', variables['central_pressure']),
+        'radius_max_wind': ('time', variables['radius_max_wind']),
+        'environmental_pressure': ('time', np.full(n_steps, ENV_PRESSURE)),
+        'basin': ('time', variables['basin']),
+    }, coords={
+        'time': ('time', variables['time']),
+        'lat': ('time', variables['lat']),
+        'lon': ('time', variables['lon']),
+    }, attrs={
+        'max_sustained_wind_unit': 'kn',
+        'central_pressure_unit': 'mb',
+        'name': f"{year}-{tc_num}",
+        'sid': f"{year}-{tc_num}",
+        'orig_event_flag': True,
+        'data_provider': 'STORM',
+        'id_no': year * 100 + tc_num,
+        'category': category,
+    })
+
+
+def read_storm_tracks(path, years=None, cache=True):
+    """
+    Read a STORM file as TCTracks, as TCTracks.from_simulations_storm.
+
+    Parameters:
+        path (str): STORM text file.
+        years (list of int, optional): Years of the simulation to read (all if None).
+        cache (bool): Use the binary cache <file>.npz.
+
+    Returns:
+        TCTracks
+    """
+    columns = load_storm_columns(path, cache=cache)
+    starts = columns['starts']
+    if years is not None:
+        lines = np.isin(columns['year'], years)
+        columns = {name: values[lines] for name, values in columns.items() if name != 'starts'}
+        starts = np.flatnonzero(np.isin(np.arange(lines.size), starts)[lines])
+    # split all variables on the boundaries of the storms at once
+    variables = {name: np.split(values, starts[1:]) for name, values in track_columns(columns).items()}
+    categories = np.maximum.reduceat(columns['category'], starts) if starts.size else []
+    return TCTracks([
+        _track({name: values[i] for name, values in variables.items()},
+               int(columns['year'][start]), int(columns['tc_num'][start]), int(categories[i]))
+        for i, start in enumerate(starts)
+    ])
+
+
+def compare_with_climada(path):
+    """Differences between read_storm_tracks and TCTracks.from_simulations_storm (empty list if none)."""
+    ours = read_storm_tracks(path).data
+    ref = TCTracks.from_simulations_storm(path).data
+    if len(ours) != len(ref):
+        return [f"{len(ours)} tracks instead of {len(ref)}"]
+    differences = []
+    for track, ref_track in zip(ours, ref):
+        for name in set(track.variables) | set(ref_track.variables):
+            if name not in track.variables or name not in ref_track.variables:
+                differences.append(f"{ref_track.sid}: variable {name} missing")
+            elif not np.array_equal(track[name].values, ref_track[name].values) and not (
+                    np.issubdtype(track[name].dtype, np.number)
+                    and np.allclose(track[name].values, ref_track[name].values)):
+                differences.append(f"{ref_track.sid}: {name} differs")
+        for name, value in ref_track.attrs.items():
+            if track.attrs.get(name) != value:
+                differences.append(f"{ref_track.sid}: attribute {name} is {track.attrs.get(name)}, not {value}")
+    return differences
+
+
+if __name__ == "__main__":
+    for file_path in sys.argv[1:]:
+        differences = compare_with_climada(file_path)
+        print(f"{file_path}: {'same tracks as CLIMADA' if not differences else ''}")
+        for difference in differences[:20]:
+            print(f"  {difference}")
@@ -0,0 +1,235 @@
+"""
+bias_correction.py
+
+Bias correction of the CMIP6 winter winds (sfcWindmax) against the ERA5 daily maxima
+(WG10) by empirical quantile mapping, for the winter windstorm hazard of the data API
+(see the bias correction section of API_storm_days_prep.ipynb).
+
+The ERA5 per-gridcell quantile table only depends on ERA5. It is computed once and
+cached to a netCDF file, and regridded to the grid of each model. The quantile table of
+the historical period of a model is computed over all its members at once, and all
+scenarios and members are then corrected with one vectorized mapping per spatial chunk.
+The models are processed in parallel, and models whose output was completely written
+(see output_manifest.py) are skipped, such that adding a model costs a single pass over
+its file.
+
+Usage: python bias_correction.py <data_folder> <cmip6_basename> <model1,model2,...> [<scenario1,scenario2,...>]
+"""
+
+import os
+import sys
+from datetime import datetime
+from timeit import default_timer as timer
+
+import numpy as np
+import xarray as xr
+from pathos.pools import ProcessPool as Pool
+
+# Add parent directory to sys.path to access config and utils
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+from create_log_file import log_msg
+import cli
+from output_manifest import is_complete, write_atomic
+from utility import make_fn
+
+ERA5_FILE = 'era5_WG10_br_day_EU_winE.nc'  # control data of the bias correction (see era5_daily_max.py)
+ERA5_VAR = 'WG10'
+PASTNAME = 'historical'
+SCENARIOS = ['historical', 'ssp585']
+FAULTY_MEMBERS = {'NESM3': [1]}  # members dropped because faulty
+#quantiles of the mapping (minq, maxq, incq)
+QUANTILES = np.round(np.arange(0.001, 1.000 + 0.0005, 0.001), 3)
+#size of the spatial chunks (number of grid cells in lat and lon)
+CHUNK_LATLON = 16
+LOG_FILE = f"progress_bias_correction_{datetime.today().strftime('%Y%m%d')}.txt"
+
+
+def era5_quantiles(era5_file, quantiles=QUANTILES, var=ERA5_VAR, cache_file=None):
+    """
+    Compute the quantile table of ERA5 at each grid cell.
+
+    Parameters:
+        era5_file (str): netCDF file of the ERA5 daily maxima.
+        quantiles (np.array): Quantiles of the table.
+        var (str): Variable of the ERA5 file.
+        cache_file (str, optional): netCDF file to read the table from if it was completely
+            written, or to write it to otherwise.
+
+    Returns:
+        xr.Dataset: Quantile table (quantile_table, dimensions quantile, lat and lon) and
+            the ERA5 dates (time).
+    """
+    if cache_file and is_complete(cache_file):
+        with xr.open_dataset(cache_file) as qt_obs:
+            return qt_obs.load()
+
+    with xr.open_dataset(era5_file) as era_ds:
+        era_da = era_ds[var].chunk({'time': -1, 'lat': CHUNK_LATLON, 'lon': CHUNK_LATLON})
+        qt_obs = xr.Dataset({'quantile_table': era_da.quantile(quantiles, dim='time').compute()})
+        qt_obs = qt_obs.assign_coords(time=era_ds['time'].values)
+
+    if cache_file:
+        write_atomic(cache_file, qt_obs.to_netcdf)
+    return qt_obs
+
+
+def quantile_map(values, qt_mod, qt_obs):
+    """
+    Empirical quantile mapping of the values of many grid cells at once.
+
+    Values within the model quantiles are mapped by linear interpolation between the
+    model and observed quantiles of their grid cell. Values outside are shifted by the
+    difference of the lowest (highest) quantiles.
+
+    Parameters:
+        values (np.array): Values to correct, shape (n_values, n_cell).
+        qt_mod (np.array): Quantiles of the model, shape (n_quantile, n_cell), non-decreasing.
+        qt_obs (np.array): Quantiles of the observations, shape (n_quantile, n_cell).
+
+    Returns:
+        np.array: Corrected values, shape (n_values, n_cell).
+    """
+    n_qt, n_cell = qt_mod.shape
+    valid = ~np.isnan(values)
+
+    #search the values in the quantiles of their cell at once, with cells offset
+    #from each other by more than the range of the values
+    low = min(np.nanmin(qt_mod), np.nanmin(values, initial=np.inf))
+    span = max(np.nanmax(qt_mod), np.nanmax(values, initial=-np.inf)) - low + 1
+    offset = np.arange(n_cell)*span
+    keys = (qt_mod - low + offset).T.ravel()
+    pos = np.searchsorted(keys, np.where(valid, values - low, 0) + offset, side='right')
+    idx = np.clip(pos - np.arange(n_cell)*n_qt, 1, n_qt - 1)
+
+    cell = np.broadcast_to(np.arange(n_cell), values.shape)
+    mod_lo, mod_hi = qt_mod[idx - 1, cell], qt_mod[idx, cell]
+    obs_lo, obs_hi = qt_obs[idx - 1, cell], qt_obs[idx, cell]
+    delta = mod_hi - mod_lo
+    weight = np.divide(values - mod_lo, delta, out=np.zeros(values.shape), where=delta > 0)
+    corrected = obs_lo + weight*(obs_hi - obs_lo)
+
+    #constant correction outside of the quantiles
+    below = values < qt_mod[0]
+    above = values > qt_mod[-1]
+    corrected = np.where(below, values + (qt_obs[0] - qt_mod[0]), corrected)
+    corrected = np.where(above, values + (qt_obs[-1] - qt_mod[-1]), corrected)
+    return np.where(valid, corrected, np.nan)
+
+
+def _quantile_map_block(values, qt_mod, qt_obs):
+    """quantile_map on a block (lat, lon, ..., value dims) with tables (lat, lon, quantile)."""
+    shape = values.shape
+    n_lat, n_lon = shape[:2]
+    values = values.reshape(n_lat*n_lon, -1).T
+    qt_mod = qt_mod.reshape(n_lat*n_lon, -1).T
+    qt_obs = qt_obs.reshape(n_lat*n_lon, -1).T
+    return quantile_map(values, qt_mod, qt_obs).T.reshape(shape)
+
+
+def bias_correct_model(cmip_file, qt_obs, scenarios=SCENARIOS, pastname=PASTNAME, drop_members=None):
+    """
+    Bias correct all scenarios and members of a model against the ERA5 quantile table.
+
+    Parameters:
+        cmip_file (str): netCDF file of the model, with one variable per scenario
+            (dimensions day, lat, lon, member) and the dates timep and timef.
+        qt_obs (xr.Dataset): ERA5 quantile table from era5_quantiles.
+        scenarios (list of str): Scenarios to correct.
+        pastname (str): Name of the historical scenario.
+        drop_members (list of int, optional): Members to drop.
+
+    Returns:
+        xr.Dataset: Corrected scenarios (dimensions day, lat, lon, member) with the
+            dates timep and timef (standard calendar) as variables.
+    """
+    with xr.open_dataset(cmip_file) as cmip_ds:
+        if drop_members:
+            cmip_ds = cmip_ds.drop_sel(member=drop_members)
+        cmip_ds = cmip_ds.load()
+
+    #convert calendars
+    past_da = cmip_ds.swap_dims({"day": "timep"})[pastname]
+    past_da = past_da.convert_calendar('standard', dim='timep', align_on="year")
+    past_tid = past_da.timep
+    fut_tid = cmip_ds.swap_dims({"day": "timef"})['timef']
+    fut_tid = fut_tid.convert_calendar('standard', dim='timef', align_on="year").timef
+
+    #model quantiles on the dates of ERA5, over all members
+    era_dates = qt_obs['time'].values.astype('datetime64[D]')
+    past_da = past_da.isel(timep=np.isin(past_da.timep.values.astype('datetime64[D]'), era_dates))
+    past_da = past_da.chunk({'timep': -1, 'member': -1, 'lat': CHUNK_LATLON, 'lon': CHUNK_LATLON})
+    qt_mod = past_da.quantile(qt_obs['quantile'].values, dim=['timep', 'member'])
+
+    #regrid the era5 table to the gcm's res
+    qt_obs_rg = qt_obs['quantile_table'].interp(lat=cmip_ds.lat, lon=cmip_ds.lon, method='linear',
+                                                kwargs={"fill_value": 'extrapolate'})
+    qt_obs_rg = qt_obs_rg.chunk({'quantile': -1, 'lat': CHUNK_LATLON, 'lon': CHUNK_LATLON})
+
+    da_dict = dict()
+    for scen in scenarios:
+        da_scen = cmip_ds[scen].chunk({'day': -1, 'member': -1, 'lat': CHUNK_LATLON, 'lon': CHUNK_LATLON})
+        da_dict[scen] = xr.apply_ufunc(_quantile_map_block, da_scen, qt_mod, qt_obs_rg,
+                                       input_core_dims=[['day', 'member'], ['quantile'], ['quantile']],
+                                       output_core_dims=[['day', 'member']],
+                                       dask='parallelized', output_dtypes=[float])
+    bias_corr_ds = xr.Dataset(da_dict).compute().transpose('day', 'lat', 'lon', 'member')
+
+    #keep correct time coordinates as variables
+    bias_corr_ds = bias_corr_ds.assign_coords({"timep": ("day", past_tid.data)}).reset_coords()
+    bias_corr_ds = bias_corr_ds.assign_coords({"timef": ("day", fut_tid.data)}).reset_coords()
+    return bias_corr_ds
+
+
+def _bias_correct_file(args):
+    """Bias correct one model and write the output file (for the process pool)."""
+    modname, cmip_file, out_file, qt_obs, scenarios = args
+    start_time = timer()
+    bias_corr_ds = bias_correct_model(cmip_file, qt_obs, scenarios=scenarios,
+                                      drop_members=FAULTY_MEMBERS.get(modname))
+    write_atomic(out_file, bias_corr_ds.to_netcdf, info={'model': modname, 'scenarios': list(scenarios)})
+    return modname, timer() - start_time
+
+
+def main(data_folder, cmip6_basename, models, scenarios=SCENARIOS, nb_cpus=None):
+    """
+    Bias correct the CMIP6 winter winds of several models against ERA5.
+
+    Parameters:
+        data_folder (str): Folder with the ERA5 file, the CMIP6 files <model>_<cmip6_basename>.nc
+            and the outputs <model>_bias_corrWG10_<cmip6_basename>.nc.
+        cmip6_basename (str): Base name of the CMIP6 files.
+        models (list of str): Models to correct. Models whose output was completely written are skipped.
+        scenarios (list of str): Scenarios to correct.
+        nb_cpus (int, optional): Number of models processed in parallel. Default: all cpus.
+    """
+    start_time = timer()
+    qt_obs = era5_quantiles(os.path.join(data_folder, ERA5_FILE),
+                            cache_file=os.path.join(data_folder, make_fn(['quantiles'], ERA5_FILE)))
+    log_msg(f"ERA5 quantile table ready after {timer() - start_time:.1f}s\n", LOG_FILE)
+
+    bnout = "bias_corrWG10_" + cmip6_basename
+    tasks = []
+    for modname in models:
+        out_file = os.path.join(data_folder, modname + "_" + bnout + '.nc')
+        if is_complete(out_file):
+            log_msg(f"Skipping {modname}, {out_file} exists\n", LOG_FILE)
+            continue
+        cmip_file = os.path.join(data_folder, make_fn([modname], cmip6_basename, filetype=".nc"))
+        tasks.append((modname, cmip_file, out_file, qt_obs, scenarios))
+
+    pool = Pool(nodes=nb_cpus) if nb_cpus else Pool()
+    for modname, time_delta in pool.imap(_bias_correct_file, tasks):
+        log_msg(f"Time for bias correction model {modname}: {time_delta:.1f}s\n", LOG_FILE)
+    pool.close()
+    pool.join()
+    log_msg(f"Bias corrected {len(tasks)} models in {timer() - start_time:.1f}s\n", LOG_FILE)
+
+
+if __name__ == "__main__":
+    cli.run(main, 'bias_correction', [
+        ('data_folder', str, cli.REQUIRED, "Folder of the ERA5 and CMIP6 files"),
+        ('cmip6_basename', str, cli.REQUIRED, "Base name of the CMIP6 files"),
+        ('models', cli.str_list, cli.REQUIRED, "Models, e.g. CanESM5,NESM3"),
+        ('scenarios', cli.str_list, SCENARIOS, "Scenarios, e.g. historical,ssp585"),
+        ('nb_cpus', int, None, "Number of models processed in parallel"),
+    ], description="Bias correct the CMIP6 winter winds against ERA5.")
@@ -0,0 +1,254 @@
+"""
+cmip6_inventory.py
+
+Persistent inventory of the CMIP6 files used for the winter windstorm hazard, stored in
+a small SQLite table that maps variable, time resolution, scenario, model, member and
+time range to files.
+
+The directories of the CMIP6 archive (<root>/<scen>/<tres>/<var>/<model>/<member>/<grid>/)
+are only listed again when their mtime changed since the last refresh, so that after the
+first scan a refresh only costs one stat per known directory. The available members
+(models_df and dicscen of API_storm_days_prep.ipynb) and the file lists for
+xr.open_mfdataset are then obtained from indexed queries.
+
+Usage: python cmip6_inventory.py <db_file> [<var>] [<scenario1,scenario2,...>]
+"""
+
+import os
+import sys
+import sqlite3
+from datetime import datetime
+from timeit import default_timer as timer
+
+import pandas as pd
+
+# Add parent directory to sys.path to access config and utils
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+from create_log_file import log_msg
+import cli
+
+CMIP6_DIR = "/net/atmos/data/cmip6"
+SCENARIOS = ["historical", "ssp126", "ssp245", "ssp370", "ssp585"]
+VAR = "sfcWindmax"
+TRES = "day"
+LOG_FILE = f"progress_cmip6_inventory_{datetime.today().strftime('%Y%m%d')}.txt"
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS dirs (
+    path TEXT PRIMARY KEY,
+    mtime REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS files (
+    var TEXT NOT NULL,
+    tres TEXT NOT NULL,
+    scen TEXT NOT NULL,
+    model TEXT NOT NULL,
+    member TEXT NOT NULL,
+    grid TEXT NOT NULL,
+    path TEXT PRIMARY KEY,
+    start TEXT,
+    end TEXT
+);
+CREATE INDEX IF NOT EXISTS files_key ON files (var, tres, scen, model, member);
+"""
+
+
+def open_index(db_file):
+    """
+    Open (and create if needed) the inventory database.
+
+    Parameters:
+        db_file (str): SQLite file of the inventory.
+
+    Returns:
+        sqlite3.Connection: Connection to the inventory.
+    """
+    con = sqlite3.connect(db_file)
+    con.executescript(SCHEMA)
+    return con
+
+
+def file_time_range(filename):
+    """
+    Parse the time range of a CMIP6 file name, e.g. ..._gn_19800101-19841231.nc.
+
+    Parameters:
+        filename (str): Name of the file.
+
+    Returns:
+        tuple: (start, end) as 'YYYYMMDD' strings, or (None, None) if the name has no range.
+    """
+    stem = os.path.splitext(filename)[0].rsplit('_', 1)[-1]
+    start, sep, end = stem.partition('-')
+    if not sep or not (start.isdigit() and end.isdigit()):
+        return None, None
+    start, end = start[:8], end[:8]
+    #complete yearly (YYYY) or monthly (YYYYMM) ranges to days
+    return start + '0101'[len(start) - 4:], end + '1231'[len(end) - 4:]
+
+
+def _under(path):
+    """SQL condition and parameters selecting the paths below path."""
+    prefix = os.path.join(path, '')
+    return "substr(path, 1, ?) = ?", (len(prefix), prefix)
+
+
+def _subdirs(con, path, known, children):
+    """
+    Subdirectories of path, listed only if path changed since the last refresh. The
+    entries of removed subdirectories are dropped.
+
+    Returns:
+        names (list of str): Names of the subdirectories.
+        listed (bool): True if path was listed.
+    """
+    mtime = os.stat(path).st_mtime
+    if known.get(path) == mtime:
+        return children.get(path, []), False
+    con.execute("INSERT OR REPLACE INTO dirs (path, mtime) VALUES (?, ?)", (path, mtime))
+    names = sorted(entry.name for entry in os.scandir(path) if entry.is_dir())
+    for name in set(children.get(path, [])) - set(names):
+        removed = os.path.join(path, name)
+        cond, params = _under(removed)
+        con.execute(f"DELETE FROM dirs WHERE path = ? OR {cond}", (removed, *params))
+        con.execute(f"DELETE FROM files WHERE {cond}", params)
+    return names, True
+
+
+def refresh_index(con, scenarios=SCENARIOS, var=VAR, tres=TRES, root=CMIP6_DIR):
+    """
+    Update the inventory with the archive. Only directories whose mtime changed since the
+    last refresh are listed again; entries of removed directories are dropped.
+
+    Parameters:
+        con (sqlite3.Connection): Connection to the inventory.
+        scenarios (list of str): Scenarios to index.
+        var (str): Variable to index.
+        tres (str): Time resolution to index.
+        root (str): Root directory of the CMIP6 archive.
+
+    Returns:
+        int: Number of directories listed again.
+    """
+    known = dict(con.execute("SELECT path, mtime FROM dirs"))
+    children = {}
+    for path in known:
+        children.setdefault(os.path.dirname(path), []).append(os.path.basename(path))
+
+    n_listed = 0
+    for scen in scenarios:
+        var_dir = os.path.join(root, scen, tres, var)
+        if not os.path.isdir(var_dir):
+            continue
+        models, listed = _subdirs(con, var_dir, known, children)
+        n_listed += listed
+        for model in models:
+            model_dir = os.path.join(var_dir, model)
+            members, listed = _subdirs(con, model_dir, known, children)
+            n_listed += listed
+            for member in members:
+                member_dir = os.path.join(model_dir, member)
+                grids, listed = _subdirs(con, member_dir, known, children)
+                n_listed += listed
+                for grid in grids:
+                    grid_dir = os.path.join(member_dir, grid)
+                    mtime = os.stat(grid_dir).st_mtime
+                    if known.get(grid_dir) == mtime:
+                        continue
+                    n_listed += 1
+                    con.execute("INSERT OR REPLACE INTO dirs (path, mtime) VALUES (?, ?)", (grid_dir, mtime))
+                    cond, params = _under(grid_dir)
+                    con.execute(f"DELETE FROM files WHERE {cond}", params)
+                    con.executemany(
+                        "INSERT INTO files (var, tres, scen, model, member, grid, path, start, end) "
+                        "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                        [(var, tres, scen, model, member, grid, os.path.join(grid_dir, name),
+                          *file_time_range(name))
+                         for name in sorted(os.listdir(grid_dir)) if name.endswith('.nc')])
+    con.commit()
+    return n_listed
+
+
+def available_members(con, scenarios=SCENARIOS, var=VAR, tres=TRES):
+    """
+    Members available for each model and scenario.
+
+    Parameters:
+        con (sqlite3.Connection): Connection to the inventory.
+        scenarios (list of str): Scenarios to consider.
+        var (str): Variable.
+        tres (str): Time resolution.
+
+    Returns:
+        models_df (pd.DataFrame): Number of members per model (rows) and scenario (columns).
+        dicscen (dict): dicscen[scen][model] = [number of members, list of member names].
+    """
+    rows = con.execute(
+        "SELECT DISTINCT scen, model, member FROM files WHERE var=? AND tres=? AND scen IN (%s) "
+        "ORDER BY scen, model, member" % ','.join('?'*len(scenarios)), (var, tres, *scenarios)).fetchall()
+    members_df = pd.DataFrame(rows, columns=['scen', 'model', 'member'])
+    models_df = members_df.groupby(['model', 'scen']).size().unstack('scen').reindex(columns=scenarios)
+    dicscen = {scen: {} for scen in scenarios}
+    for (scen, model), members in members_df.groupby(['scen', 'model'])['member']:
+        dicscen[scen][model] = [len(members), members.tolist()]
+    return models_df, dicscen
+
+
+def member_files(con, scen, model, member, datestart=None, dateend=None, var=VAR, tres=TRES):
+    """
+    Files of a member, optionally restricted to those overlapping a time range, for
+    xr.open_mfdataset.
+
+    Parameters:
+        con (sqlite3.Connection): Connection to the inventory.
+        scen (str): Scenario.
+        model (str): Model.
+        member (str): Member, e.g. r1i1p1f1.
+        datestart (str, optional): Start date, 'YYYY-MM-DD'.
+        dateend (str, optional): End date, 'YYYY-MM-DD'.
+        var (str): Variable.
+        tres (str): Time resolution.
+
+    Returns:
+        list of str: Sorted paths of the files (of the first grid if there are several).
+    """
+    query = "SELECT grid, path FROM files WHERE var=? AND tres=? AND scen=? AND model=? AND member=?"
+    params = [var, tres, scen, model, member]
+    if datestart:
+        query += " AND (end IS NULL OR end >= ?)"
+        params.append(datestart.replace('-', ''))
+    if dateend:
+        query += " AND (start IS NULL OR start <= ?)"
+        params.append(dateend.replace('-', ''))
+    rows = con.execute(query + " ORDER BY grid, path", params).fetchall()
+    if not rows:
+        return []
+    return [path for grid, path in rows if grid == rows[0][0]]
+
+
+def main(db_file, var=VAR, scenarios=SCENARIOS, tres=TRES, root=CMIP6_DIR):
+    """
+    Refresh the inventory and print the number of members per model and scenario.
+
+    Parameters:
+        db_file (str): SQLite file of the inventory.
+        var (str): Variable to index.
+        scenarios (list of str): Scenarios to index.
+        tres (str): Time resolution to index.
+        root (str): Root directory of the CMIP6 archive.
+    """
+    start_time = timer()
+    con = open_index(db_file)
+    n_listed = refresh_index(con, scenarios=scenarios, var=var, tres=tres, root=root)
+    models_df, _ = available_members(con, scenarios=scenarios, var=var, tres=tres)
+    con.close()
+    log_msg(f"Refreshed {db_file} ({n_listed} directories listed) in {timer() - start_time:.1f}s\n", LOG_FILE)
+    print(models_df)
+
+
+if __name__ == "__main__":
+    cli.run(main, 'cmip6_inventory', [
+        ('db_file', str, cli.REQUIRED, "SQLite file of the inventory"),
+        ('var', str, VAR, "Variable"),
+        ('scenarios', cli.str_list, SCENARIOS, "Scenarios, e.g. historical,ssp585"),
+    ], description="Refresh the inventory of the CMIP6 files.")
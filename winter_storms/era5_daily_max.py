@@ -0,0 +1,158 @@
+"""
+era5_daily_max.py
+
+Compute daily maxima of hourly ERA5 wind gusts (WG10) over Europe for the winter
+half year (ONDJFM), as input for the bias correction of the CMIP6 winter winds.
+
+The hourly files are selected by month before anything is opened, every day is
+cropped to the domain and reduced to its maximum independently in a process pool,
+and the daily fields are appended in order to a chunked Zarr store. An existing
+store is resumed, i.e. days that are already stored are skipped.
+
+Usage: python era5_daily_max.py <start_year> <end_year> <out_store> [<out_netcdf>]
+"""
+
+import os
+import sys
+import glob
+from datetime import datetime
+from timeit import default_timer as timer
+
+import numpy as np
+import pandas as pd
+import xarray as xr
+from pathos.pools import ProcessPool as Pool
+
+# Add parent directory to sys.path to access config and utils
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+from create_log_file import log_msg
+import cli
+from output_manifest import write_atomic
+from utility import DOMAIN_EU, WINTER_MONTHS, def_domain, norm_lon
+
+ERA5_DIR = "/net/atmos/data/era5"  # input path for ERA5 data
+ERA5_FILE_PATTERN = "B{year}{month:02d}??_??"  # one file per hour, e.g. B19801001_00
+VAR = 'WG10'
+LOG_FILE = f"progress_era5_daily_max_{datetime.today().strftime('%Y%m%d')}.txt"
+
+
+def era5_daily_files(years, months=WINTER_MONTHS, era5_dir=ERA5_DIR):
+    """
+    Select the hourly ERA5 files of the requested months and group them by day.
+
+    Parameters:
+        years (list of int): Years to select.
+        months (list of int): Months to select (1=January, ..., 12=December).
+        era5_dir (str): Root directory of the ERA5 data (<era5_dir>/<year>/<month>/).
+
+    Returns:
+        dict: Sorted mapping of day (pd.Timestamp) to the sorted list of its hourly files.
+    """
+    days = {}
+    for year in years:
+        for month in months:
+            pattern = os.path.join(era5_dir, str(year), f"{month:02d}",
+                                   ERA5_FILE_PATTERN.format(year=year, month=month))
+            for path in glob.glob(pattern):
+                day = pd.Timestamp(os.path.basename(path)[1:9])
+                days.setdefault(day, []).append(path)
+    return {day: sorted(days[day]) for day in sorted(days)}
+
+
+def daily_max(day, paths, var=VAR, domain=DOMAIN_EU):
+    """
+    Compute the daily maximum of one day of hourly ERA5 files over the domain.
+
+    Parameters:
+        day (pd.Timestamp): Day of the files.
+        paths (list of str): Hourly files of the day.
+        var (str): Variable to read.
+        domain (tuple): (min_lat, max_lat, min_lon, max_lon) in degrees.
+
+    Returns:
+        xr.DataArray: Daily maximum with a time dimension of length one.
+    """
+    fields = []
+    for path in paths:
+        with xr.open_dataset(path) as ds:
+            da = def_domain(norm_lon(ds[var]), *domain)
+            fields.append(da.load())
+    da_day = xr.concat(fields, dim='time').max(dim='time')
+    return da_day.expand_dims(time=[np.datetime64(day, 'ns')])
+
+
+def _daily_max_item(item):
+    """Unpack a (day, paths) item for the process pool."""
+    return daily_max(*item)
+
+
+def write_daily(da_list, out_store):
+    """Append daily fields to the Zarr store (chunked by day), creating it if needed."""
+    ds = xr.concat(da_list, dim='time').to_dataset(name=VAR)
+    ds = ds.chunk({'time': 1})
+    if os.path.exists(out_store):
+        ds.to_zarr(out_store, append_dim='time')
+    else:
+        ds.to_zarr(out_store, mode='w')
+
+
+def main(years=None, out_store='era5_WG10_br_day_EU_winE.zarr', out_netcdf=None,
+         months=WINTER_MONTHS, nb_cpus=None, batch_days=31):
+    """
+    Compute the daily maxima of ERA5 WG10 over Europe and write them incrementally.
+
+    Parameters:
+        years (list of int): Start and end year, e.g. [1980, 2010].
+        out_store (str): Path of the Zarr store the daily maxima are appended to.
+        out_netcdf (str, optional): If given, the store is also written to this netCDF
+            file (e.g. era5_WG10_br_day_EU_winE.nc for the bias correction).
+        months (list of int): Months to consider. Default: ONDJFM.
+        nb_cpus (int, optional): Number of worker processes. Default: all cpus.
+        batch_days (int): Number of days appended to the store at once.
+    """
+    if years is None:
+        years = [1980, 2010]
+
+    start_time = timer()
+    days = era5_daily_files(range(int(years[0]), int(years[1]) + 1), months)
+
+    # resume: skip days already stored
+    if os.path.exists(out_store):
+        with xr.open_zarr(out_store) as ds_done:
+            done = set(pd.DatetimeIndex(ds_done.time.values))
+        days = {day: paths for day, paths in days.items() if day not in done}
+    log_msg(f"Selected {len(days)} days to process in {timer() - start_time:.1f}s\n", LOG_FILE)
+
+    start_time = timer()
+    pool = Pool(nodes=nb_cpus) if nb_cpus else Pool()
+    batch = []
+    for da_day in pool.imap(_daily_max_item, days.items()):
+        batch.append(da_day)
+        if len(batch) == batch_days:
+            write_daily(batch, out_store)
+            log_msg(f"Stored days until {pd.Timestamp(da_day.time.values[0]).date()} "
+                    f"after {timer() - start_time:.1f}s\n", LOG_FILE)
+            batch = []
+    if batch:
+        write_daily(batch, out_store)
+    pool.close()
+    pool.join()
+    log_msg(f"Computed daily maxima of {len(days)} days in {timer() - start_time:.1f}s\n", LOG_FILE)
+
+    if out_netcdf:
+        start_time = timer()
+        with xr.open_zarr(out_store) as ds:
+            write_atomic(out_netcdf, ds.sortby('time').to_netcdf)
+        log_msg(f"Written {out_netcdf} in {timer() - start_time:.1f}s\n", LOG_FILE)
+
+
+if __name__ == "__main__":
+    cli.run(lambda start_year, end_year, out_store, out_netcdf, nb_cpus: main(
+                years=[start_year, end_year], out_store=out_store, out_netcdf=out_netcdf, nb_cpus=nb_cpus),
+            'era5_daily_max', [
+                ('start_year', int, cli.REQUIRED, "First year"),
+                ('end_year', int, cli.REQUIRED, "Last year"),
+                ('out_store', str, cli.REQUIRED, "Zarr store of the daily maxima"),
+                ('out_netcdf', str, None, "netCDF file the store is also written to"),
+                ('nb_cpus', int, None, "Number of worker processes"),
+            ], description="Compute the daily maxima of ERA5 WG10 over Europe.")
@@ -0,0 +1,249 @@
+"""
+storm_days_hazard.py
+
+Preprocessing of the (bias corrected) CMIP6 and ERA5 winter winds into storm days
+for the winter windstorm hazard of the data API (see API_storm_days_prep.ipynb).
+
+The per-gridcell quantile of the historical period only depends on the historical
+data of each model. It is computed once per model on arrays chunked in space (the
+full time series of a grid cell is always in one chunk, such that the quantile is
+exact), cached to a netCDF file, and applied to all scenarios in a single pass.
+
+The masked fields are converted to CLIMADA hazards chunk by chunk along the events,
+keeping only the non-zero values, so that the memory is proportional to the number
+of storm gridcells rather than to the full (events x centroids) matrix.
+"""
+
+import os
+import sys
+import datetime as dt
+
+import numpy as np
+import pandas as pd
+import xarray as xr
+from scipy import sparse
+from climada.hazard import Hazard, Centroids
+
+from utility import get_lat_lon_res
+# Add parent directory to sys.path to access the output manifest
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+from output_manifest import is_complete, write_atomic
+
+#size of the spatial chunks (number of grid cells in lat and lon)
+CHUNK_LATLON = 16
+#number of events converted to sparse at once
+CHUNK_EVENTS = 100
+
+#centroids already built, by grid
+_CENTROIDS = {}
+
+
+def historical_quantile(da_past, q, dims=('member', 'day'), cache_file=None):
+    """
+    Compute the quantile q of the historical period at each grid cell.
+
+    Parameters:
+        da_past (xr.DataArray): Historical winds with dimensions dims, lat and lon.
+        q (float): Quantile, e.g. 0.98.
+        dims (tuple of str): Dimensions the quantile is computed over (e.g. member and time
+            for stacked members, or time only).
+        cache_file (str, optional): netCDF file to read the quantile field from if it was
+            completely written, or to write it to otherwise.
+
+    Returns:
+        xr.DataArray: Quantile field with dimensions lat and lon.
+    """
+    if cache_file and is_complete(cache_file):
+        with xr.open_dataarray(cache_file) as qt_field:
+            return qt_field.load()
+
+    dims = [dim for dim in dims if dim in da_past.dims]
+    da_past = da_past.chunk({**{dim: -1 for dim in dims}, 'lat': CHUNK_LATLON, 'lon': CHUNK_LATLON})
+    qt_field = da_past.quantile(q, dim=dims).drop_vars('quantile').compute()
+    qt_field.name = 'quantile'
+    qt_field.attrs['quantile'] = q
+
+    if cache_file:
+        write_atomic(cache_file, qt_field.to_netcdf)
+    return qt_field
+
+
+def mask_scenarios(ds, qt_field, scenarios, scale=False, mask_abs=None, timeres='day',
+                   stack=True, cutarea=1000000):
+    """
+    Mask the values below the historical quantile at each grid cell for several scenarios
+    at once. Fields for which less than cutarea is above the quantile are dropped.
+
+    Parameters:
+        ds (xr.Dataset): Winds with one variable per scenario, dimensions member, timeres, lat, lon.
+        qt_field (xr.DataArray): Quantile field from historical_quantile.
+        scenarios (list of str): Variables of ds to process (e.g. ['historical', 'ssp585']).
+        scale (bool): If True, the masked winds are scaled by the quantile, (U - U_qt) / U_qt
+            (as in scale_qt_2), otherwise the masked winds are returned (as in mask_qt_2).
+        mask_abs (float, optional): Mask everything below this absolute value.
+        timeres (str): Name of the time dimension.
+        stack (bool): If True, the members are stacked along time.
+        cutarea (float): Minimal area (km2) above the quantile to keep a field.
+
+    Returns:
+        dict: Mapping of scenario to the masked xr.DataArray (zeros where masked), dask-backed:
+            only the number of values above the quantile of each field is computed here, the
+            masked values are computed block by block when converted (see sparse_events).
+    """
+    fut = xr.concat([ds[scen] for scen in scenarios], dim=pd.Index(scenarios, name='scenario'))
+    #lazy, one block per member and chunk of time steps with the whole grid
+    fut = fut.chunk({**({'member': 1} if 'member' in fut.dims else {}), timeres: CHUNK_EVENTS, 'lat': -1, 'lon': -1})
+    if stack:
+        fut = fut.stack(real=("member", timeres))
+        dim = "real"
+    else:
+        dim = timeres
+
+    #mask values below the quantile and below threshold
+    ds_mask = fut.where(fut > qt_field)
+    if mask_abs:
+        ds_mask = ds_mask.where(ds_mask >= mask_abs)
+    if scale:
+        ds_mask = (ds_mask - qt_field) / qt_field #scale by quantile
+
+    latres, lonres = get_lat_lon_res(ds)
+    gcarea = latres*lonres*100*100 #gridcell area approximated: 1 deg corresponds to 100km
+    threshold = round(cutarea/gcarea)
+
+    #number of values above the quantile of all scenarios in one pass, the masked fields stay lazy
+    n_valid = ds_mask.notnull().sum(dim=['lat', 'lon']).compute()
+
+    ds_mask_dict = dict()
+    for scen in scenarios:
+        #keep fields for which at least X values are not NaN
+        keep = n_valid.sel(scenario=scen).values >= threshold
+        da_scen = ds_mask.sel(scenario=scen, drop=True).isel({dim: keep})
+        if stack:
+            da_scen = da_scen.unstack()
+        da_scen.name = scen
+        ds_mask_dict[scen] = da_scen.fillna(0)
+    return ds_mask_dict
+
+
+def mask_qt_2(ds, q, mask_abs=None, timeres='day', stack=True, pastname='historical', futname='ssp585',
+              cutarea=1000000, qt_field=None):
+    '''Function taking a dateset as an input, and returning it with the values below the quantile q at each grid cell
+       masked. The mask is computed for each gridcell for the past period. Fields for which less than cutarea is above the
+       quantile are dropped. A precomputed quantile field (historical_quantile) can be passed as qt_field.'''
+    if qt_field is None:
+        qt_field = historical_quantile(ds[pastname], q, dims=("member", timeres) if stack else (timeres,))
+    return mask_scenarios(ds, qt_field, [futname], scale=False, mask_abs=mask_abs, timeres=timeres,
+                          stack=stack, cutarea=cutarea)[futname]
+
+
+def scale_qt_2(ds, q, mask_abs=None, timeres='day', stack=True, pastname='historical', futname='ssp585',
+               cutarea=1000000, qt_field=None):
+    '''Function taking a dateset as an input, and returning it with the values below the quantile q at each grid cell
+       masked and the other values scaled by the quantile. The mask is computed for each gridcell for the past period.
+       Fields for which less than cutarea is above the quantile are dropped. A precomputed quantile field
+       (historical_quantile) can be passed as qt_field.'''
+    if qt_field is None:
+        qt_field = historical_quantile(ds[pastname], q, dims=("member", timeres) if stack else (timeres,))
+    return mask_scenarios(ds, qt_field, [futname], scale=True, mask_abs=mask_abs, timeres=timeres,
+                          stack=stack, cutarea=cutarea)[futname]
+
+
+def grid_centroids(lat, lon):
+    """
+    Centroids of a lat/lon grid (lat outer, lon inner, as stack(cent=("lat", "lon"))).
+    The centroids are built once per grid and shared by all hazards on that grid.
+
+    Parameters:
+        lat (array-like): Latitudes of the grid.
+        lon (array-like): Longitudes of the grid.
+
+    Returns:
+        Centroids: Centroids of the grid.
+    """
+    lat = np.asarray(lat, dtype=float)
+    lon = np.asarray(lon, dtype=float)
+    key = (lat.tobytes(), lon.tobytes())
+    if key not in _CENTROIDS:
+        lat_ar, lon_ar = np.meshgrid(lat, lon, indexing='ij')
+        _CENTROIDS[key] = Centroids(lat=lat_ar.ravel(), lon=lon_ar.ravel())
+    return _CENTROIDS[key]
+
+
+def sparse_events(da, event_dims, chunk_events=CHUNK_EVENTS):
+    """
+    Convert a DataArray to a sparse (events x centroids) matrix, chunk by chunk along
+    the events. Only the non-zero values of each chunk are kept. da must be dask-backed
+    (e.g. from mask_scenarios), such that each chunk is computed only when converted and the
+    memory is proportional to the non-zero values.
+
+    Parameters:
+        da (xr.DataArray): Lazy field with dimensions event_dims, lat and lon (NaN filled with 0).
+        event_dims (list of str): Dimensions stacked into events, outer first
+            (e.g. ['member', 'day']).
+        chunk_events (int): Number of time steps converted at once.
+
+    Returns:
+        sparse.csr_matrix: Event matrix with events in the order of stack(events=event_dims).
+    """
+    if da.chunks is None:
+        raise ValueError("sparse_events requires a dask-backed DataArray (e.g. from mask_scenarios), "
+                         "use da.chunk() to convert an array in memory.")
+    da = da.transpose(*event_dims, 'lat', 'lon')
+    n_cent = da.sizes['lat']*da.sizes['lon']
+    outer_shape = [da.sizes[dim] for dim in event_dims[:-1]]
+    n_inner = da.sizes[event_dims[-1]]
+
+    blocks = []
+    for outer in np.ndindex(*outer_shape):
+        for start in range(0, n_inner, chunk_events):
+            block = da[outer + (slice(start, start + chunk_events),)].values
+            blocks.append(sparse.csr_matrix(block.reshape(-1, n_cent)))
+    if not blocks:
+        return sparse.csr_matrix((0, n_cent))
+    return sparse.vstack(blocks, format='csr')
+
+
+def set_centroids_3(da, stack=True, imem=0, haztype='WS', timeres="day", chunk_events=CHUNK_EVENTS):
+    """
+    Build a CLIMADA hazard from a masked DataArray, with centroids corresponding to its
+    latitudes and longitudes.
+
+    Parameters:
+        da (xr.DataArray): Lazy masked winds (see mask_scenarios), with attribute 'model' and the
+            period (scenario) as name. Dimensions member (if stack), timeres, lat and lon.
+        stack (bool): If True, the members are stacked into events, member outer.
+        imem (int): Member of da if not stacked, used for the event names.
+        haztype (str): Hazard type.
+        timeres (str): Name of the time dimension.
+        chunk_events (int): Number of time steps converted to sparse at once.
+
+    Returns:
+        Hazard: Winter windstorm hazard.
+    """
+    gcm_name = da.attrs['model']
+    period = da.name
+
+    event_dims = ["member", timeres] if stack else [timeres]
+    intensity = sparse_events(da, event_dims, chunk_events)
+    n_ev = intensity.shape[0]
+    n_time = da.sizes[timeres]
+    nmem = da.sizes["member"] if stack else 1
+
+    ev_dates = pd.to_datetime(da[timeres].values).map(dt.datetime.toordinal).to_numpy()
+    ev_dates = np.tile(ev_dates, nmem)
+    if (gcm_name != 'era5') and stack:
+        ev_names = np.repeat([gcm_name+'_'+period+'_mem'+str(mem) for mem in da["member"].values.tolist()],
+                             n_time).tolist()
+    elif gcm_name != 'era5':
+        ev_names = np.repeat(gcm_name+'_'+period+'_mem'+str(imem), n_ev).tolist()
+    else:
+        ev_names = np.repeat(gcm_name+'_'+period, n_ev).tolist()
+
+    fraction = intensity.copy()
+    fraction.data.fill(1)
+    haz = Hazard(haztype, units='m/s', centroids=grid_centroids(da.lat, da.lon),
+                 event_id=np.arange(n_ev, dtype=int), event_name=ev_names, date=ev_dates,
+                 orig=np.zeros(n_ev, bool), frequency=np.ones(n_ev)/(nmem*30),
+                 intensity=intensity, fraction=fraction)
+    haz.check()
+    return haz
@@ -0,0 +1,74 @@
+"""
+Utility functions for the winter windstorm hazard of the data API, taken from
+API_storm_days_prep.ipynb.
+"""
+#winter half year (ONDJFM)
+WINTER_MONTHS = [1, 2, 3, 10, 11, 12]
+
+#European domain (min_lat, max_lat, min_lon, max_lon), in degrees
+DOMAIN_EU = (30, 75, -30, 30)
+
+
+def norm_lon(ds):
+    """Function that takes xr.dataset or xr.dataarry and normalizes its longitude coordinate
+    Args:
+        ds (xr.dataset or xr.dataarry) = input dataset which lon coordinates needs to be normalized
+
+    Ouputs:
+        ds = xr.dataset or xr.dataarry with normalized lon coordinates
+    """
+    ds.coords['lon'] = (ds.coords['lon'] + 180) % 360 - 180
+    return ds.sortby(ds.lon)
+
+
+def def_domain(ds, min_lat, max_lat, min_lon, max_lon):
+    """Function that takes xr.dataset or xr.dataarry and box coordinates from a domain and crops the dataset or datarray to
+    the domain defined by the box coordinates.
+    Args:
+        ds (xr.dataset or xr.dataarry) = input dataset which lat and lon needs to be cropped
+        min_lat, max_lat = minimum and maximum latitudinal coordinates
+        min_lon, max_lon = minimum and maximum longitudinal coordinates
+    Ouputs:
+        ds = xr.dataset or xr.dataarry cropped to the input domain
+    """
+    LatIndexer, LonIndexer = 'lat', 'lon'
+    lat_slice = slice(min_lat, max_lat)
+    if ds[LatIndexer].size > 1 and ds[LatIndexer][0] > ds[LatIndexer][-1]: #descending latitudes (e.g. ERA5)
+        lat_slice = slice(max_lat, min_lat)
+    ds = ds.loc[{LatIndexer: lat_slice,
+                 LonIndexer: slice(min_lon, max_lon)}]
+    return ds
+
+
+def get_ONDJFM_day(ds, months=WINTER_MONTHS, timedim="day"):
+    """Function that takes xr.dataset or xr.dataarry and months of the year and returns a dataset corresponding to
+    the specified months
+    Args:
+        ds (xr.dataset or xr.dataarry) = input dataset from which monthly data needs to be selected
+        months = months which are requested, in ordinal format (1=January, 2=February, ...,12=December)
+        timedim = name of the temporal coordinate of the dataset
+
+    Ouputs:
+        ds = xr.dataset or xr.dataarry corresponding to the months selected
+    """
+    return ds.isel({timedim: ds[timedim].dt.month.isin(months)})
+
+
+def make_fn(addlist, basename="", sep="_", filetype=''):
+    return sep.join(addlist)+sep+basename+filetype
+
+
+def get_lat_lon_res(ds):
+    """Function to obtain the average lat and lon gridspacing from a dataset of a non regular model grid.
+    Args:
+        ds (xr.dataset or xr.dataarry) = input dataset from which average lat and lon resolutions must be calculated
+    Ouputs:
+        latres, lonres = average latitudinal and longitudinal resolutions
+    """
+    lat = ds.coords['lat']
+    lon = ds.coords['lon']
+    difflat = lat - lat.shift(lat=1)
+    latres = difflat.mean().to_numpy()
+    difflon = lon - lon.shift(lon=1)
+    lonres = difflon.mean().to_numpy()
+    return latres, lonres
@@ -0,0 +1,328 @@
+"""
+Warm worker daemon for the pipeline scripts.
+
+Each script started with python pays the import of CLIMADA (and CLIMADA petals) and the
+load of its global centroids, tens of seconds before any work, for each of the hundreds
+of jobs of a run. The daemon imports the libraries and loads the frequently used centroid
+files once (see centroid_cache.py), then runs the scripts submitted on a Unix socket. Each
+job is a fork of the daemon: it starts with the libraries and centroids in memory, runs
+the script as python would (as __main__, with its arguments, working directory and
+environment, writing to the standard streams of the client) and exits, such that the jobs
+cannot change the state of the daemon or of each other. The client exits with the return
+code of the script.
+
+The start-up overhead of each job (from the submission to the start of the script) is
+printed by the client and recorded in the event log of the job (stage 'worker_job').
+
+Repository modules (but config and centroid_cache) are not preloaded, such that they are
+imported in the environment of each job (e.g. PIPELINE_LOG_DIR, TC_RUN_ID). Libraries
+reading their configuration at import (e.g. the CLIMADA configuration) keep that of the
+daemon.
+
+The socket is WORKER_SOCKET if set, <tmp>/climada_worker_<uid>.sock otherwise, readable
+by the user only. Without a daemon, run starts the script in a new python process.
+
+Usage: python worker_daemon.py serve [--centroids <file>,...] [--max-jobs <n>]
+       python worker_daemon.py run <script.py> [<args> ...]
+       python worker_daemon.py status
+       python worker_daemon.py stop
+"""
+import os
+import sys
+import json
+import time
+import runpy
+import atexit
+import signal
+import socket
+import argparse
+import tempfile
+import importlib
+import traceback
+
+from centroid_cache import preload_centroids
+
+SOCKET_ENV = 'WORKER_SOCKET'
+SOCKET_PATH = os.environ.get(SOCKET_ENV) or os.path.join(tempfile.gettempdir(), f"climada_worker_{os.getuid()}.sock")
+PRELOAD = ['numpy', 'scipy.sparse', 'pandas', 'xarray', 'h5py', 'pathos.pools', 'pycountry',
+           'climada.hazard', 'climada.entity', 'climada.util.coordinates', 'climada.util.constants']
+PRELOAD_OPTIONAL = ['climada_petals.hazard', 'hdf5plugin']
+MAX_MESSAGE = 2**20
+STREAMS = [0, 1, 2]  # stdin, stdout and stderr of the client, passed to the job
+
+
+def default_centroids():
+    """Centroid files of the TC, STORM and river flood scripts."""
+    from climada.util.constants import SYSTEM_DIR
+    from config import DATA_DIR
+
+    centroids_dir = os.path.join(DATA_DIR, 'centroids', '08_2022')
+    return [
+        os.path.join(centroids_dir, 'earth_centroids_150asland_1800asoceans_distcoast_region.hdf5'),
+        os.path.join(centroids_dir, 'earth_centroids_150asland_1800asoceans_distcoast_region_litpop_aligned.hdf5'),
+        str(SYSTEM_DIR.joinpath('centroids_0300as_global.hdf5')),
+    ]
+
+
+def send_message(sock, message, fds=()):
+    """Send a JSON message, with file descriptors."""
+    data = json.dumps(message).encode() + b'\n'
+    if fds:
+        socket.send_fds(sock, [data], list(fds))
+    else:
+        sock.sendall(data)
+
+
+def receive_message(sock, maxfds=0):
+    """Receive a JSON message and the file descriptors sent with it."""
+    data, fds, _, _ = socket.recv_fds(sock, MAX_MESSAGE, maxfds) if maxfds else (sock.recv(MAX_MESSAGE), [], 0, None)
+    while data and not data.endswith(b'\n'):
+        chunk = sock.recv(MAX_MESSAGE)
+        if not chunk:
+            break
+        data += chunk
+    if not data:
+        raise ConnectionError("connection closed without a message")
+    return json.loads(data), fds
+
+
+def _run_job(conn, request, fds):
+    """Run a script in the forked job process and report its return code. Does not return."""
+    code = 1
+    try:
+        started = time.time()
+        signal.signal(signal.SIGTERM, signal.SIG_DFL)
+        signal.signal(signal.SIGINT, signal.default_int_handler)
+        for fd, stream in zip(fds, STREAMS):
+            os.dup2(fd, stream)
+            os.close(fd)
+        os.chdir(request['cwd'])
+        os.environ.clear()
+        os.environ.update(request['env'])
+        script = request['script']
+        sys.argv = [script] + request['args']
+        sys.path.insert(0, os.path.dirname(script))  # as python <script>
+        overhead = started - request['sent']
+
+        from instrumentation import log_event
+        log_event('worker_job', os.path.basename(script), overhead_s=round(overhead, 4))
+        send_message(conn, {'started': True, 'overhead_s': overhead, 'pid': os.getpid()})
+        try:
+            runpy.run_path(script, run_name='__main__')
+            code = 0
+        except SystemExit as exit_:
+            if exit_.code is None or isinstance(exit_.code, int):
+                code = exit_.code or 0
+            else:
+                print(exit_.code, file=sys.stderr)
+        except BaseException:
+            traceback.print_exc()
+        atexit._run_exitfuncs()  # e.g. the flush of the event log, skipped by os._exit
+        send_message(conn, {'returncode': code, 'wall_s': time.time() - started})
+    except BaseException:
+        traceback.print_exc()
+    finally:
+        for stream in (sys.stdout, sys.stderr):
+            try:
+                stream.flush()
+            except (OSError, ValueError):
+                pass
+        os._exit(code)
+
+
+class WorkerDaemon:
+    """
+    Daemon running the submitted scripts in forked jobs, at most max_jobs at a time.
+
+    Example:
+        WorkerDaemon(SOCKET_PATH, centroids=default_centroids()).serve()
+    """
+
+    def __init__(self, socket_path=SOCKET_PATH, centroids=(), max_jobs=None):
+        self.socket_path = socket_path
+        self.max_jobs = max_jobs or os.cpu_count()
+        self.jobs = {}  # pid: script, arguments and start time
+        self.stopping = False
+        self.started = time.time()
+        self.preloaded = preload_modules()
+        self.centroids = preload_centroids(centroids)
+        self.preload_s = time.time() - self.started
+
+    def _reap(self, block=False):
+        """Remove the jobs that exited."""
+        while self.jobs:
+            pid, _ = os.waitpid(-1, 0 if block else os.WNOHANG)
+            if pid == 0:
+                return
+            self.jobs.pop(pid, None)
+            if block:
+                return
+
+    def status(self):
+        """State of the daemon."""
+        return {'pid': os.getpid(), 'uptime_s': round(time.time() - self.started, 1),
+                'preload_s': round(self.preload_s, 1), 'modules': self.preloaded, 'centroids': self.centroids,
+                'max_jobs': self.max_jobs, 'jobs': [dict(job, pid=pid) for pid, job in self.jobs.items()]}
+
+    def _handle(self, conn):
+        request, fds = receive_message(conn, maxfds=len(STREAMS))
+        if request['cmd'] != 'run':
+            for fd in fds:
+                os.close(fd)
+            if request['cmd'] == 'stop':
+                self.stopping = True
+            send_message(conn, self.status())
+            return
+        sys.stdout.flush()
+        sys.stderr.flush()
+        pid = os.fork()
+        if pid == 0:
+            self.server.close()
+            _run_job(conn, request, fds)
+        for fd in fds:
+            os.close(fd)
+        self.jobs[pid] = {'script': request['script'], 'args': request['args'], 'started': time.time()}
+
+    def serve(self):
+        """Accept jobs until stop is requested or SIGTERM, then wait for the running jobs."""
+        if os.path.exists(self.socket_path):
+            sock = _connect(self.socket_path)
+            if sock is not None:
+                sock.close()
+                raise RuntimeError(f"a worker daemon is already listening on {self.socket_path}")
+            os.remove(self.socket_path)  # stale socket of a daemon that was killed
+        self.server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        old_umask = os.umask(0o177)
+        try:
+            self.server.bind(self.socket_path)
+        finally:
+            os.umask(old_umask)
+        self.server.listen(64)
+        self.server.settimeout(1)
+        signal.signal(signal.SIGTERM, lambda *_: setattr(self, 'stopping', True))
+        print(f"Worker daemon {os.getpid()} listening on {self.socket_path} ({self.preload_s:.1f}s to preload "
+              f"{len(self.preloaded)} modules and {len(self.centroids)} centroid files)", flush=True)
+        try:
+            while not self.stopping:
+                self._reap()
+                if len(self.jobs) >= self.max_jobs:
+                    self._reap(block=True)
+                    continue
+                try:
+                    conn, _ = self.server.accept()
+                except socket.timeout:
+                    continue
+                except InterruptedError:
+                    continue
+                with conn:
+                    conn.settimeout(None)
+                    try:
+                        self._handle(conn)
+                    except (OSError, ValueError, KeyError) as err:
+                        print(f"Invalid request: {err!r}", file=sys.stderr, flush=True)
+        finally:
+            self.server.close()
+            os.remove(self.socket_path)
+            while self.jobs:
+                self._reap(block=True)
+
+
+def preload_modules(names=PRELOAD, optional=PRELOAD_OPTIONAL):
+    """Import the libraries of the scripts, the optional ones if installed."""
+    loaded = []
+    for name in list(names) + list(optional):
+        try:
+            importlib.import_module(name)
+            loaded.append(name)
+        except ImportError:
+            if name not in optional:
+                raise
+    return loaded
+
+
+def _connect(socket_path):
+    """Connection to the daemon, None if it is not running."""
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(socket_path)
+        return sock
+    except (FileNotFoundError, ConnectionRefusedError):
+        sock.close()
+        return None
+
+
+def request(cmd, socket_path=SOCKET_PATH):
+    """Send a command (status or stop) to the daemon, None if it is not running."""
+    sock = _connect(socket_path)
+    if sock is None:
+        return None
+    with sock:
+        send_message(sock, {'cmd': cmd})
+        return receive_message(sock)[0]
+
+
+def submit(script, args=(), socket_path=SOCKET_PATH, verbose=True):
+    """
+    Run a script in the daemon, with the working directory, environment and standard
+    streams of the caller.
+
+    Parameters:
+        script (str): Path of the script.
+        args (list of str): Command line arguments of the script.
+        socket_path (str): Socket of the daemon.
+        verbose (bool): Print the start-up overhead to stderr.
+
+    Returns:
+        int: Return code of the script, None if the daemon is not running.
+    """
+    sock = _connect(socket_path)
+    if sock is None:
+        return None
+    with sock:
+        send_message(sock, {'cmd': 'run', 'script': os.path.abspath(script), 'args': list(args),
+                            'cwd': os.getcwd(), 'env': dict(os.environ), 'sent': time.time()}, fds=STREAMS)
+        reader = sock.makefile('rb')
+        started = json.loads(reader.readline() or 'null')
+        if started is None:
+            return 1
+        if verbose:
+            print(f"[worker {started['pid']}] started {os.path.basename(script)} in "
+                  f"{started['overhead_s'] * 1000:.0f} ms", file=sys.stderr, flush=True)
+        finished = json.loads(reader.readline() or 'null')
+        return 1 if finished is None else finished['returncode']
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Warm worker daemon for the pipeline scripts.")
+    parser.add_argument('--socket', default=SOCKET_PATH, help=f"Socket of the daemon (default: {SOCKET_PATH}).")
+    commands = parser.add_subparsers(dest='command', required=True)
+    serve = commands.add_parser('serve', help="Start the daemon.")
+    serve.add_argument('--centroids', default=None,
+                       help="Centroid files to preload, comma separated (default: those of the scripts).")
+    serve.add_argument('--max-jobs', type=int, default=None, help="Concurrent jobs (default: number of CPUs).")
+    run = commands.add_parser('run', help="Run a script in the daemon.")
+    run.add_argument('script')
+    run.add_argument('args', nargs=argparse.REMAINDER)
+    commands.add_parser('status', help="Print the state of the daemon.")
+    commands.add_parser('stop', help="Stop the daemon once the running jobs are finished.")
+    args = parser.parse_args(argv)
+
+    if args.command == 'serve':
+        WorkerDaemon(args.socket, centroids=args.centroids.split(',') if args.centroids else default_centroids(),
+                     max_jobs=args.max_jobs).serve()
+        return 0
+    if args.command == 'run':
+        code = submit(args.script, args.args, socket_path=args.socket)
+        if code is None:  # no daemon, cold start
+            os.execv(sys.executable, [sys.executable, args.script] + args.args)
+        return code
+    state = request(args.command, socket_path=args.socket)
+    if state is None:
+        print(f"No worker daemon on {args.socket}")
+        return 1
+    print(json.dumps(state, indent=2))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())